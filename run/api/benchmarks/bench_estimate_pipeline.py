@@ -0,0 +1,209 @@
+# End-to-end latency of an estimate from the sensor query results: screening, correction factors, elevations, createModel and estimateUsingModel.
+# Compares the columnar pipeline (prepareModelSensorData, which keeps the readings in one DataFrame) with the previous one, which moved the
+# query results into a list of dictionaries and worked on them one reading at a time (kept below as the reference), and exits with an error
+# if the estimates differ.
+#
+# The readings are either a recorded query result (csv or parquet with the columns of request_model_data_local: id, time, pm2_5, lat, lon,
+# humidity, sensormodel, sensorsource) or synthetic readings.  The area elevation files are not in the repo, so the elevations come from a
+# synthetic grid.
+#
+# usage (from run/api):
+#    python -m benchmarks.bench_estimate_pipeline
+#    python -m benchmarks.bench_estimate_pipeline --sensors 400 --hours 12
+#    python -m benchmarks.bench_estimate_pipeline --data recorded_query.parquet
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytz
+
+import common.elevation as elevation
+import common.gaussian_model_utils as gaussian_model_utils
+import common.jsonutils as jsonutils
+import common.utils as utils
+
+START_TIME = datetime(2021, 9, 20, 0, 0, 0, 0, pytz.timezone('UTC'))
+SENSOR_MODELS = ['PMS3003', 'PMS5003', 'SPS30']
+SENSOR_SOURCES = {'PMS3003': 'AQ&U', 'PMS5003': 'PurpleAir', 'SPS30': 'Tetrad'}
+LATLON_LENGTH_SCALE = 2000.
+ELEVATION_LENGTH_SCALE = 100.
+TIME_LENGTH_SCALE = 0.25
+MEAN_TOLERANCE = 1e-6
+
+
+# correction factors with the shape of the ones in the region info, one period per sensor model and a catch-all
+def makeCorrectionFactors(start_time, end_time):
+    factors = {}
+    for sensor_model, slope in zip(SENSOR_MODELS + ['default'], [0.778, 0.524, 0.85, 1.0]):
+        factors[sensor_model] = [{'starttime': start_time - timedelta(days=365), 'endtime': end_time + timedelta(days=365),
+                                  'slope': slope, 'humidslope': -0.0862, 'intercept': 5.75, 'note': f'{sensor_model} correction'}]
+    return factors
+
+
+# stand-in for the area elevation grid: a smooth surface on a grid that covers the readings
+def makeElevationInterpolator():
+    lons, lats = np.linspace(-112.2, -111.6, 600), np.linspace(40.4, 40.9, 500)
+    elevations = 1300. + 200.*np.sin(lons*40.)[np.newaxis, :]**2 + 100.*np.cos(lats*30.)[:, np.newaxis]
+    return elevation.AreaElevation(lons, lats, elevations.astype(np.float32))
+
+
+# readings in the form returned by request_model_data_local
+def makeQueryResult(num_sensors, num_hours, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {'id': [], 'time': [], 'pm2_5': [], 'lat': [], 'lon': [], 'humidity': [], 'sensormodel': [], 'sensorsource': []}
+    for sensor in range(num_sensors):
+        lat, lon = rng.uniform(40.55, 40.80), rng.uniform(-112.05, -111.75)
+        sensor_model = SENSOR_MODELS[int(rng.integers(len(SENSOR_MODELS)))]
+        num_readings = int(rng.integers(1, 30*num_hours))
+        minutes = np.sort(rng.uniform(0., 60.*num_hours, num_readings))
+        columns['id'] += [f'S{sensor:04d}']*num_readings
+        columns['time'] += [pd.Timestamp(START_TIME + timedelta(minutes=float(minute))) for minute in minutes]
+        columns['pm2_5'] += list(np.round(rng.gamma(2., 6., num_readings), 1))
+        columns['lat'] += [lat]*num_readings
+        columns['lon'] += [lon]*num_readings
+        # some sources don't report humidity
+        columns['humidity'] += list(rng.uniform(10., 60., num_readings)) if rng.uniform() < 0.8 else [np.nan]*num_readings
+        columns['sensormodel'] += [sensor_model]*num_readings
+        columns['sensorsource'] += [SENSOR_SOURCES[sensor_model]]*num_readings
+    return pd.DataFrame(columns)
+
+
+def loadQueryResult(filename):
+    df = pd.read_parquet(filename) if filename.endswith('.parquet') else pd.read_csv(filename)
+    df['time'] = pd.to_datetime(df['time'], utc=True)
+    return df
+
+
+# reference: the removeInvalidSensors that worked on the list of dictionaries
+def perDatumRemoveInvalidSensors(sensor_data):
+    epoch = datetime(1970, 1, 1)
+    epoch = pytz.timezone('UTC').localize(epoch)
+    dayCounts = {}
+    dayReadings = {}
+    for datum in sensor_data:
+        pm25 = datum['PM2_5']
+        datum['daysSinceEpoch'] = (datum['time'] - epoch).days
+        key = (datum['daysSinceEpoch'], datum['ID'])
+        if key in dayReadings:
+            dayReadings[key] += pm25
+            dayCounts[key] += 1
+        else:
+            dayReadings[key] = pm25
+            dayCounts[key] = 1
+    for key in dayReadings:
+        dayReadings[key] = dayReadings[key] / dayCounts[key]
+
+    keysToRemoveSet = set()
+    for key in [key for key in dayReadings if dayReadings[key] > 350]:
+        keysToRemoveSet.add(key)
+        keysToRemoveSet.add((key[0] + 1, key[1]))
+        keysToRemoveSet.add((key[0] - 1, key[1]))
+    sensor_data = [datum for datum in sensor_data if (datum['daysSinceEpoch'], datum['ID']) not in keysToRemoveSet]
+
+    sensor5003Locations = {datum['ID']: (datum['utm_x'], datum['utm_y']) for datum in sensor_data if datum['SensorModel'] == '5003'}
+    sensorMatches = {}
+    for sensor in sensor5003Locations:
+        for match in sensor5003Locations:
+            if sensor5003Locations[sensor] == sensor5003Locations[match] and sensor != match:
+                sensorMatches[sensor] = match
+                sensorMatches[match] = sensor
+
+    keysToRemoveSet = set()
+    for key in dayReadings:
+        if key[1] in sensorMatches:
+            reading1 = dayReadings[key]
+            key2 = (key[0], sensorMatches[key[1]])
+            if key2 in dayReadings:
+                reading2 = dayReadings[key2]
+                if min(reading1, reading2) > 5 and abs(reading1 - reading2) / max(reading1, reading2) > 0.16:
+                    for this_key in (key, key2):
+                        keysToRemoveSet.add(this_key)
+                        keysToRemoveSet.add((this_key[0] + 1, this_key[1]))
+                        keysToRemoveSet.add((this_key[0] - 1, this_key[1]))
+    return [datum for datum in sensor_data if (datum['daysSinceEpoch'], datum['ID']) not in keysToRemoveSet]
+
+
+# reference: the query results -> list of dictionaries steps of the previous loadModelSensorData
+def perDatumSensorData(df, area_model, elevation_interpolator):
+    df = df.copy()
+    if pd.notnull(df["humidity"]).any():
+        mean_humidity = df["humidity"].mean()
+    else:
+        mean_humidity = area_model["defaulthumidity"]
+    df["humidity"] = df["humidity"].fillna(mean_humidity)
+
+    sensor_data = []
+    for _, row in df.iterrows():
+        sensor_data.append({"ID": row["id"], "Latitude": row["lat"], "Longitude": row["lon"], "time": row["time"], "PM2_5": row["pm2_5"],
+                            "Humidity": row["humidity"], "SensorModel": row["sensormodel"], "SensorSource": row["sensorsource"]})
+    # all the readings in the zone of the first one, as prepareModelSensorData does (and the utm package does for arrays)
+    zone_num, zone_let = utils.latlonToUTM(sensor_data[0]['Latitude'], sensor_data[0]['Longitude'])[2:]
+    for datum in sensor_data:
+        datum['utm_x'], datum['utm_y'] = utils.utm.from_latlon(datum['Latitude'], datum['Longitude'], force_zone_number=zone_num, force_zone_letter=zone_let)[:2]
+
+    sensor_data = perDatumRemoveInvalidSensors(sensor_data)
+    for datum in sensor_data:
+        datum['PM2_5'] = jsonutils.applyCorrectionFactor(area_model['pm2.5 correction factors'], datum['time'], datum['PM2_5'], datum["Humidity"], datum['SensorModel'])
+    for datum in sensor_data:
+        datum['Altitude'] = elevation_interpolator([datum['Longitude']], [datum['Latitude']])[0]
+    return sensor_data
+
+
+def runEstimate(sensor_data, query_lats, query_lons, query_elevations, query_dates, time_lo_bound, time_hi_bound):
+    model, time_offset, model_status = gaussian_model_utils.createModel(
+        sensor_data, LATLON_LENGTH_SCALE, ELEVATION_LENGTH_SCALE, TIME_LENGTH_SCALE, time_lo_bound, time_hi_bound)
+    yPred, yVar, status = gaussian_model_utils.estimateUsingModel(model, query_lats, query_lons, query_elevations, query_dates, time_offset, compute_variance=False)
+    return yPred
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--data', help='recorded query result (csv or parquet); synthetic readings if not given')
+    parser.add_argument('--sensors', type=int, default=200, help='number of synthetic sensors')
+    parser.add_argument('--hours', type=int, default=6, help='hours of synthetic readings')
+    parser.add_argument('--locations', type=int, default=400, help='number of query locations')
+    parser.add_argument('--times', type=int, default=4, help='number of query times')
+    parser.add_argument('--repeats', type=int, default=3, help='runs of each pipeline, the best is reported')
+    args = parser.parse_args()
+
+    df = loadQueryResult(args.data) if args.data else makeQueryResult(args.sensors, args.hours)
+    time_lo_bound, time_hi_bound = df['time'].min(), df['time'].max()
+    area_model = {'defaulthumidity': 30., 'pm2.5 correction factors': makeCorrectionFactors(time_lo_bound, time_hi_bound)}
+    elevation_interpolator = makeElevationInterpolator()
+
+    side = int(np.ceil(np.sqrt(args.locations)))
+    query_lats, query_lons = [grid.flatten()[:args.locations] for grid in
+                              np.meshgrid(np.linspace(df['lat'].min(), df['lat'].max(), side), np.linspace(df['lon'].min(), df['lon'].max(), side))]
+    query_elevations = elevation_interpolator(query_lons, query_lats)
+    query_dates = [time_lo_bound + (time_hi_bound - time_lo_bound)*(i + 1)/(args.times + 1) for i in range(args.times)]
+
+    timings = {'per datum': [], 'columnar': []}
+    for i in range(args.repeats):
+        start = time.perf_counter()
+        sensor_data = perDatumSensorData(df, area_model, elevation_interpolator)
+        prepared = time.perf_counter()
+        expected = runEstimate(sensor_data, query_lats, query_lons, query_elevations, query_dates, time_lo_bound, time_hi_bound)
+        timings['per datum'].append((prepared - start, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        sensor_data, status = utils.prepareModelSensorData(df, area_model, elevation_interpolator)
+        prepared = time.perf_counter()
+        result = runEstimate(sensor_data, query_lats, query_lons, query_elevations, query_dates, time_lo_bound, time_hi_bound)
+        timings['columnar'].append((prepared - start, time.perf_counter() - start))
+
+    mean_diff = float(np.abs(expected - result).max())
+    print(f"{len(df)} readings from {df['id'].nunique()} sensors, {args.locations} locations x {args.times} times")
+    print(f"{'pipeline':>10} {'prepare s':>10} {'end to end s':>13}")
+    for name, runs in timings.items():
+        print(f"{name:>10} {min(run[0] for run in runs):>10.4f} {min(run[1] for run in runs):>13.4f}")
+    print(f"speedup (end to end): {min(run[1] for run in timings['per datum'])/min(run[1] for run in timings['columnar']):.1f}, max |dmean|: {mean_diff:.3e}")
+
+    if mean_diff > MEAN_TOLERANCE:
+        print(f"columnar and per-datum estimates differ by more than {MEAN_TOLERANCE}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
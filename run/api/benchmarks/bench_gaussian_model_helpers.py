@@ -0,0 +1,121 @@
+# Micro-benchmark of the broadcasted helpers in gaussian_model against the python-loop versions they replaced
+# (the loop versions are copied here so that the two can be compared side by side).
+#
+# usage (from run/api):
+#    python -m benchmarks.bench_gaussian_model_helpers
+#    python -m benchmarks.bench_gaussian_model_helpers --sizes 1000 20000 --bins 64 256
+import argparse
+import math
+import time
+import numpy as np
+import torch
+from scipy import fft as scipy_fft
+
+import common.gaussian_model as gaussian_model
+
+
+def loopDiagMultTorchLeft(diag_vector, matrix):
+    rows = diag_vector.shape[0]
+    cols = matrix.shape[1]
+    result = torch.zeros([rows,cols],dtype=torch.float64)
+    for i in range(rows):
+        result[i, :] = diag_vector[i]*matrix[i, :]
+    return result
+
+
+def loopGaussKernel(x):
+    return(math.exp(-(x**2/2.0)))
+
+
+def loopBuildKernelArray(size, kernel, bandwidth=1.0):
+    array = np.zeros(size)
+    if (size % 2) != 0:
+        for i in range((size-1)//2):
+            array[i] = kernel(float(i)/bandwidth)
+        for i in range((size+1)//2):
+            array[size-(i+1)] = kernel(float((i+1))/bandwidth)
+    else:
+        for i in range((size)//2):
+            array[i] = kernel(float(i)/bandwidth)
+        for i in range((size)//2):
+            array[size-(i+1)] = kernel(float((i+1))/bandwidth)
+    return(array)
+
+
+def loopCirculantMatrixInverse(vector):
+    v_fft = scipy_fft.fft(vector)
+    size = vector.shape[0]
+    array = np.zeros([size, size], dtype=np.complex128)
+    for i in range(size):
+        array[:,i] = np.exp(-2j * np.pi * i * np.arange(size)/size)
+    array *= 1./np.sqrt(size)
+    return(np.matmul(np.matmul(array, np.diagflat(1.0/v_fft)), (array.conjugate()).transpose()))
+
+
+def loopSymCirculantMatrixEigen(vector):
+    v_fft = np.real(scipy_fft.fft(vector))
+    size = vector.shape[0]
+    array = np.zeros([size, size])
+    for i in range(size):
+        this_vector = np.exp(-2j * np.pi * i * np.arange(size)/(size))
+        if i <= size//2:
+            array[:,i] = np.real(this_vector)
+        else:
+            array[:,i] = np.imag(this_vector)
+    if (size % 2) == 0:
+        array[:,size//2] *= np.sqrt(0.5)
+    array *= np.sqrt(2.)/np.sqrt(size)
+    array[:, 0] *= 1.0/np.sqrt(2.)
+    return(v_fft, array)
+
+
+def bestTime(function, *args, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(name, size, loop_time, new_time, difference):
+    print(f"{name:<26} {size:>8} {loop_time:>10.5f} {new_time:>10.5f} {loop_time/new_time:>9.1f} {difference:>12.3e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 5000, 10000, 20000], help='N*T sizes for the diagonal multiply and kernel array')
+    parser.add_argument('--columns', type=int, default=16, help='columns of the matrix in the diagonal multiply')
+    parser.add_argument('--bins', nargs='+', type=int, default=[60, 120, 240, 480], help='time bins (T) for the circulant decompositions')
+    args = parser.parse_args()
+
+    print(f"{'function':<26} {'size':>8} {'loop s':>10} {'new s':>10} {'speedup':>9} {'max |diff|':>12}")
+    for size in args.sizes:
+        diag_vector = torch.rand(size, dtype=torch.float64)
+        matrix = torch.rand(size, args.columns, dtype=torch.float64)
+        loop_time, loop_result = bestTime(loopDiagMultTorchLeft, diag_vector, matrix)
+        new_time, new_result = bestTime(gaussian_model.diagMultTorchLeft, diag_vector, matrix)
+        report('diagMultTorchLeft', size, loop_time, new_time, float((loop_result - new_result).abs().max()))
+
+    for size in args.sizes:
+        # even sizes -- the odd case was fixed, so it is not expected to match
+        size = 2*(size//2)
+        loop_time, loop_result = bestTime(loopBuildKernelArray, size, loopGaussKernel, 7.5)
+        new_time, new_result = bestTime(gaussian_model.buildKernelArray, size, gaussian_model.gaussKernel, 7.5)
+        report('buildKernelArray', size, loop_time, new_time, np.abs(loop_result - new_result).max())
+
+    for size in args.bins:
+        vector = gaussian_model.buildKernelArray(size, gaussian_model.gaussKernel, size/8.)
+        loop_time, loop_result = bestTime(loopSymCirculantMatrixEigen, vector)
+        new_time, new_result = bestTime(gaussian_model.symCirculantMatrixEigen, vector)
+        difference = max(np.abs(loop_result[0] - new_result[0]).max(), np.abs(loop_result[1] - new_result[1]).max())
+        report('symCirculantMatrixEigen', size, loop_time, new_time, difference)
+
+        loop_time, loop_result = bestTime(loopCirculantMatrixInverse, vector)
+        new_time, new_result = bestTime(gaussian_model.circulantMatrixInverse, vector)
+        report('circulantMatrixInverse', size, loop_time, new_time, np.abs(loop_result - new_result).max()/np.abs(loop_result).max())
+
+
+if __name__ == '__main__':
+    main()
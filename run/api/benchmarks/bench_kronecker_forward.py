@@ -0,0 +1,58 @@
+# Compares the dense (kronecker products built explicitly) and factored versions of the gaussian model on synthetic data
+# Reports the time for update() + forward() and the largest differences in the predicted means and variances.
+#
+# usage (from run/api):
+#    python -m benchmarks.bench_kronecker_forward
+#    python -m benchmarks.bench_kronecker_forward --sizes 100x40 300x60 --locations 400 --times 12
+import argparse
+import time
+import torch
+
+import common.gaussian_model as gaussian_model
+from benchmarks import synthetic
+
+
+def buildModel(space_coordinates, time_coordinates, data, kronecker_factored, time_structured=False):
+    return gaussian_model.gaussian_model(torch.tensor(space_coordinates), torch.tensor(time_coordinates), torch.tensor(data),
+                                         latlon_length_scale=synthetic.LATLON_LENGTH_SCALE,
+                                         elevation_length_scale=synthetic.ELEVATION_LENGTH_SCALE,
+                                         time_length_scale=synthetic.TIME_LENGTH_SCALE,
+                                         noise_variance=synthetic.NOISE_VARIANCE, signal_variance=synthetic.SIGNAL_VARIANCE,
+                                         time_structured=time_structured, kronecker_factored=kronecker_factored)
+
+
+def timeModel(space_coordinates, time_coordinates, data, query_space, query_time, kronecker_factored):
+    start = time.perf_counter()
+    model = buildModel(space_coordinates, time_coordinates, data, kronecker_factored)
+    yPred, yVar, status = model(query_space, query_time)
+    return time.perf_counter() - start, yPred, yVar
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', default=['25x20', '50x30', '100x30'], help='sensors x time bins')
+    parser.add_argument('--locations', type=int, default=100, help='number of query locations')
+    parser.add_argument('--times', type=int, default=6, help='number of query times')
+    parser.add_argument('--factored-only', action='store_true', help='skip the dense version (for sizes that do not fit in memory)')
+    args = parser.parse_args()
+
+    print(f"{'sensors':>8} {'bins':>6} {'dense MB':>10} {'dense s':>9} {'factored s':>11} {'speedup':>8} {'max |dmean|':>12} {'max |dvar|':>12}")
+    for size in args.sizes:
+        num_sensors, num_times = [int(v) for v in size.split('x')]
+        space_coordinates, time_coordinates, data = synthetic.makeSensorField(num_sensors, num_times)
+        query_space, query_time = synthetic.makeQuery(args.locations, args.times, time_coordinates)
+        # the kronecker eigen vector matrix (and the sigma inverse of the same size)
+        dense_megabytes = 8.*(num_sensors*num_times)**2/1.e6
+
+        factored_time, factored_pred, factored_var = timeModel(space_coordinates, time_coordinates, data, query_space, query_time, True)
+        if args.factored_only:
+            print(f"{num_sensors:>8} {num_times:>6} {dense_megabytes:>10.1f} {'-':>9} {factored_time:>11.4f} {'-':>8} {'-':>12} {'-':>12}")
+            continue
+        dense_time, dense_pred, dense_var = timeModel(space_coordinates, time_coordinates, data, query_space, query_time, False)
+        mean_diff = float((dense_pred - factored_pred).abs().max())
+        var_diff = float((dense_var - factored_var).abs().max())
+        print(f"{num_sensors:>8} {num_times:>6} {dense_megabytes:>10.1f} {dense_time:>9.4f} {factored_time:>11.4f} {dense_time/factored_time:>8.1f} {mean_diff:>12.3e} {var_diff:>12.3e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+# Load test of /streamLiveSensors through HTTP, served the way the Dockerfile serves the API: main.py's app in gunicorn, one worker with
+# --threads threads (the API_REQUEST_SLOTS of the rest of the API plus the streams).  The live snapshot of the server (a child process) has
+# synthetic readings (several areas, sources and sensor models, a reading every couple of minutes per sensor, a few outliers), refreshed on
+# simulated time, LIVE_REFRESH_SECONDS apart.  This is the limit of one instance; benchmarks/bench_live_stream_fanout.py tests the fan-out of
+# a snapshot to thousands of subscribers.
+# The bench opens as many streams as the worker takes (--streams, LIVE_STREAM_MAX_SUBSCRIBERS), each with one of the subscriptions (areas,
+# source, correction, flags, format), and checks that:
+#   - the streams past the limit get 503 with Retry-After,
+#   - getLiveSensors still answers, on the threads left over, while the streams are open,
+#   - after the refreshes every stream has the sensors that getLiveSensors returns for its subscription,
+#   - the streams' slots are free again after the clients go away, also clients that go away before reading the response.
+# Reports the refresh and fan-out times, what serializing the changes for every stream separately would take instead, and the delay from
+# the start of a refresh to each stream having its message.  Exits with an error if any check fails.
+# The request log and the region info (BigQuery and firestore) are left out of the server, so it runs without credentials.
+#
+# usage (from run/api):
+#    python -m benchmarks.bench_live_stream
+#    python -m benchmarks.bench_live_stream --threads 40 --streams 32 --sensors 10000 --refreshes 20
+import argparse
+import http.client
+import itertools
+import json
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import numpy as np
+import pandas as pd
+import gunicorn.app.base
+
+import common.live_snapshot as live_snapshot
+import common.live_stream as live_stream
+
+CORRECTION_FACTORS = {
+    'PMS3003': [{'starttime': 'default', 'slope': 0.7, 'humidslope': -0.05, 'intercept': 1.0, 'note': '3003'}],
+    'default': [{'starttime': 'default', 'slope': 0.9, 'humidslope': 0.0, 'intercept': 0.0, 'note': 'default'}]}
+AREA_MODELS = {
+    'slc_ut': {'name': 'slc_ut', 'defaulthumidity': 30., 'boundingbox': [[0, 40.5, -112.1], [1, 40.9, -111.7]], 'pm2.5 correction factors': CORRECTION_FACTORS},
+    'clev_oh': {'name': 'clev_oh', 'defaulthumidity': 50., 'boundingbox': [[0, 41.3, -81.9], [1, 41.6, -81.5]], 'pm2.5 correction factors': CORRECTION_FACTORS},
+    'kc_mo': {'name': 'kc_mo', 'defaulthumidity': 45., 'boundingbox': [[0, 38.9, -94.7], [1, 39.2, -94.4]], 'pm2.5 correction factors': CORRECTION_FACTORS,
+              'sourcetablemap': {'PurpleAir': ['kc_mo']}}}
+SOURCES = ['AQ&U', 'PurpleAir', 'Tetrad']
+MODELS = ['PMS3003', 'PMS5003', 'SPS30']
+AREA_CHOICES = [['slc_ut'], ['clev_oh', 'kc_mo'], list(AREA_MODELS.keys())]
+SUBSCRIPTIONS = list(itertools.product(range(len(AREA_CHOICES)), ['all', 'PurpleAir', 'AQ&U'], [True, False], [True, False], ['sse', 'ndjson']))
+# keep-alives of the streams in the server, so the streams of clients that went away are noticed quickly
+KEEPALIVE_SECONDS = 2.
+
+
+# readings of all sensors from an hour before start_time to end_time, with the columns of fetchLiveReadings
+def makeReadings(num_sensors, start_time, end_time, seed=0):
+    rng = np.random.default_rng(seed)
+    areas = list(AREA_MODELS.keys())
+    frames = []
+    for sensor in range(num_sensors):
+        area = AREA_MODELS[areas[sensor % len(areas)]]
+        bbox = np.array(area['boundingbox'])[:, 1:3]
+        period = rng.uniform(60., 300.)
+        seconds = np.arange(rng.uniform(0., period) - 3600., (end_time - start_time).total_seconds(), period)
+        seconds = np.floor(seconds + rng.uniform(0., 20., seconds.shape[0]))
+        frames.append(pd.DataFrame({
+            'id': f'S{sensor:05d}', 'time': start_time + pd.to_timedelta(seconds, unit='s'),
+            'pm2_5': np.where(rng.uniform(size=seconds.shape[0]) < 0.005, 400., np.round(rng.gamma(2., 6., seconds.shape[0]), 1)),
+            'lat': rng.uniform(bbox[:, 0].min(), bbox[:, 0].max()), 'lon': rng.uniform(bbox[:, 1].min(), bbox[:, 1].max()),
+            'humidity': np.where(rng.uniform(size=seconds.shape[0]) < 0.1, np.nan, rng.uniform(10., 60., seconds.shape[0])),
+            'sensormodel': MODELS[sensor % 3], 'sensorsource': SOURCES[(sensor // 3) % 3], 'areamodel': area['name']}))
+    return pd.concat(frames, ignore_index=True).sort_values('time', kind='mergesort').reset_index(drop=True)
+
+
+# the query string of subscription number (with format for the stream)
+def subscriptionQuery(number, with_format=True):
+    areas, sensor_source, apply_correction, flag_outliers, stream_format = SUBSCRIPTIONS[number % len(SUBSCRIPTIONS)]
+    params = {'areaModel': ",".join(AREA_CHOICES[areas]), 'sensorSource': sensor_source}
+    if not apply_correction:
+        params['noCorrection'] = 1
+    if flag_outliers:
+        params['flagOutliers'] = 1
+    if with_format:
+        params['format'] = stream_format
+    return urllib.parse.urlencode(params)
+
+
+# the app of the worker (main.py's) on a snapshot of the readings, and a thread that refreshes the snapshot once all of the streams are open
+# and puts the times of each refresh in reports
+def makeApp(args, reports):
+    import common.db_utils
+    import common.jsonutils
+    common.db_utils.RequestAPI_DB_ACCESS.recordServiceRequest = lambda *args, **kwargs: None
+    common.jsonutils.get_all_region_info = lambda: AREA_MODELS
+    import main
+
+    refresh_seconds = live_snapshot.LIVE_REFRESH_SECONDS
+    # the last refresh is at about the present, as both endpoints keep the sensors of the last hour by the wall clock
+    end_time = pd.Timestamp.now(tz='UTC').floor('s')
+    start_time = end_time - pd.Timedelta(seconds=refresh_seconds*args.refreshes)
+    readings = makeReadings(args.sensors, start_time, end_time)
+    clock = {'now': start_time}
+
+    # what the telemetry table would have at the simulated time
+    def fetch(since, window_start):
+        times = readings['time']
+        return readings[(times > since) & (times >= window_start) & (times <= clock['now'])]
+
+    snapshot = live_snapshot.LiveSnapshot(fetch, refresh_seconds, get_area_models=lambda: AREA_MODELS)
+    snapshot.refresh(clock['now'])
+    stream = live_stream.LiveStream(snapshot, stream_seconds=3600., keepalive_seconds=KEEPALIVE_SECONDS, max_subscribers=args.streams)
+    live_snapshot.getLiveSnapshot.snapshot = snapshot
+    live_stream.getLiveStream.stream = stream
+
+    def refreshes():
+        while stream.stats()["subscribers"] < args.streams:
+            time.sleep(0.01)
+        # let the first messages go out
+        time.sleep(1.)
+        for refresh in range(args.refreshes):
+            clock['now'] = clock['now'] + pd.Timedelta(seconds=refresh_seconds)
+            previous_version = snapshot.state["version"]
+            publish_seconds = stream.publish_seconds_total
+            started = time.time()
+            snapshot.refresh(clock['now'])
+            refresh_time = time.time() - started
+            publish_time = stream.publish_seconds_total - publish_seconds
+
+            # the same messages serialized for every stream on its own (what the shared fan-out saves)
+            begin = time.perf_counter()
+            with stream.lock:
+                keys = [subscriber.key for subscribers in stream.subscribers.values() for subscriber in subscribers]
+            for areas, sensor_source, apply_correction, flag_outliers, stream_format in keys:
+                version, records = snapshot.sensors(list(areas), sensor_source, apply_correction, flag_outliers, since=previous_version)
+                live_stream.encodeMessage(stream_format, version, records)
+            separate_time = time.perf_counter() - begin
+
+            changed = int((snapshot.state["changed"] == snapshot.state["version"]).sum())
+            reports.put(("refresh", (refresh, snapshot.state["version"], started, changed, refresh_time - publish_time, publish_time, separate_time)))
+            time.sleep(args.interval)
+        reports.put(("done", stream.stats()))
+
+    threading.Thread(target=refreshes, daemon=True).start()
+
+    return main.app
+
+
+class BenchServer(gunicorn.app.base.BaseApplication):
+    def __init__(self, args, reports):
+        self.args = args
+        self.reports = reports
+        super().__init__()
+
+    # the options of the Dockerfile's command
+    def load_config(self):
+        self.cfg.set('bind', f'127.0.0.1:{self.args.port}')
+        self.cfg.set('workers', 1)
+        self.cfg.set('threads', self.args.threads)
+        self.cfg.set('timeout', 0)
+        self.cfg.set('graceful_timeout', 1)
+        self.cfg.set('loglevel', 'warning')
+
+    # (in the worker)
+    def load(self):
+        return makeApp(self.args, self.reports)
+
+
+def serve(args, reports):
+    BenchServer(args, reports).run()
+
+
+# (with an empty JSON body: the request parsers also read the body, which newer versions of Flask refuse unless it is JSON)
+def get(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    connection.request('GET', path, body="{}", headers={'Host': 'localhost', 'Content-Type': 'application/json'})
+    return connection, connection.getresponse()
+
+
+# a stream client: opens the stream and keeps the version and time of each message until done is set
+def streamClient(port, number, done, results, lock):
+    connection, response = get(port, f"/streamLiveSensors?{subscriptionQuery(number)}")
+    received = []
+    with lock:
+        results[number] = (response.status, received)
+    stream_format = SUBSCRIPTIONS[number % len(SUBSCRIPTIONS)][4]
+    lines = []
+    while (response.status == 200) and not done.is_set():
+        line = response.readline()
+        if line == b"":
+            break
+        line = line.decode().rstrip("\n")
+        # an SSE event ends with an empty line (a keep-alive is a comment), and an NDJSON message is one line (a keep-alive is empty)
+        if stream_format == "sse":
+            if line != "":
+                lines.append(line)
+                continue
+            message, lines = "\n".join(lines), []
+            if message.startswith(":") or (message == ""):
+                continue
+        elif line == "":
+            continue
+        else:
+            message = line
+        # parsed after the run, so the clients don't slow down the server
+        received.append((time.time(), message))
+    connection.close()
+
+
+# version and records of a message
+def parseMessage(stream_format, message):
+    if stream_format == "sse":
+        lines = message.split("\n")
+        return int(lines[0][len("id: "):]), json.loads(lines[2][len("data: "):])
+    payload = json.loads(message)
+    return payload["version"], payload["sensors"]
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=40, help='gunicorn threads of the worker (--threads in the Dockerfile)')
+    parser.add_argument('--streams', type=int, default=live_stream.LIVE_STREAM_MAX_SUBSCRIBERS, help='streams the worker takes (LIVE_STREAM_MAX_SUBSCRIBERS)')
+    parser.add_argument('--extra', type=int, default=4, help='streams opened past the limit')
+    parser.add_argument('--polls', type=int, default=20, help='getLiveSensors requests while the streams are open')
+    parser.add_argument('--sensors', type=int, default=3000, help='number of sensors')
+    parser.add_argument('--refreshes', type=int, default=10, help='number of refreshes after the first')
+    parser.add_argument('--interval', type=float, default=1., help='seconds between the refreshes')
+    args = parser.parse_args()
+    args.port = freePort()
+
+    reports = multiprocessing.get_context("fork").Queue()
+    server = multiprocessing.get_context("fork").Process(target=serve, args=(args, reports), daemon=True)
+    server.start()
+    failures = []
+    try:
+        deadline = time.monotonic() + 120.
+        while True:
+            try:
+                connection, response = get(args.port, "/getLiveSensors")
+                response.read()
+                connection.close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+
+        done = threading.Event()
+        lock = threading.Lock()
+        results = {}
+        threads = [threading.Thread(target=streamClient, args=(args.port, number, done, results, lock), daemon=True) for number in range(args.streams)]
+        for thread in threads:
+            thread.start()
+        while len(results) < args.streams:
+            time.sleep(0.01)
+        refused = [number for number, (status, received) in results.items() if status != 200]
+        if len(refused) > 0:
+            failures.append(f"{len(refused)} of {args.streams} streams refused")
+
+        # past the limit
+        extra_statuses = []
+        for number in range(args.extra):
+            connection, response = get(args.port, f"/streamLiveSensors?{subscriptionQuery(number)}")
+            extra_statuses.append((response.status, response.getheader('Retry-After')))
+            connection.close()
+        if any((status != 503) or (retry_after is None) for status, retry_after in extra_statuses):
+            failures.append(f"streams past the limit got {extra_statuses}")
+
+        # the rest of the API, on the threads that are left
+        poll_times = []
+        for number in range(args.polls):
+            begin = time.perf_counter()
+            connection, response = get(args.port, f"/getLiveSensors?{subscriptionQuery(number, False)}")
+            response.read()
+            connection.close()
+            poll_times.append(time.perf_counter() - begin)
+            if response.status != 200:
+                failures.append(f"getLiveSensors answered {response.status} while the streams were open")
+                break
+
+        print(f"{args.sensors} sensors, {args.streams} streams on {len(set(number % len(SUBSCRIPTIONS) for number in range(args.streams)))} subscriptions, gunicorn 1 worker {args.threads} threads")
+        print(f"{args.extra} streams past the limit: {sorted(set(extra_statuses))}")
+        print(f"getLiveSensors while the streams are open: median {np.median(poll_times)*1000:.1f}ms, max {max(poll_times)*1000:.1f}ms ({len(poll_times)} requests)")
+        print(f"{'refresh':>8} {'version':>14} {'changed':>8} {'refresh s':>10} {'fan-out s':>10} {'separately s':>13}")
+        refresh_started = {}
+        while True:
+            kind, report = reports.get(timeout=600.)
+            if kind == "done":
+                server_stats = report
+                break
+            refresh, version, started, changed, refresh_time, publish_time, separate_time = report
+            refresh_started[version] = started
+            print(f"{refresh:>8} {version:>14} {changed:>8} {refresh_time:>10.4f} {publish_time:>10.4f} {separate_time:>13.4f}")
+        print(server_stats)
+
+        # the last messages
+        time.sleep(1.)
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        # every stream has what getLiveSensors returns for its subscription
+        mismatched = 0
+        delays = []
+        for number, (status, received) in results.items():
+            stream_format = SUBSCRIPTIONS[number % len(SUBSCRIPTIONS)][4]
+            sensors = {}
+            for received_time, message in received:
+                version, records = parseMessage(stream_format, message)
+                if version in refresh_started:
+                    delays.append(received_time - refresh_started[version])
+                for record in records:
+                    sensors[record["Sensor ID"]] = record
+            connection, response = get(args.port, f"/getLiveSensors?{subscriptionQuery(number, False)}")
+            expected = {record["Sensor ID"]: record for record in json.loads(response.read())}
+            connection.close()
+            if (len(expected) == 0) or any(sensors.get(sensor_id) != record for sensor_id, record in expected.items()):
+                mismatched += 1
+        if mismatched > 0:
+            failures.append(f"{mismatched} streams don't have the sensors of getLiveSensors")
+        delays = np.array(delays)
+        if delays.shape[0] > 0:
+            print(f"delivery after the start of a refresh: median {np.median(delays)*1000:.1f}ms, 99% {np.percentile(delays, 99)*1000:.1f}ms, max {delays.max()*1000:.1f}ms ({delays.shape[0]} messages)")
+
+        # clients that go away without reading the response, then the slots must all be free again
+        for number in range(args.streams):
+            connection = socket.create_connection(('127.0.0.1', args.port))
+            connection.sendall(f"GET /streamLiveSensors?{subscriptionQuery(number)} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{{}}".encode())
+            connection.close()
+        time.sleep(3*KEEPALIVE_SECONDS)
+        reopened = []
+        for number in range(args.streams):
+            connection, response = get(args.port, f"/streamLiveSensors?{subscriptionQuery(number)}")
+            reopened.append((connection, response.status))
+        for connection, status in reopened:
+            connection.close()
+        if any(status != 200 for connection, status in reopened):
+            failures.append(f"{sum(status != 200 for connection, status in reopened)} of {args.streams} slots still taken after the clients went away")
+        else:
+            print(f"all {args.streams} slots free again after the clients went away")
+    finally:
+        server.terminate()
+        server.join()
+
+    if len(failures) > 0:
+        print("\n".join(failures))
+        sys.exit(1)
+    print("all checks passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Load test of the fan-out of the live sensor stream (common.live_stream): thousands of simulated subscribers on one snapshot, fed by one
+# refresh loop, in process (LiveStream.publish and LiveStream.messages, without HTTP).  One instance serves LIVE_STREAM_MAX_SUBSCRIBERS streams
+# (benchmarks/bench_live_stream.py tests that through the endpoint), so this is the load of many instances' worth of streams on one snapshot:
+# the fan-out is per subscription, so its cost shouldn't grow with the subscribers.
+# The readings are the synthetic ones of bench_live_stream and the refreshes run on simulated time, LIVE_REFRESH_SECONDS apart.  Each subscriber is a thread reading its stream (LiveStream.messages, as
+# streamLiveSensors sends it) with one of the subscriptions (areas, source, correction, flags, format), and keeps the sensors it was sent.
+# Reports the refresh and fan-out times, what serializing the changes for every subscriber separately would take instead, and the delay
+# from the start of a refresh to each subscriber having its message.  Exits with an error if, after the last refresh, any subscriber's
+# sensors differ from the snapshot's.
+#
+# usage (from run/api):
+#    python -m benchmarks.bench_live_stream_fanout
+#    python -m benchmarks.bench_live_stream_fanout --subscribers 5000 --sensors 10000 --refreshes 20
+import argparse
+import json
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+import common.live_snapshot as live_snapshot
+import common.live_stream as live_stream
+from benchmarks.bench_live_stream import AREA_MODELS, AREA_CHOICES, SUBSCRIPTIONS, makeReadings
+
+# subscribers timed for the serialized-separately column
+SEPARATE_SAMPLE = 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subscribers', type=int, default=2000, help='number of simulated subscribers')
+    parser.add_argument('--sensors', type=int, default=3000, help='number of sensors')
+    parser.add_argument('--refreshes', type=int, default=10, help='number of refreshes after the first')
+    args = parser.parse_args()
+
+    # the last refresh is at the present, as the streams keep the sensors of the last hour by the wall clock
+    refresh_seconds = live_snapshot.LIVE_REFRESH_SECONDS
+    end_time = pd.Timestamp.now(tz='UTC').floor('s')
+    start_time = end_time - pd.Timedelta(seconds=refresh_seconds*args.refreshes)
+    readings = makeReadings(args.sensors, start_time, end_time)
+    clock = {'now': start_time}
+
+    # what the telemetry table would have at the simulated time
+    def fetch(since, window_start):
+        times = readings['time']
+        return readings[(times > since) & (times >= window_start) & (times <= clock['now'])]
+
+    snapshot = live_snapshot.LiveSnapshot(fetch, refresh_seconds, get_area_models=lambda: AREA_MODELS)
+    begin = time.perf_counter()
+    snapshot.refresh(clock['now'])
+    first_refresh = time.perf_counter() - begin
+    stream = live_stream.LiveStream(snapshot, stream_seconds=3600., keepalive_seconds=5., queue_size=args.refreshes + 2, max_subscribers=args.subscribers)
+
+    done = threading.Event()
+    refresh_started = {}
+    results = []
+    lock = threading.Lock()
+
+    def subscriber(number):
+        areas, sensor_source, apply_correction, flag_outliers, stream_format = SUBSCRIPTIONS[number % len(SUBSCRIPTIONS)]
+        sub = stream.subscribe(AREA_CHOICES[areas], sensor_source, apply_correction, flag_outliers, stream_format)
+        # the messages are read after the run, so the subscribers' JSON parsing doesn't slow down the refreshes
+        received = []
+        for message in stream.messages(sub):
+            if done.is_set():
+                break
+            if message.strip() != "" and not message.startswith(":"):
+                received.append((time.perf_counter(), message))
+        with lock:
+            results.append((sub, received))
+
+    threads = [threading.Thread(target=subscriber, args=(number,), daemon=True) for number in range(args.subscribers)]
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while stream.stats()["subscribers"] < args.subscribers:
+        time.sleep(0.01)
+    subscribe_time = time.perf_counter() - begin
+    # let the first messages go out
+    time.sleep(1.)
+
+    print(f"{args.sensors} sensors, {len(readings)} readings, {args.subscribers} subscribers on {len(SUBSCRIPTIONS)} subscriptions")
+    print(f"first refresh {first_refresh:.3f}s, {args.subscribers} subscribed in {subscribe_time:.3f}s")
+    print(f"{'refresh':>8} {'version':>14} {'changed':>8} {'refresh s':>10} {'fan-out s':>10} {'separately s':>13}")
+    for refresh in range(args.refreshes):
+        clock['now'] = clock['now'] + pd.Timedelta(seconds=refresh_seconds)
+        stats = stream.stats()
+        previous_version = snapshot.state["version"]
+        started = time.perf_counter()
+        # keyed by the version the refresh will have (the versions are the refresh times in milliseconds)
+        refresh_started[max(previous_version + 1, int(clock['now'].timestamp()*1000))] = started
+        snapshot.refresh(clock['now'])
+        refresh_time = time.perf_counter() - started
+        publish_time = stream.publish_seconds_total - (stats["mean publish seconds"] or 0.)*stats["published versions"]
+
+        # the same messages serialized for every subscriber on its own (what the shared fan-out saves), timed on a sample
+        sample = min(args.subscribers, SEPARATE_SAMPLE)
+        begin = time.perf_counter()
+        for number in range(sample):
+            areas, sensor_source, apply_correction, flag_outliers, stream_format = SUBSCRIPTIONS[number % len(SUBSCRIPTIONS)]
+            version, records = snapshot.sensors(AREA_CHOICES[areas], sensor_source, apply_correction, flag_outliers, since=previous_version)
+            live_stream.encodeMessage(stream_format, version, records)
+        separate_time = (time.perf_counter() - begin)*args.subscribers/sample
+        changed = int((snapshot.state["changed"] == snapshot.state["version"]).sum())
+        print(f"{refresh:>8} {snapshot.state['version']:>14} {changed:>8} {refresh_time - publish_time:>10.4f} {publish_time:>10.4f} {separate_time:>13.4f}")
+        time.sleep(0.5)
+
+    time.sleep(1.)
+    done.set()
+    for thread in threads:
+        thread.join()
+
+    print(stream.stats())
+
+    # every subscriber has the snapshot's records of its sensors
+    failed = 0
+    delays = []
+    for sub, received in results:
+        areas, sensor_source, apply_correction, flag_outliers, stream_format = sub.key
+        sensors = {}
+        for received_time, message in received:
+            if stream_format == "sse":
+                version = int(message.split("\n")[0][len("id: "):])
+                records = json.loads(message.split("\ndata: ", 1)[1])
+            else:
+                payload = json.loads(message)
+                version, records = payload["version"], payload["sensors"]
+            if version in refresh_started:
+                delays.append(received_time - refresh_started[version])
+            for record in records:
+                sensors[record["Sensor ID"]] = record
+        version, records = snapshot.sensors(list(areas), sensor_source, apply_correction, flag_outliers)
+        expected = {record["Sensor ID"]: record for record in json.loads(live_stream.encodeRecords(records))}
+        if sub.closed or (len(expected) == 0) or any(sensors.get(sensor_id) != record for sensor_id, record in expected.items()):
+            failed += 1
+
+    delays = np.array(delays)
+    if delays.shape[0] > 0:
+        print(f"delivery after the start of a refresh: median {np.median(delays)*1000:.1f}ms, 99% {np.percentile(delays, 99)*1000:.1f}ms, max {delays.max()*1000:.1f}ms ({delays.shape[0]} messages)")
+    if failed > 0:
+        print(f"{failed} subscribers don't have the snapshot's sensors")
+        sys.exit(1)
+    print("all subscribers have the snapshot's sensors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Time of forward() with and without the predictive variance (variance=false in the estimate endpoints), for each version of the model
+# The models are fit once; only forward() is timed, since that is what a cached model or a big map spends its time on.
+#
+# usage (from run/api):
+#    python -m benchmarks.bench_mean_only
+#    python -m benchmarks.bench_mean_only --sensors 100 --bins 40 --locations 400 2500 --times 12
+import argparse
+import time
+
+from benchmarks import synthetic
+from benchmarks.bench_kronecker_forward import buildModel
+
+# (name, kronecker_factored, time_structured)
+MODEL_VERSIONS = [("factored", True, False), ("dense", False, False), ("dense fft", False, True)]
+
+
+def timeForward(model, query_space, query_time, compute_variance, repeats):
+    start = time.perf_counter()
+    for i in range(repeats):
+        yPred, yVar, status = model(query_space, query_time, compute_variance=compute_variance)
+    return (time.perf_counter() - start)/repeats, yPred
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sensors', type=int, default=50, help='number of sensors')
+    parser.add_argument('--bins', type=int, default=30, help='number of time bins')
+    parser.add_argument('--locations', type=int, nargs='+', default=[100, 400, 1600], help='numbers of query locations')
+    parser.add_argument('--times', type=int, default=6, help='number of query times')
+    parser.add_argument('--repeats', type=int, default=3, help='forward() calls averaged for each timing')
+    parser.add_argument('--factored-only', action='store_true', help='skip the dense versions (for sizes that do not fit in memory)')
+    args = parser.parse_args()
+
+    space_coordinates, time_coordinates, data = synthetic.makeSensorField(args.sensors, args.bins)
+    versions = MODEL_VERSIONS[:1] if args.factored_only else MODEL_VERSIONS
+    models = [(name, buildModel(space_coordinates, time_coordinates, data, factored, time_structured=structured)) for name, factored, structured in versions]
+
+    print(f"{'model':>10} {'locations':>10} {'with var s':>11} {'mean only s':>12} {'speedup':>8} {'max |dmean|':>12}")
+    for num_locations in args.locations:
+        query_space, query_time = synthetic.makeQuery(num_locations, args.times, time_coordinates)
+        for name, model in models:
+            full_time, full_pred = timeForward(model, query_space, query_time, True, args.repeats)
+            mean_time, mean_pred = timeForward(model, query_space, query_time, False, args.repeats)
+            mean_diff = float((full_pred - mean_pred).abs().max())
+            print(f"{name:>10} {num_locations:>10} {full_time:>11.4f} {mean_time:>12.4f} {full_time/mean_time:>8.1f} {mean_diff:>12.3e}")
+
+
+if __name__ == '__main__':
+    main()
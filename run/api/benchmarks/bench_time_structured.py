@@ -0,0 +1,66 @@
+# Compares the fft/circulant (time_structured) and dense time versions of the gaussian model on synthetic data
+# The queries are kept TIME_KERNEL_FACTOR_PADDING time length scales away from the ends of the sensor data (the padding that
+# computeEstimatesForLocations puts on each chunk), which is the case where createModel picks the circulant version.
+# Reports the time for update() + forward() for each chunk length and exits with an error if the two disagree by more than the tolerances.
+#
+# usage (from run/api):
+#    python -m benchmarks.bench_time_structured
+#    python -m benchmarks.bench_time_structured --sensors 100 --bins 40 80 160 320
+import argparse
+import sys
+import time
+import numpy as np
+import torch
+
+import common.utils as utils
+from benchmarks import synthetic
+from benchmarks.bench_kronecker_forward import buildModel
+
+# the circulant version wraps the first and last bins around, so a small difference is expected even with padding
+# mean in ug/m^3, variance relative to the signal variance
+MEAN_TOLERANCE = 0.5
+VARIANCE_TOLERANCE = 0.005
+
+
+def timeModel(space_coordinates, time_coordinates, data, query_space, query_time, time_structured):
+    start = time.perf_counter()
+    model = buildModel(space_coordinates, time_coordinates, data, True, time_structured=time_structured)
+    yPred, yVar, status = model(query_space, query_time)
+    return time.perf_counter() - start, yPred, yVar
+
+
+def paddedQueryTimes(time_coordinates, num_times):
+    padding = utils.TIME_KERNEL_FACTOR_PADDING*synthetic.TIME_LENGTH_SCALE
+    return torch.tensor(np.expand_dims(np.linspace(time_coordinates[0, 0] + padding, time_coordinates[-1, 0] - padding, num_times), axis=1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sensors', type=int, default=50, help='number of sensors')
+    parser.add_argument('--bins', type=int, nargs='+', default=[20, 40, 80, 160], help='time bins per chunk')
+    parser.add_argument('--locations', type=int, default=100, help='number of query locations')
+    parser.add_argument('--times', type=int, default=6, help='number of query times')
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'sensors':>8} {'bins':>6} {'dense s':>9} {'fft s':>9} {'speedup':>8} {'max |dmean|':>12} {'max |dvar|':>12}")
+    for num_times in args.bins:
+        space_coordinates, time_coordinates, data = synthetic.makeSensorField(args.sensors, num_times)
+        query_space, _ = synthetic.makeQuery(args.locations, args.times, time_coordinates)
+        query_time = paddedQueryTimes(time_coordinates, args.times)
+
+        dense_time, dense_pred, dense_var = timeModel(space_coordinates, time_coordinates, data, query_space, query_time, False)
+        fft_time, fft_pred, fft_var = timeModel(space_coordinates, time_coordinates, data, query_space, query_time, True)
+        mean_diff = float((dense_pred - fft_pred).abs().max())
+        var_diff = float((dense_var - fft_var).abs().max())
+        ok = (mean_diff < MEAN_TOLERANCE) and (var_diff < VARIANCE_TOLERANCE*synthetic.SIGNAL_VARIANCE)
+        failed = failed or not ok
+        print(f"{args.sensors:>8} {num_times:>6} {dense_time:>9.4f} {fft_time:>9.4f} {dense_time/fft_time:>8.1f} {mean_diff:>12.3e} {var_diff:>12.3e}" + ("" if ok else "  FAILED"))
+
+    if failed:
+        print(f"fft and dense time models differ by more than {MEAN_TOLERANCE} (mean) / {VARIANCE_TOLERANCE*synthetic.SIGNAL_VARIANCE} (variance)")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Checks that the getTimeAggregatedData query that numbers the intervals (rollups.bucketAggregationQuery) gives exactly the same rows as the
+# query that joined the readings with a table of intervals (kept below as the reference), and reports the time of each.  Both run on the
+# DuckDB backend over a synthetic local data set (written to a temporary directory) with the columns of db_table_headings.json.
+# The readings have fractional seconds (some in the last second of an interval, which the interval table left out), values over
+# MAX_ALLOWED_PM2_5, missing humidities, and several areas; the cases have aligned and unaligned starts, a range of intervals, the three
+# functions and the groupings getTimeAggregatedData uses.  Exits with an error if any case differs.
+#
+# usage (from run/api):
+#    python -m benchmarks.check_aggregation_query
+#    python -m benchmarks.check_aggregation_query --sensors 200 --days 7
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+import common.rollups as rollups
+import common.telemetry_backend as telemetry_backend
+import common.utils as utils
+
+START_TIME = pd.Timestamp('2021-09-13 00:00:00', tz='UTC')
+AREAS = ['slc_ut', 'clev_oh']
+SQL_FUNCTIONS = {"mean": "AVG", "min": "MIN", "max": "MAX"}
+GROUP_STRINGS = ["", ", ID", ", ID, sensormodel, areamodel", ", sensormodel, areamodel"]
+
+
+# telemetry table rows (the Parquet layout of the local backend: the BigQuery columns with Latitude/Longitude for GPS)
+def makeTelemetry(num_sensors, num_days, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for sensor in range(num_sensors):
+        num_readings = int(rng.integers(50, 500*num_days))
+        seconds = np.sort(rng.uniform(0., num_days*86400., num_readings))
+        # most sources report whole seconds
+        if sensor % 4 != 0:
+            seconds = np.floor(seconds)
+        frames.append(pd.DataFrame({
+            'Timestamp': START_TIME + pd.to_timedelta(seconds, unit='s'),
+            'DeviceID': f'S{sensor:04d}',
+            'Latitude': rng.uniform(40.5, 40.8), 'Longitude': rng.uniform(-112.0, -111.7),
+            'PM2_5': np.where(rng.uniform(size=num_readings) < 0.01, 2000., np.round(rng.gamma(2., 6., num_readings), 1)),
+            'Temperature': 20.,
+            'Humidity': np.where(rng.uniform(size=num_readings) < 0.1, np.nan, rng.uniform(10., 60., num_readings)),
+            'Source': ['AQ&U', 'PurpleAir', 'Tetrad'][sensor % 3],
+            'PMSModel': ['PMS3003', 'PMS5003', 'SPS30'][sensor % 3],
+            'Label': AREAS[sensor % len(AREAS)]}))
+    return pd.concat(frames, ignore_index=True)
+
+
+# the per-area queries of getTimeAggregatedData
+def makeTablesList(backend, db_table_headings, end_interval):
+    column_string = ", ".join([db_table_headings['id'] + " AS ID", db_table_headings['time'] + " AS time", db_table_headings['pm2_5'] + " AS pm2_5",
+                               db_table_headings['latitude'] + " AS lat", db_table_headings['longitude'] + " AS lon",
+                               db_table_headings['sensormodel'] + " AS sensormodel", db_table_headings['humidity'] + " AS humidity",
+                               db_table_headings['sensorsource'] + " AS sensorsource", db_table_headings['label'] + " AS areamodel"])
+    where_string = f"pm2_5 < {utils.MAX_ALLOWED_PM2_5} AND time >= @start AND time <= '{end_interval}'"
+    return [f"""(SELECT * FROM (SELECT {column_string} FROM {backend.table("telemetry.telemetry")}) WHERE ({where_string} AND areamodel = '{area}'))"""
+            for area in AREAS]
+
+
+# reference: the query with the table of intervals
+def intervalJoinQuery(backend, tables_list, sql_function, group_string):
+    return f"""
+            WITH
+                intervals AS (
+                    SELECT
+                        {backend.timestampAdd("@start", "@interval * num", "MINUTE")} AS lower,
+                        {backend.timestampAdd("@start", "@interval * 60* (1 + num) - 1", "SECOND")} AS upper
+                    FROM {backend.integerSeries(0, f'DIV({backend.timestampDiff("@end", "@start", "MINUTE")} , @interval)', "num")}
+                )
+            SELECT
+                CASE WHEN {sql_function}(pm2_5) IS NOT NULL
+                    THEN {sql_function}(pm2_5)
+                    ELSE 0
+                    END AS PM2_5,
+               AVG(humidity) AS HUMIDITY,
+                upper  {group_string}
+            FROM intervals
+                JOIN (
+                {' UNION ALL '.join(tables_list)}
+            ) sensors
+                ON sensors.time BETWEEN intervals.lower AND intervals.upper
+            GROUP BY upper {group_string}
+            ORDER BY upper"""
+
+
+def sameRows(expected, result, group_string):
+    columns = ["upper"] + [column.strip() for column in group_string.split(",") if column.strip()]
+    expected = expected.sort_values(columns, kind='mergesort').reset_index(drop=True)
+    result = result.sort_values(columns, kind='mergesort').reset_index(drop=True)
+    return (expected.shape == result.shape) and all(expected[column].equals(result[column]) for column in columns) and \
+        np.allclose(expected["PM2_5"].to_numpy(dtype=float), result["PM2_5"].to_numpy(dtype=float), rtol=1e-12, equal_nan=True) and \
+        np.allclose(expected["HUMIDITY"].to_numpy(dtype=float), result["HUMIDITY"].to_numpy(dtype=float), rtol=1e-12, equal_nan=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sensors', type=int, default=60, help='number of sensors')
+    parser.add_argument('--days', type=int, default=3, help='days of readings')
+    args = parser.parse_args()
+
+    with open('common/db_table_headings.json') as json_file:
+        db_table_headings = json.load(json_file)
+
+    with tempfile.TemporaryDirectory() as directory:
+        telemetry_directory = os.path.join(directory, 'telemetry', 'telemetry')
+        os.makedirs(telemetry_directory)
+        telemetry = makeTelemetry(args.sensors, args.days)
+        telemetry.to_parquet(os.path.join(telemetry_directory, 'telemetry.parquet'), index=False)
+        backend = telemetry_backend.DuckDBBackend(directory)
+
+        span = timedelta(days=args.days)
+        cases = [(START_TIME, START_TIME + span, 60), (START_TIME + timedelta(minutes=7, seconds=13), START_TIME + span - timedelta(hours=5), 60),
+                 (START_TIME + timedelta(hours=3), START_TIME + span, 15), (START_TIME, START_TIME + span, 1440),
+                 (START_TIME + timedelta(hours=1, seconds=30), START_TIME + timedelta(days=1), 7), (START_TIME, START_TIME + timedelta(hours=6), 1)]
+        failed = False
+        print(f"{'start':>26} {'interval':>9} {'function':>9} {'group by':>30} {'rows':>6} {'join s':>8} {'bucket s':>9} {'speedup':>8} {'same':>5}")
+        for start, end, interval in cases:
+            end_interval = (end + timedelta(minutes=interval)).strftime(utils.DATETIME_FORMAT)
+            tables_list = makeTablesList(backend, db_table_headings, end_interval)
+            parameters = [("start", "TIMESTAMP", start), ("end", "TIMESTAMP", end), ("interval", "INT64", interval)]
+            for function, sql_function in SQL_FUNCTIONS.items():
+                for group_string in GROUP_STRINGS:
+                    begin = time.perf_counter()
+                    expected = backend.query(intervalJoinQuery(backend, tables_list, sql_function, group_string), parameters)
+                    join_time = time.perf_counter() - begin
+                    begin = time.perf_counter()
+                    result = backend.query(rollups.bucketAggregationQuery(backend, tables_list, sql_function, group_string), parameters)
+                    bucket_time = time.perf_counter() - begin
+
+                    same = sameRows(expected, result, group_string)
+                    failed = failed or not same
+                    print(f"{str(start):>26} {interval:>9} {function:>9} {group_string.strip(', '):>30} {len(result):>6} {join_time:>8.4f} {bucket_time:>9.4f} {join_time/bucket_time:>8.1f} {str(same):>5}")
+
+    if failed:
+        print("interval join and bucket aggregation queries differ")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
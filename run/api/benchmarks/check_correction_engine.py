@@ -0,0 +1,70 @@
+# Checks that the compiled correction factors (jsonutils.CorrectionEngine) give the same values and notes as applyCorrectionFactor(..., status=True)
+# reading by reading, and reports the time of each.  The factor lists have overlapping periods (the first one in the list wins), "default" rows
+# in the middle of the list, sensor types with no factors of their own and readings with no sensor type (corrected by their source).
+# Exits with an error if any reading differs.
+#
+# usage (from run/api):
+#    python -m benchmarks.check_correction_engine
+#    python -m benchmarks.check_correction_engine --readings 200000
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytz
+
+import common.jsonutils as jsonutils
+
+
+def makeFactors():
+    def month(year, month):
+        return datetime(year, month, 1, 0, 0, 0, 0, pytz.timezone('UTC'))
+    return {
+        'PMS3003': [
+            {'starttime': month(2020, 1), 'endtime': month(2021, 1), 'slope': 0.5, 'humidslope': -0.1, 'intercept': 2.0, 'note': '3003 2020'},
+            {'starttime': month(2020, 6), 'endtime': month(2022, 1), 'slope': 0.7, 'humidslope': 0.0, 'intercept': 1.0, 'note': '3003 2021'},
+            {'starttime': 'default', 'slope': 0.9, 'humidslope': 0.0, 'intercept': 0.0, 'note': '3003 default'},
+            {'starttime': month(2019, 1), 'endtime': month(2020, 3), 'slope': 0.3, 'humidslope': 0.01, 'intercept': 0.0, 'note': '3003 2019'}],
+        'PMS5003': [
+            {'starttime': month(2021, 1), 'endtime': month(2021, 6), 'slope': 0.4, 'humidslope': 0.0, 'intercept': 0.0, 'note': '5003 2021'}],
+        'default': [
+            {'starttime': 'default', 'slope': 1.1, 'humidslope': 0.0, 'intercept': -1.0, 'note': 'default'}]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readings', type=int, default=20000, help='number of readings')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    factors = makeFactors()
+    start = datetime(2018, 6, 1, 0, 0, 0, 0, pytz.timezone('UTC'))
+    times = pd.Series([pd.Timestamp(start + timedelta(days=float(day))) for day in rng.uniform(0., 1500., args.readings)])
+    pm2_5 = rng.gamma(2., 6., args.readings)
+    humidity = rng.uniform(10., 60., args.readings)
+    sensor_types = rng.choice(np.array(['PMS3003', 'PMS5003', 'SPS30', None], dtype=object), args.readings)
+    sensor_sources = rng.choice(np.array(['AQ&U', 'PurpleAir', 'DAQ'], dtype=object), args.readings)
+
+    begin = time.perf_counter()
+    expected = [jsonutils.applyCorrectionFactor(factors, this_time, this_pm2_5, this_humidity, this_type, this_source, status=True)
+                for this_time, this_pm2_5, this_humidity, this_type, this_source in zip(times, pm2_5, humidity, sensor_types, sensor_sources)]
+    per_reading_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    correction_engine = jsonutils.CorrectionEngine(factors)
+    compile_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    values, notes = correction_engine.apply(times, pm2_5, humidity, sensor_types, sensor_sources)
+    engine_time = time.perf_counter() - begin
+
+    same = np.array_equal(values, np.array([value for value, note in expected])) and (list(notes) == [note for value, note in expected])
+    print(f"{'readings':>9} {'per reading s':>14} {'compile s':>10} {'engine s':>9} {'speedup':>8} {'same':>5}")
+    print(f"{args.readings:>9} {per_reading_time:>14.4f} {compile_time:>10.4f} {engine_time:>9.4f} {per_reading_time/engine_time:>8.1f} {str(same):>5}")
+    if not same:
+        print("compiled and per-reading correction factors differ")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
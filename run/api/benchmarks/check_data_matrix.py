@@ -0,0 +1,89 @@
+# Checks that the columnar sensor -> data matrix pipeline (binSensorData + cleanDataMatrix) gives exactly the same matrix, coordinates and time offset
+# as the per-datum functions (createTimeVector, createSpaceVector2, assignTimeData, computeTimeArrays, setupDataMatrix2), and reports the time of each.
+# The synthetic readings have irregular times, several (and repeated) readings per bin, gaps, and readings outside the time window.
+# Exits with an error if any case differs.
+#
+# usage (from run/api):
+#    python -m benchmarks.check_data_matrix
+#    python -m benchmarks.check_data_matrix --sensors 300 --hours 12
+import argparse
+import copy
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytz
+
+import common.gaussian_model_utils as gaussian_model_utils
+
+START_TIME = datetime(2021, 9, 20, 0, 0, 0, 0, pytz.timezone('UTC'))
+
+
+# list of sensor dictionaries, like the ones computeEstimatesForLocations builds from the query results
+def makeSensorData(num_sensors, num_hours, seed=0):
+    rng = np.random.default_rng(seed)
+    sensor_data = []
+    for sensor in range(num_sensors):
+        utm_x, utm_y, altitude = rng.uniform(420000., 450000.), rng.uniform(4500000., 4530000.), rng.uniform(1300., 1600.)
+        # some sensors report every couple of minutes, some rarely
+        num_readings = int(rng.integers(1, 30*num_hours))
+        minutes = np.sort(rng.uniform(-60., 60.*(num_hours + 1), num_readings))
+        values = np.round(rng.gamma(2., 6., num_readings), 1)
+        for minute, value in zip(minutes, values):
+            sensor_data.append({'ID': f'S{sensor:04d}', 'time': pd.Timestamp(START_TIME + timedelta(minutes=float(minute))), 'PM2_5': float(value),
+                                'utm_x': utm_x, 'utm_y': utm_y, 'Altitude': altitude})
+            # repeated readings (the same value twice in a bin) happen with some of the sources
+            if rng.uniform() < 0.05:
+                sensor_data.append(dict(sensor_data[-1]))
+    return sensor_data
+
+
+def perDatumMatrix(sensor_data, time_lo_bound, time_hi_bound):
+    time_coordinates, time_offset = gaussian_model_utils.createTimeVector(sensor_data, time_lo_bound, time_hi_bound)
+    space_coordinates, device_location_map = gaussian_model_utils.createSpaceVector2(sensor_data, time_coordinates.shape[0])
+    gaussian_model_utils.assignTimeData(sensor_data, device_location_map, time_offset, time_lo_bound, time_hi_bound)
+    gaussian_model_utils.computeTimeArrays(sensor_data, device_location_map, time_coordinates)
+    data_matrix, space_coordinates, time_coordinates = gaussian_model_utils.setupDataMatrix2(sensor_data, space_coordinates, time_coordinates, device_location_map)
+    return data_matrix, space_coordinates, time_coordinates, time_offset
+
+
+def columnarMatrix(sensor_data, time_lo_bound, time_hi_bound):
+    data_matrix, space_coordinates, time_coordinates, time_offset = gaussian_model_utils.binSensorData(pd.DataFrame(sensor_data), time_lo_bound, time_hi_bound)
+    data_matrix, space_coordinates = gaussian_model_utils.cleanDataMatrix(data_matrix, space_coordinates)
+    return data_matrix, space_coordinates, time_coordinates, time_offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sensors', type=int, default=100, help='number of sensors')
+    parser.add_argument('--hours', type=int, default=6, help='hours of readings')
+    parser.add_argument('--seeds', type=int, default=5, help='number of random data sets')
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'seed':>5} {'window':>12} {'readings':>9} {'matrix':>10} {'per datum s':>12} {'columnar s':>11} {'speedup':>8} {'same':>5}")
+    for seed in range(args.seeds):
+        sensor_data = makeSensorData(args.sensors, args.hours, seed)
+        windows = [("none", -1.0, -1.0), ("bounded", START_TIME + timedelta(minutes=37), START_TIME + timedelta(hours=args.hours - 1, minutes=3))]
+        for window_name, time_lo_bound, time_hi_bound in windows:
+            # the per-datum version writes bin numbers into the dictionaries
+            old_data = copy.deepcopy(sensor_data)
+            start = time.perf_counter()
+            expected = perDatumMatrix(old_data, time_lo_bound, time_hi_bound)
+            per_datum_time = time.perf_counter() - start
+            start = time.perf_counter()
+            result = columnarMatrix(sensor_data, time_lo_bound, time_hi_bound)
+            columnar_time = time.perf_counter() - start
+
+            same = all(np.array_equal(a, b) for a, b in zip(expected[:3], result[:3])) and (expected[3] == result[3])
+            failed = failed or not same
+            print(f"{seed:>5} {window_name:>12} {len(sensor_data):>9} {str(result[0].shape):>10} {per_datum_time:>12.4f} {columnar_time:>11.4f} {per_datum_time/columnar_time:>8.1f} {str(same):>5}")
+
+    if failed:
+        print("columnar and per-datum data matrices differ")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Checks that the vectorized interpolateBadElements, removeBadSensors and fillInMissingReadings give exactly the same matrices as the
+# element-by-element versions they replaced (kept below as the reference), and reports the time of each.
+# The random matrices have gaps of all lengths, runs of good values, and bad values at both ends.  Exits with an error if any case differs.
+#
+# usage (from run/api):
+#    python -m benchmarks.check_matrix_cleanup
+#    python -m benchmarks.check_matrix_cleanup --sensors 400 --bins 300
+import argparse
+import logging
+import sys
+import time
+import numpy as np
+
+import common.gaussian_model_utils as gaussian_model_utils
+from common.gaussian_model_utils import SENSOR_INTERPOLATE_DISTANCE
+
+
+# the loop versions, as they were before vectorizing (logging left out)
+def referenceInterpolateBadElements(matrix, bad_value = 0):
+    for row in matrix:
+        prevValueIndex = None
+        for i in range(row.shape[0]):
+            if row[i] != bad_value:
+                if prevValueIndex is None:
+                    prevValueIndex = i
+                    if (i > 0) and (i < SENSOR_INTERPOLATE_DISTANCE):
+                        row[0:i] = row[i]
+                else:
+                    curValueIndex = i
+                    distance = curValueIndex - prevValueIndex
+                    if (distance > 1):
+                        if (distance < SENSOR_INTERPOLATE_DISTANCE):
+                            terp = np.interp(range(prevValueIndex + 1, curValueIndex), [prevValueIndex, curValueIndex], [row[prevValueIndex], row[curValueIndex]])
+                            row[prevValueIndex + 1:curValueIndex] = terp
+                            prevValueIndex = curValueIndex
+        if row[-1] == bad_value:
+            curValueIndex = row.shape[0]-1
+            if (prevValueIndex != None):
+                distance = curValueIndex - prevValueIndex
+                if (distance < SENSOR_INTERPOLATE_DISTANCE):
+                    row[prevValueIndex+1: curValueIndex+1] = row[prevValueIndex]
+
+
+def referenceRemoveBadSensors(data_matrix, space_coordinates, ratio):
+    toKeep = [(np.count_nonzero(row != -1.0) / len(row)) > ratio for row in data_matrix]
+    return data_matrix[toKeep], space_coordinates[toKeep]
+
+
+def referenceFillInMissingReadings(data_matrix, bad_value = 0.):
+    data_mask = (data_matrix != bad_value)
+    data_counts = np.sum(data_mask, 0)
+    sum_tmp = np.sum(np.multiply(data_matrix,data_mask), 0)
+    time_averages = np.divide(sum_tmp, data_counts, out=np.zeros_like(sum_tmp), where=(data_counts!=0))
+    for idx in np.ndindex(data_matrix.shape):
+        if data_matrix[idx] == bad_value:
+            data_matrix[idx] = time_averages[idx[1]]
+    return data_matrix
+
+
+# readings with runs of good and bad bins of random lengths (bad is -1)
+def makeRawMatrix(num_sensors, num_bins, seed):
+    rng = np.random.default_rng(seed)
+    matrix = np.round(rng.gamma(2., 6., (num_sensors, num_bins)), 2)
+    for row in matrix:
+        # mostly reliable sensors, some flaky ones and a few dead ones
+        bad_rate = rng.choice([0.05, 0.3, 0.7, 1.0], p=[0.6, 0.25, 0.1, 0.05])
+        i = 0
+        while i < num_bins:
+            run = int(rng.integers(1, 2*SENSOR_INTERPOLATE_DISTANCE + 2))
+            if rng.uniform() < bad_rate:
+                row[i:i + run] = -1.0
+            i += run
+    return matrix
+
+
+def timeCall(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sensors', type=int, default=200, help='number of sensors (rows)')
+    parser.add_argument('--bins', type=int, default=150, help='number of time bins (columns)')
+    parser.add_argument('--seeds', type=int, default=10, help='number of random matrices')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    failed = False
+    print(f"{'seed':>5} {'step':>10} {'loop s':>9} {'numpy s':>9} {'speedup':>8} {'same':>5}")
+    for seed in range(args.seeds):
+        raw = makeRawMatrix(args.sensors, args.bins, seed)
+        space_coordinates = np.arange(3*args.sensors, dtype=float).reshape(-1, 3)
+
+        expected, result = raw.copy(), raw.copy()
+        loop_time, _ = timeCall(referenceInterpolateBadElements, expected, -1)
+        numpy_time, _ = timeCall(gaussian_model_utils.interpolateBadElements, result, -1)
+        steps = [("interp", loop_time, numpy_time, np.array_equal(expected, result))]
+
+        loop_time, (expected, expected_space) = timeCall(referenceRemoveBadSensors, expected, space_coordinates, 0.75)
+        numpy_time, (result, result_space) = timeCall(gaussian_model_utils.removeBadSensors, result, space_coordinates, 0.75)
+        steps.append(("remove", loop_time, numpy_time, np.array_equal(expected, result) and np.array_equal(expected_space, result_space)))
+
+        loop_time, expected = timeCall(referenceFillInMissingReadings, expected, -1)
+        numpy_time, result = timeCall(gaussian_model_utils.fillInMissingReadings, result, -1)
+        steps.append(("fill", loop_time, numpy_time, np.array_equal(expected, result)))
+
+        for step, loop_time, numpy_time, same in steps:
+            failed = failed or not same
+            print(f"{seed:>5} {step:>10} {loop_time:>9.4f} {numpy_time:>9.4f} {loop_time/numpy_time:>8.1f} {str(same):>5}")
+
+    if failed:
+        print("vectorized and loop versions differ")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
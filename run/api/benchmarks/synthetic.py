@@ -0,0 +1,48 @@
+# synthetic sensor fields for the benchmarks in this directory
+# the numbers are loosely based on slc_ut: sensors spread over ~30km, elevations in the 1300-1600m range, and 8 minute time bins
+import numpy as np
+import torch
+
+import common.gaussian_model_utils as gaussian_model_utils
+
+LATLON_LENGTH_SCALE = 4300.
+ELEVATION_LENGTH_SCALE = 30.
+TIME_LENGTH_SCALE = 0.25
+NOISE_VARIANCE = 36.0
+SIGNAL_VARIANCE = 400.0
+
+AREA_SIZE_METERS = 30000.
+UTM_ORIGIN = (420000., 4500000.)
+
+
+# smooth-ish PM2.5 field (plus noise) sampled at the sensor locations on a regular grid of time bins
+def makeSensorField(num_sensors, num_times, seed=0):
+    rng = np.random.default_rng(seed)
+    utm_x = UTM_ORIGIN[0] + rng.uniform(0., AREA_SIZE_METERS, num_sensors)
+    utm_y = UTM_ORIGIN[1] + rng.uniform(0., AREA_SIZE_METERS, num_sensors)
+    elevation = rng.uniform(1300., 1600., num_sensors)
+    space_coordinates = np.column_stack((utm_x, utm_y, elevation))
+
+    bin_hours = gaussian_model_utils.NUM_MINUTES_PER_BIN/60.
+    time_coordinates = np.expand_dims(np.arange(num_times)*bin_hours, axis=1)
+
+    phase = rng.uniform(0., 2.*np.pi)
+    space_part = np.sin((utm_x - UTM_ORIGIN[0])/8000. + phase) + np.cos((utm_y - UTM_ORIGIN[1])/11000.)
+    time_part = np.sin(time_coordinates[:, 0]/1.5)
+    data = 15. + 8.*np.outer(space_part, 1. + 0.5*time_part) + rng.normal(0., 2., (num_sensors, num_times))
+    return space_coordinates, time_coordinates, np.maximum(data, 0.)
+
+
+# query locations on a regular grid that covers the sensors, and query times inside the sensor time range
+def makeQuery(num_locations, num_times, time_coordinates, seed=1):
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(num_locations)))
+    grid_x, grid_y = np.meshgrid(np.linspace(0., AREA_SIZE_METERS, side), np.linspace(0., AREA_SIZE_METERS, side))
+    utm_x = UTM_ORIGIN[0] + grid_x.flatten()[:num_locations]
+    utm_y = UTM_ORIGIN[1] + grid_y.flatten()[:num_locations]
+    elevation = rng.uniform(1300., 1600., num_locations)
+    query_space = np.column_stack((utm_x, utm_y, elevation))
+
+    margin = 0.25*(time_coordinates[-1, 0] - time_coordinates[0, 0])
+    query_time = np.expand_dims(np.linspace(time_coordinates[0, 0] + margin, time_coordinates[-1, 0] - margin, num_times), axis=1)
+    return torch.tensor(query_space), torch.tensor(query_time)
@@ -0,0 +1,64 @@
+# Columnar responses (format=arrow or format=parquet) of the bulk data endpoints: an Arrow IPC stream, or a Parquet file, of record batches
+# with typed columns (timestamps as timestamps, PM2.5 as float32), so analytics jobs read the result straight into a DataFrame/Arrow table
+# instead of formatting and parsing JSON.  The batches are written to the response one at a time (a Parquet row group each).
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Response, stream_with_context
+
+ARROW_MIMETYPES = {"arrow": "application/vnd.apache.arrow.stream", "parquet": "application/vnd.apache.parquet"}
+ARROW_EXTENSIONS = {"arrow": "arrows", "parquet": "parquet"}
+
+
+# file for the Arrow/Parquet writers that hands over what has been written so far (and keeps the count of bytes, which the Parquet writer
+# needs for the offsets in its footer)
+class ChunkSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# the bytes of the Arrow IPC stream or Parquet file of the batches (which have the schema), as each batch is written
+def encodeBatches(batches, schema, data_format):
+    sink = ChunkSink()
+    output = pa.PythonFile(sink, mode='w')
+    writer = pa.ipc.new_stream(output, schema) if data_format == "arrow" else pq.ParquetWriter(output, schema)
+    for batch in batches:
+        if data_format == "arrow":
+            writer.write_batch(batch)
+        else:
+            writer.write_table(pa.Table.from_batches([batch], schema=schema))
+        data = sink.drain()
+        if len(data) > 0:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+
+def arrowResponse(batches, schema, data_format, filename):
+    response = Response(stream_with_context(encodeBatches(batches, schema, data_format)), mimetype=ARROW_MIMETYPES[data_format])
+    response.headers.add('Content-Disposition', f'attachment; filename={filename}.{ARROW_EXTENSIONS[data_format]}')
+    return response
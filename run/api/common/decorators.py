@@ -174,23 +174,23 @@ def estimateQuerySizeInDateRange():
     start_date = start_date.replace(day=1)
     end_date = end_datetime.date()
 
-    bq_client = common.utils.getBigQueryClient()
-    regions_clause = f'''({' OR '.join([f'Region="{region}"' for region in args[URL_PARAMS.AREA_MODEL]])})'''
+    backend = common.utils.getTelemetryBackend()
+    regions_clause = f'''({' OR '.join([f"Region='{region}'" for region in args[URL_PARAMS.AREA_MODEL]])})'''
 
     if args[URL_PARAMS.SENSOR_SOURCE] == 'all':
         sources_clause = 'True'
     else:
-        sources_clause = f'Source="{args[URL_PARAMS.SENSOR_SOURCE]}"'
+        sources_clause = f"Source='{args[URL_PARAMS.SENSOR_SOURCE]}'"
     query = f"""
 SELECT
     Date,
     SUM(NumDevices) AS NumDevices
 FROM
-    `telemetry.statistics`
+    {backend.table("telemetry.statistics")}
 WHERE
-    Date >= "{start_date}"
+    Date >= '{start_date}'
     AND
-    Date < "{end_date}"
+    Date < '{end_date}'
     AND
     {regions_clause}
     AND
@@ -201,8 +201,7 @@ ORDER BY
     Date
     """
 
-    job = bq_client.query(query)
-    df = pd.DataFrame([dict(r) for r in job.result()]).drop_duplicates()
+    df = backend.query(query).drop_duplicates()
     
     #
     # Calculate the number of hours in each month of the query
@@ -0,0 +1,116 @@
+# Elevations for the estimate areas.
+# Each area has a grid of elevations (common/elevation/{area}_elevations.mat, with 'elevs', 'lons' and 'lats').  Reading the .mat file and
+# building an interpolator for every request is slow, so the grid is converted once to .npy files (float32 elevations, which are memory mapped
+# so that the worker processes share the pages) and one interpolator per area is kept for the life of the process.
+# The interpolators take whole arrays of points, and remember the altitudes of the sensors they have been asked about.
+#
+# usage (from run/api), to convert the grids ahead of time:
+#    python -m common.elevation [area names]
+import glob
+import os
+import sys
+import threading
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RegularGridInterpolator
+from scipy.io import loadmat
+
+ELEVATION_DIR = 'common/elevation/'
+# elevation outside of the grid (what the interp2d interpolators used for fill_value)
+OUTSIDE_ELEVATION = 0.0
+# more sensors than this and the altitude cache is started over
+SENSOR_ALTITUDE_CACHE_SIZE = 100000
+
+
+def elevationFiles(area_name):
+    prefix = os.path.join(ELEVATION_DIR, f'{area_name}_elevations')
+    return prefix + '.mat', prefix + '.npy', prefix + '_lons.npy', prefix + '_lats.npy'
+
+
+# write the area's grid as .npy files, if they are missing or older than the .mat file
+def convertElevationGrid(area_name):
+    mat_file, elevation_file, lons_file, lats_file = elevationFiles(area_name)
+    if os.path.exists(elevation_file) and not (os.path.exists(mat_file) and os.path.getmtime(mat_file) > os.path.getmtime(elevation_file)):
+        return
+    print('converting elevations:', mat_file)
+    data = loadmat(mat_file)
+    # the lons and lats come first, the elevations are what says the conversion is done
+    for filename, values in [(lons_file, np.ravel(data['lons']).astype(np.float64)), (lats_file, np.ravel(data['lats']).astype(np.float64)),
+                             (elevation_file, np.asarray(data['elevs'], dtype=np.float32))]:
+        # write and rename, so other processes never load a partial file
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'wb') as tmp_file:
+            np.save(tmp_file, values)
+        os.replace(tmp_filename, filename)
+
+
+class AreaElevation:
+    # elevations[i, j] is the elevation at (lats[i], lons[j])
+    def __init__(self, lons, lats, elevations):
+        lons, lats = np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)
+        # the grid axes have to be increasing
+        if lons[0] > lons[-1]:
+            lons, elevations = lons[::-1], elevations[:, ::-1]
+        if lats[0] > lats[-1]:
+            lats, elevations = lats[::-1], elevations[::-1, :]
+        self.interpolator = RegularGridInterpolator((lats, lons), elevations, method='linear', bounds_error=False, fill_value=OUTSIDE_ELEVATION)
+        # sensor ID -> (lon, lat, altitude)
+        self.sensor_altitudes = {}
+        self.lock = threading.Lock()
+
+    # elevations at the points (lons[i], lats[i]).  The arguments are in "lon-lat" order, like the interp2d interpolators this replaces,
+    # but the result is one elevation per point rather than a grid
+    def __call__(self, lons, lats):
+        lons, lats = np.atleast_1d(np.asarray(lons, dtype=np.float64)), np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        if lons.shape[0] == 0:
+            return np.empty(0)
+        return self.interpolator(np.column_stack((lats, lons))).astype(np.float64)
+
+    # altitudes of the sensors at the given locations (one per reading).  Sensors mostly stay put, so the altitude of a sensor ID is
+    # looked up once and reused until the sensor reports a different location
+    def sensorAltitudes(self, ids, lons, lats):
+        # one lookup per distinct (sensor, location) rather than per reading
+        reading_sensors, sensors = pd.MultiIndex.from_arrays([np.asarray(ids, dtype=object), np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)]).factorize()
+        sensor_altitudes = np.empty(len(sensors))
+        missing = []
+        with self.lock:
+            for i, (sensor_id, lon, lat) in enumerate(sensors):
+                cached = self.sensor_altitudes.get(sensor_id)
+                if (cached is not None) and (cached[0] == lon) and (cached[1] == lat):
+                    sensor_altitudes[i] = cached[2]
+                else:
+                    missing.append(i)
+
+        if len(missing) > 0:
+            sensor_altitudes[missing] = self([sensors[i][1] for i in missing], [sensors[i][2] for i in missing])
+            with self.lock:
+                if len(self.sensor_altitudes) + len(missing) > SENSOR_ALTITUDE_CACHE_SIZE:
+                    self.sensor_altitudes.clear()
+                for i in missing:
+                    self.sensor_altitudes[sensors[i][0]] = (sensors[i][1], sensors[i][2], sensor_altitudes[i])
+
+        return sensor_altitudes[reading_sensors]
+
+
+def loadAreaElevation(area_name):
+    convertElevationGrid(area_name)
+    mat_file, elevation_file, lons_file, lats_file = elevationFiles(area_name)
+    print('loading elevations:', elevation_file)
+    return AreaElevation(np.load(lons_file), np.load(lats_file), np.load(elevation_file, mmap_mode='r'))
+
+
+# shared interpolator for the area, loaded the first time it is asked for
+def getAreaElevation(area_name):
+    if not hasattr(getAreaElevation, 'areas'):
+        getAreaElevation.areas = {}
+        getAreaElevation.lock = threading.Lock()
+    with getAreaElevation.lock:
+        if area_name not in getAreaElevation.areas:
+            getAreaElevation.areas[area_name] = loadAreaElevation(area_name)
+        return getAreaElevation.areas[area_name]
+
+
+if __name__ == '__main__':
+    area_names = sys.argv[1:] if len(sys.argv) > 1 else [os.path.basename(filename)[:-len('_elevations.mat')] for filename in glob.glob(os.path.join(ELEVATION_DIR, '*_elevations.mat'))]
+    for area_name in area_names:
+        convertElevationGrid(area_name)
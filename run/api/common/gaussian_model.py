@@ -17,6 +17,8 @@ from scipy import fft as scipy_fft
 
 
 JITTER = 1e-2
+# upper bound on the temporary memory used when computing the variances in blocks (dense, unstructured case)
+VARIANCE_BLOCK_BYTES = 64*1024*1024
 
 # this does an eigen analysis of a symmetric circulant matrix using an FFT
 #def symeigCirculant(data_first_row, eigenvectors=True):
@@ -25,64 +27,57 @@ JITTER = 1e-2
 #  This is a set of tools for supporting and inverting circulant matrices, as needed for efficient inversion of time series (sampled at regular intervals)
 
 # efficient matrix multiply with diagonal matrix -- I cannot believe torch doesn't have this.
+# (broadcasting the diagonal down the rows does it in one shot)
 def diagMultTorchLeft(diag_vector, matrix):
     rows = diag_vector.shape[0]
-    cols = matrix.shape[1]
 #    print(diag_vector.shape)
 #    print(matrix.shape)
     if (rows != matrix.shape[0]):
         print("RunTimeError: bad entries for diagonal matrix multiply")
         return torch.zeros([0])
 
-    result = torch.zeros([rows,cols],dtype=torch.float64)
-    for i in range(rows):
-        result[i, :] = diag_vector[i]*matrix[i, :]
-#    print(result.shape)
-    return result
+    return (diag_vector.view(-1, 1)*matrix).to(torch.float64)
 
 # used for plugging kernels into other operations associated with circulant kernel matrices
+# works on scalars or numpy arrays
 def gaussKernel(x):
-    return(math.exp(-(x**2/2.0)))
+    return(np.exp(-(x**2/2.0)))
 
-# just fills up an array with kernel values, relative to the zero position and wrapping boundary conditions (circulant
+# just fills up an array with kernel values, relative to the zero position and wrapping boundary conditions (circulant)
+# the kernel is evaluated on the whole array of (wrapped) distances at once
+# note: for odd sizes the old loop version put the wrong distance in the middle entry, which made the array (and the circulant matrix) non-symmetric
 def buildKernelArray(size, kernel, bandwidth=1.0):
-    array = np.zeros(size)
-    if (size % 2) != 0:
-        for i in range((size-1)//2):
-            array[i] = kernel(float(i)/bandwidth)
-        for i in range((size+1)//2):
-            array[size-(i+1)] = kernel(float((i+1))/bandwidth)
-    else:
-        for i in range((size)//2):
-            array[i] = kernel(float(i)/bandwidth)
-        for i in range((size)//2):
-            array[size-(i+1)] = kernel(float((i+1))/bandwidth)
-    return(array)
+    index = np.arange(size)
+    distance = np.minimum(index, size - index)
+    return(np.asarray(kernel(distance/float(bandwidth)), dtype=np.float64))
 
 
 # convenience function for getting a circulant matrix
 def buildKernelCirculantMatrix(size, kernel, bandwidth=1.0):
     return(scipy.linalg.circulant(buildKernelArray(size, kernel, bandwidth)))
 
+# the phases 2*pi*i*k/size for all of the fourier basis vectors, as an outer product
+# i*k is reduced mod size first, which keeps the angles small (and accurate) for big sizes
+def fourierAngles(size):
+    index = np.arange(size)
+    return (2.*np.pi/size)*(np.outer(index, index) % size)
+
+# unitary DFT matrix -- column i is exp(-2j*pi*i*k/size)/sqrt(size)
+def fourierMatrix(size):
+    return np.exp(-1j*fourierAngles(size))/np.sqrt(size)
+
 #uses the fft to compute the inverse of a circulant matrix, specified by the first column as input
 def circulantMatrixInverse(vector):
     v_fft = scipy_fft.fft(vector)
-    size = vector.shape[0]
-    array = np.zeros([size, size], dtype=np.complex_)
-    for i in range(size):
-        array[:,i] = np.exp(-2j * np.pi * i * np.arange(size)/size)
-    array *= 1./np.sqrt(size)
-    return(np.matmul(np.matmul(array, np.diagflat(1.0/v_fft)), (array.conjugate()).transpose()))
+    array = fourierMatrix(vector.shape[0])
+    # scaling the columns is the same as multiplying by diag(1/v_fft)
+    return(np.matmul(array*(1.0/v_fft), (array.conjugate()).transpose()))
 
 
 #uses the fft to compute the complex eigen values/vectors of a circulant matrix, specified by the first column as input
 def circulantMatrixEigen(vector):
     v_fft = scipy_fft.fft(vector)
-    size = vector.shape[0]
-    array = np.zeros([size, size], dtype=np.complex_)
-    for i in range(size):
-        array[:,i] = np.exp(-2j * np.pi * i * np.arange(size)/size)
-    array *= 1./np.sqrt(size)
+    array = fourierMatrix(vector.shape[0])
 # return an complex valued eigen and vectors... 
     return(v_fft, array)
 
@@ -98,18 +93,19 @@ def circulantMatrixEigen(vector):
 #     return(v_fft, array)
 
 # This works and has been tested
+# For a real, symmetric first column the spectrum is real and symmetric, so the rfft has all of the eigen values.  The eigen vectors are the
+# cos (low half) and sin (high half) parts of the fourier basis, built directly from the outer product of the indices.
 def symCirculantMatrixEigen(vector):
-    v_fft = np.real(scipy_fft.fft(vector))
+    size = vector.shape[0]
+    v_rfft = np.real(scipy_fft.rfft(vector))
+    v_fft = np.concatenate((v_rfft, v_rfft[1:(size+1)//2][::-1]))
 #    print("fft")
 #    print(v_fft)
-    size = vector.shape[0]
-    array = np.zeros([size, size])
-    for i in range(size):
-        this_vector = np.exp(-2j * np.pi * i * np.arange(size)/(size))
-        if i <= size//2:
-            array[:,i] = np.real(this_vector)
-        else:
-            array[:,i] = np.imag(this_vector)
+    angles = fourierAngles(size)
+    array = np.empty([size, size])
+    array[:, :size//2 + 1] = np.cos(angles[:, :size//2 + 1])
+    # imaginary part of exp(-2j*pi*i*k/size)
+    array[:, size//2 + 1:] = -np.sin(angles[:, size//2 + 1:])
 #crazy normalization of the high-freq vector for special, even case
     if (size % 2) == 0:
         array[:,size//2] *= np.sqrt(0.5)
@@ -160,11 +156,15 @@ def combinations(A, B):
 # Put in lots of print statements that are commented out, that were used for debugging.
 # Tested/debugged the case where query is multiple spatial locations -- this will be used in getEstimateForLocations and getEstimateMap in the API code
 #
+# The "kronecker_factored" flag keeps the space and time eigen decompositions separate.  The space-time kernel is K_t (x) K_s, so its eigen vectors are
+# Q_t (x) Q_s and every product with them can be done with the identity (A (x) B) vec(X) = vec(B X A^T).  That way the (N*T)x(N*T) matrices are never
+# built -- memory is O(N^2 + T^2) instead of O((N*T)^2) -- and the predictions are the same as the dense versions (up to round off).
+#
 
 class gaussian_model(nn.Module):
     def __init__(self, space_coordinates, time_coordinates, stData,
                  latlon_length_scale=4300., elevation_length_scale=30., time_length_scale=0.25,
-                 noise_variance=0.1, signal_variance=1., time_structured=True):
+                 noise_variance=0.1, signal_variance=1., time_structured=True, kronecker_factored=False):
         # space_coordinates musth a matrix of [number of space_coordinates x (lat,long,elevation)]
         # in UTM or any meter coordinate.
         # time_coordinates musth a matrix of [number of time_coordinates x 1] in hour formate
@@ -181,6 +181,8 @@ class gaussian_model(nn.Module):
         self.log_signal_variance = nn.Parameter(torch.log(torch.tensor(signal_variance)))
         # this says whether or not you can use the FFT for time
         self.time_structured = time_structured
+        # this says whether or not to keep the space-time decomposition in factored (kronecker) form
+        self.kronecker_factored = kronecker_factored
         # for reporting purposes
         self.measurements = stData.numel()
 
@@ -190,6 +192,19 @@ class gaussian_model(nn.Module):
     def getLengthScales(self):
         return math.exp(self.log_latlon_length_scale), math.exp(self.log_elevation_length_scale), math.exp(self.log_time_length_scale)
 
+    # approximate number of bytes held by the fitted model (data, decompositions, inverses) -- used to budget the model cache
+    def get_memory_size(self):
+        return sum(value.element_size()*value.nelement() for value in vars(self).values() if torch.is_tensor(value))
+
+    # approximate temporary memory (bytes) that forward() needs for each query location -- used to split big queries into tiles
+    def get_forward_bytes_per_location(self, num_test_times):
+        num_space, num_time = self.stData.shape
+        if self.kronecker_factored:
+            # the test space kernel and its eigen projection, plus the outputs
+            return 8*(2*num_space + 4*num_test_times)
+        # the (space*time) test kernel and its eigen projection, plus the outputs
+        return 8*(2*num_test_times*num_space*num_time + 4*num_test_times)
+
     def SE_kernel(self, X, X2, length_scale):
         # length_scale MUST be positive
         X = X / length_scale.expand(X.size(0), X.size(1))
@@ -220,14 +235,6 @@ class gaussian_model(nn.Module):
                 ) + torch.eye(self.time_coordinates.size(0)) * JITTER
             # np.savetxt('temp_kernel_unstructured.csv', (temporal_kernel).detach().numpy(), delimiter = ';')
             eigen_value_t, eigen_vector_t = torch.symeig(temporal_kernel, eigenvectors=True)
-            eigen_vector_st = kronecker(eigen_vector_t, eigen_vector_s)
-            eigen_value_st = kronecker(eigen_value_t.view(-1, 1), eigen_value_s.view(-1, 1)).view(-1)
-            eigen_value_st_plus_noise_inverse = 1. / (self.log_signal_variance.exp()*eigen_value_st + torch.exp(self.log_noise_variance))
-            sigma_inverse = eigen_vector_st @ eigen_value_st_plus_noise_inverse.diag_embed() @ (eigen_vector_st.transpose(-2, -1))
-#            self.K = eigen_vector_st @ eigen_value_st.diag_embed() @ eigen_vector_st.transpose(-2, -1)
- #           np.savetxt('kernel_unstructured.csv', (self.K).detach().numpy(), delimiter = ';')
-            self.alpha = sigma_inverse @ self.stData.transpose(-2, -1).reshape(-1, 1)
-            self.sigma_inverse = sigma_inverse
         else:
             # in this case we assume that time has a constant interval between successive samples
             # we might not need to build the matrix
@@ -240,18 +247,31 @@ class gaussian_model(nn.Module):
             # this is the first column of the circulant time-kernel matrix
             temporal_kernel_vector = buildKernelArray(self.time_coordinates.shape[0], gaussKernel,
                                                              # express the length in terms of bins
-                                                             torch.exp(self.log_time_length_scale)/delta_time)
+                                                             (torch.exp(self.log_time_length_scale)/delta_time).item())
 #            print("about to do circ eigen")
             eigen_value_t_np, eigen_vector_t_np = symCirculantMatrixEigen(temporal_kernel_vector)
 #            print("done circ eigen")
 
-            eigen_value_t = torch.from_numpy(eigen_value_t_np)
+            # the circulant matrix has the same eigen vectors with the JITTER added to the diagonal (as in the unstructured kernel)
+            eigen_value_t = torch.from_numpy(eigen_value_t_np) + JITTER
             eigen_vector_t = torch.from_numpy(eigen_vector_t_np)
 #            print("temp inversion")
 # this is a test to make sure they are eigen vectors            
 #            print(eigen_vector_t_np.transpose()@temporal_kernel@eigen_vector_t_np)                
 
-
+        if self.kronecker_factored:
+            self.update_factored(eigen_value_s, eigen_vector_s, eigen_value_t, eigen_vector_t)
+        elif not self.time_structured:
+            eigen_vector_st = kronecker(eigen_vector_t, eigen_vector_s)
+            eigen_value_st = kronecker(eigen_value_t.view(-1, 1), eigen_value_s.view(-1, 1)).view(-1)
+            eigen_value_st_plus_noise_inverse = 1. / (self.log_signal_variance.exp()*eigen_value_st + torch.exp(self.log_noise_variance))
+            sigma_inverse = eigen_vector_st @ eigen_value_st_plus_noise_inverse.diag_embed() @ (eigen_vector_st.transpose(-2, -1))
+#            self.K = eigen_vector_st @ eigen_value_st.diag_embed() @ eigen_vector_st.transpose(-2, -1)
+ #           np.savetxt('kernel_unstructured.csv', (self.K).detach().numpy(), delimiter = ';')
+            self.alpha = sigma_inverse @ self.stData.transpose(-2, -1).reshape(-1, 1)
+            self.sigma_inverse = sigma_inverse
+            self.eigen_value_st = eigen_value_st
+        else:
             self.eigen_vector_st = kronecker(eigen_vector_t, eigen_vector_s)
 #            eigen_value_st = kronecker(eigen_value_t.view(-1, 1), eigen_value_s.view(-1, 1)).view(-1)
             self.eigen_value_st = kronecker(eigen_value_t.view(-1, 1), eigen_value_s.view(-1, 1)).view(-1)
@@ -271,7 +291,23 @@ class gaussian_model(nn.Module):
 #        self.alpha = sigma_inverse @ self.stData.transpose(-2, -1).reshape(-1, 1)
 #        self.eigen_value_st = eigen_value_st
 
-    def forward(self, test_space_coordinates, test_time_coordinates):
+    # keeps the space and time eigen decompositions separate, rather than building the kronecker products of the eigen vectors
+    # the data matrix is N x T (space x time), which is the same ordering as vec() of the kronecker product Q_t (x) Q_s
+    def update_factored(self, eigen_value_s, eigen_vector_s, eigen_value_t, eigen_vector_t):
+        self.eigen_vector_s = eigen_vector_s
+        self.eigen_vector_t = eigen_vector_t
+        # the vector form is only needed for the likelihood -- it is N*T long, which is cheap
+        self.eigen_value_st = kronecker(eigen_value_t.view(-1, 1), eigen_value_s.view(-1, 1)).view(-1)
+        # N x T matrix of 1/(s*lambda_s*lambda_t + noise), same entries as the diagonal used in the dense version
+        eigen_value_matrix = eigen_value_s.view(-1, 1) * eigen_value_t.view(1, -1)
+        self.eigen_value_st_plus_noise_inverse_matrix = 1. / (self.log_signal_variance.exp()*eigen_value_matrix + torch.exp(self.log_noise_variance))
+        # (Q_t (x) Q_s)^T vec(Y) = vec(Q_s^T Y Q_t), scaled by the inverse eigen values
+        self.sigma_diag_matrix = self.eigen_value_st_plus_noise_inverse_matrix * (eigen_vector_s.transpose(-2, -1) @ self.stData @ eigen_vector_t)
+        # alpha = sigma_inverse vec(Y) = vec(Q_s W Q_t^T)
+        self.alpha = (eigen_vector_s @ self.sigma_diag_matrix @ eigen_vector_t.transpose(-2, -1)).transpose(-2, -1).reshape(-1, 1)
+
+    # with compute_variance=False only the means are computed and yVar is None (the variance is most of the cost for large queries)
+    def forward(self, test_space_coordinates, test_time_coordinates, compute_variance=True):
         with torch.no_grad():
             test_latlon_kernel = self.SE_kernel(test_space_coordinates[:, 0:2], self.space_coordinates[:, 0:2],
                                                  torch.exp(self.log_latlon_length_scale))
@@ -282,43 +318,79 @@ class gaussian_model(nn.Module):
             test_temporal_kernel = self.SE_kernel(test_time_coordinates, self.time_coordinates,
                                                   torch.exp(self.log_time_length_scale))
 
-            test_st_kernel = self.log_signal_variance.exp()*kronecker(test_temporal_kernel, test_spatial_kernel)
-            # alpha is the kernel inverse times the measurements that were taken already
-            #        self.alpha = sigma_inverse @ self.stData.transpose(-2, -1).reshape(-1, 1)
-            if self.time_structured==True:
-                sigma_diag = diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, ((self.eigen_vector_st).transpose(-2, -1)@self.stData.transpose(-2, -1).reshape(-1, 1)))
+            if self.kronecker_factored:
+                yPred, yVar = self.forward_factored(test_spatial_kernel, test_temporal_kernel, compute_variance)
+            else:
+                yPred, yVar = self.forward_dense(test_spatial_kernel, test_temporal_kernel, compute_variance)
+
+#            status_string = str(self.measurements) + " binned measurements"
+            status_string = str(self.stData.shape[0]) + " sensors" + (", fft time model" if self.time_structured else ", dense time model")
+            status = [status_string for i in range(test_time_coordinates.size(0))]
+            return yPred, yVar, status
+
+    # the test kernel is also a kronecker product (time x space), so the predictions come out directly as a [space x time] matrix
+    def forward_factored(self, test_spatial_kernel, test_temporal_kernel, compute_variance=True):
+        signal_variance = self.log_signal_variance.exp()
+        test_space_eigen = test_spatial_kernel @ self.eigen_vector_s
+        test_time_eigen = test_temporal_kernel @ self.eigen_vector_t
+        yPred = signal_variance*(test_space_eigen @ self.sigma_diag_matrix @ test_time_eigen.transpose(-2, -1))
+        if not compute_variance:
+            return yPred, None
+        # diagonal of the (kronecker) test kernel times the inverse -- each term of the sum factors into a space part and a time part
+        yVar = signal_variance - (signal_variance**2)*((test_space_eigen**2) @ self.eigen_value_st_plus_noise_inverse_matrix @ (test_time_eigen**2).transpose(-2, -1))
+        return yPred, yVar
+
+    # builds the full (N*T) test kernel -- kept for the case where the decompositions are not factored (and for checking the factored version)
+    def forward_dense(self, test_spatial_kernel, test_temporal_kernel, compute_variance=True):
+        test_st_kernel = self.log_signal_variance.exp()*kronecker(test_temporal_kernel, test_spatial_kernel)
+        num_test_times = test_temporal_kernel.size(0)
+        num_test_locations = test_spatial_kernel.size(0)
+        # alpha is the kernel inverse times the measurements that were taken already
+        #        self.alpha = sigma_inverse @ self.stData.transpose(-2, -1).reshape(-1, 1)
+        if self.time_structured==True:
+            sigma_diag = diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, ((self.eigen_vector_st).transpose(-2, -1)@self.stData.transpose(-2, -1).reshape(-1, 1)))
 #                print("done with sigma_diag")
-                yPred = (test_st_kernel@self.eigen_vector_st)@sigma_diag
+            if not compute_variance:
+                # only a matrix-vector product with the test kernel is needed for the means
+                yPred = test_st_kernel@(self.eigen_vector_st@sigma_diag)
+                return yPred.view(num_test_times, num_test_locations).transpose(-2, -1), None
+            test_times_eigen = test_st_kernel@ self.eigen_vector_st
+            yPred = test_times_eigen@sigma_diag
 #                print("done with yPred")
-                yVar = torch.zeros(test_st_kernel.size(0))
-                test_times_eigen = test_st_kernel@ self.eigen_vector_st
-                # for i in range(test_st_kernel.size(0)):
-                #     yVar[i] = self.log_signal_variance.exp() - test_times_eigen[i:i+1, :] @diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen[i:i+1, :] .t())
+            yPred = yPred.view(num_test_times, num_test_locations).transpose(-2, -1)
+            # for i in range(test_st_kernel.size(0)):
+            #     yVar[i] = self.log_signal_variance.exp() - test_times_eigen[i:i+1, :] @diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen[i:i+1, :] .t())
 #                yVar = torch.diagonal(self.log_signal_variance.exp()*torch.eye(test_st_kernel.size(0)) - test_times_eigen@diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen.t()))
-                yVar = self.log_signal_variance.exp()*torch.ones(test_st_kernel.size(0)) - torch.einsum("ij,ji->i", test_times_eigen, diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen.t()))
+            yVar = self.log_signal_variance.exp()*torch.ones(test_st_kernel.size(0)) - torch.einsum("ij,ji->i", test_times_eigen, diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen.t()))
 #                print(test_times_eigen.shape)
 #                print(diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen.t()))
 
 #                print("done with yVar")
 
-                yPred = yPred.view(test_time_coordinates.size(0), test_space_coordinates.size(0)).transpose(-2, -1)
-                yVar = yVar.view(test_time_coordinates.size(0), test_space_coordinates.size(0)).transpose(-2, -1)
+            yVar = yVar.view(num_test_times, num_test_locations).transpose(-2, -1)
 
-            else:
-                yPred = test_st_kernel @ self.alpha
+        else:
+            yPred = test_st_kernel @ self.alpha
+            yPred = yPred.view(num_test_times, num_test_locations).transpose(-2, -1)
+            if not compute_variance:
+                return yPred, None
 
-                yVar = torch.zeros(test_st_kernel.size(0))
-                for i in range(test_st_kernel.size(0)):
-                    yVar[i] = self.log_signal_variance.exp() - test_st_kernel[i:i + 1, :] @ self.sigma_inverse @ test_st_kernel[i:i + 1, :].t()
+            yVar = self.batched_variance(test_st_kernel)
+            yVar = yVar.view(num_test_times, num_test_locations).transpose(-2, -1)
 
-                yPred = yPred.view(test_time_coordinates.size(0), test_space_coordinates.size(0)).transpose(-2, -1)
-                yVar = yVar.view(test_time_coordinates.size(0), test_space_coordinates.size(0)).transpose(-2, -1)
+        return yPred, yVar
+        
+    # diagonal of k* sigma_inverse k*^T, without a python loop over the query points
+    # rows of the test kernel are done in blocks so that the temporary (block x N*T) product stays under VARIANCE_BLOCK_BYTES
+    def batched_variance(self, test_st_kernel):
+        num_rows, num_cols = test_st_kernel.shape
+        block_size = max(1, int(VARIANCE_BLOCK_BYTES // (8*max(num_cols, 1))))
+        yVar = torch.empty(num_rows, dtype=torch.float64)
+        for start in range(0, num_rows, block_size):
+            block = test_st_kernel[start:start + block_size]
+            yVar[start:start + block_size] = self.log_signal_variance.exp() - torch.einsum("ij,ij->i", block @ self.sigma_inverse, block)
+        return yVar
 
-#            status_string = str(self.measurements) + " binned measurements"
-            status_string = str(self.stData.shape[0]) + " sensors"
-            status = [status_string for i in range(test_time_coordinates.size(0))]
-            return yPred, yVar, status
-            
     def negative_log_likelihood(self):
         nll = 0
         nll += 0.5 * (self.eigen_value_st + torch.exp(self.log_noise_variance)).log().sum()
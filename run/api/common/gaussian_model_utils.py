@@ -1,6 +1,7 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 import numpy
+import pandas as pd
 import common.gaussian_model as gaussian_model
 import common.utils as utils
 import torch
@@ -35,6 +36,9 @@ FRACTION_SIGNIFICANT_FAILS = 0.30
 # maximum valid that we would expect -- anything bigger may be a bad reading
 MAX_VALID_PM2_5 = 200.0
 
+# default memory budget for evaluating a model at many query locations (e.g. big maps).  The locations are done in tiles that fit in this
+QUERY_TILE_BYTES = 256*1024*1024
+
 
 def getTimeCoordinateBin(datetime, time_offset=0):
     delta = datetime - JANUARY1ST
@@ -51,6 +55,17 @@ def getTimeCoordinateBin(datetime, time_offset=0):
     return bin_number - time_offset
 
 
+# round a datetime down/up to the edges of its time bin (the same bins as getTimeCoordinateBin)
+def binFloorDatetime(date):
+    bin_width = timedelta(minutes=NUM_MINUTES_PER_BIN)
+    return JANUARY1ST + ((date - JANUARY1ST)//bin_width)*bin_width
+
+
+def binCeilDatetime(date):
+    floor = binFloorDatetime(date)
+    return floor if floor == date else floor + timedelta(minutes=NUM_MINUTES_PER_BIN)
+
+
 def convertToTimeCoordinatesVector(dates, time_offset):
     return [getTimeCoordinateBin(date, time_offset=time_offset) for date in dates]
 
@@ -171,45 +186,65 @@ def saveMatrixToFile(matrix, filename):
 
 # goal is to fill in zero/bad elements in between two values
 # only do short distances, e.g.  1 > <  SENSOR_INTERPOLATE_DISTANCE (missing bins)
+# Vectorized over the whole matrix, with the same output as the original element-by-element loop, including its quirks:
+#   - the interpolation anchors start at the first good value and the next anchor is the first good value 2 or more bins later, if it is less
+#     than SENSOR_INTERPOLATE_DISTANCE away.  Everything between two anchors is interpolated (good values in between get replaced too).
+#   - once a gap is too long, the rest of the row is left alone (an interpolation failure)
+#   - a short bad stretch at the beginning is filled with the first good value, and if the last value is bad, everything after the last anchor
+#     is filled with the anchor value if it is close enough to the end
 def interpolateBadElements(matrix, bad_value = 0):
-    num_interp_fails = 0
-    for row in matrix:
-        prevValueIndex = None
-        this_fail = False
-        for i in range(row.shape[0]):
-            if row[i] != bad_value:
-                if prevValueIndex is None:
-                    prevValueIndex = i
-                    # this takes care of the boundary at the beginning of the time sequence
-                    if (i > 0) and (i < SENSOR_INTERPOLATE_DISTANCE):
-                        row[0:i] = row[i]
-                else:
-                    curValueIndex = i
-                    distance = curValueIndex - prevValueIndex
-                    if (distance > 1):
-                        if (distance < SENSOR_INTERPOLATE_DISTANCE):
-                        # interpolate zeros between prev and cur
-                            terp = numpy.interp(range(prevValueIndex + 1, curValueIndex), [prevValueIndex, curValueIndex], [row[prevValueIndex], row[curValueIndex]])
-                            row[prevValueIndex + 1:curValueIndex] = terp
-                            prevValueIndex = curValueIndex
-                        else:
-                            this_fail = True
-        if this_fail:
-            num_interp_fails += 1
-        # take care of bad values and end of time range
-        if row[-1] == bad_value:
-            curValueIndex = row.shape[0]-1
-            if (prevValueIndex != None):
-                distance = curValueIndex - prevValueIndex
-                if (distance < SENSOR_INTERPOLATE_DISTANCE):            
-                    row[prevValueIndex+1: curValueIndex+1] = row[prevValueIndex]
-            else:
-                logging.debug("got full row of bad indices?" + str(row))
-        if (float(num_interp_fails)/matrix.shape[0]) > FRACTION_SIGNIFICANT_FAILS:
-            logging.warn("got %d interp failures out of %d sensors", num_interp_fails, matrix.shape[0])
+    num_rows, num_cols = matrix.shape
+    if matrix.size == 0:
+        return
+    good = (matrix != bad_value)
+    rows = numpy.arange(num_rows)
+    columns = numpy.arange(num_cols)
+    # index of the next good value at or after each column (num_cols if there is none) -- padded so that column+2 can always be looked up
+    next_good = numpy.minimum.accumulate(numpy.where(good, columns, num_cols)[:, ::-1], axis=1)[:, ::-1]
+    next_good = numpy.concatenate((next_good, numpy.full((num_rows, 2), num_cols)), axis=1)
+    # the anchor that follows an anchor at each column
+    next_anchor = numpy.where(next_good[:, 2:] < columns + SENSOR_INTERPOLATE_DISTANCE, next_good[:, 2:], num_cols)
+
+    first_anchor = next_good[:, 0]
+    has_data = first_anchor < num_cols
+    last_anchor = numpy.full(num_rows, -1)
+    is_anchor = numpy.full(matrix.shape, False)
+    # follow the chains of anchors for all rows at once -- each step moves at least 2 bins
+    anchor = first_anchor.copy()
+    active = has_data.copy()
+    while active.any():
+        active_rows = rows[active]
+        is_anchor[active_rows, anchor[active]] = True
+        last_anchor[active] = anchor[active]
+        anchor[active] = next_anchor[active_rows, anchor[active]]
+        active = anchor < num_cols
+    # the chain stopped at a gap that was too long
+    interp_fails = has_data & (next_good[rows, last_anchor + 2] < num_cols)
+
+    # interpolate between the anchors -- the rows are laid end to end so that one call does them all (the pieces between rows are not used)
+    inside = (columns >= first_anchor[:, None]) & (columns <= last_anchor[:, None])
+    anchor_positions = numpy.flatnonzero(is_anchor)
+    if anchor_positions.size > 0:
+        matrix[inside] = numpy.interp(numpy.flatnonzero(inside), anchor_positions, matrix[is_anchor])
+
+    # this takes care of the boundary at the beginning of the time sequence
+    leading = has_data & (first_anchor > 0) & (first_anchor < SENSOR_INTERPOLATE_DISTANCE)
+    leading_fill = leading[:, None] & (columns < first_anchor[:, None])
+    matrix[leading_fill] = numpy.broadcast_to(matrix[rows, first_anchor % num_cols][:, None], matrix.shape)[leading_fill]
+    # take care of bad values and end of time range
+    trailing = has_data & (~good[:, -1]) & ((num_cols - 1 - last_anchor) < SENSOR_INTERPOLATE_DISTANCE)
+    trailing_fill = trailing[:, None] & (columns > last_anchor[:, None])
+    matrix[trailing_fill] = numpy.broadcast_to(matrix[rows, last_anchor][:, None], matrix.shape)[trailing_fill]
+
+    if not has_data.all():
+        logging.debug("got %d full rows of bad indices", numpy.count_nonzero(~has_data))
+    num_interp_fails = numpy.count_nonzero(interp_fails)
+    if (float(num_interp_fails)/matrix.shape[0]) > FRACTION_SIGNIFICANT_FAILS:
+        logging.warn("got %d interp failures out of %d sensors", num_interp_fails, matrix.shape[0])
             # saveMatrixToFile(matrix, 'failed_interp_matrix.txt')            
                 
         
+        
 
 def trimBadEdgeElements(matrix, time_coordinates, bad_value=-1):
     # record index of edge values for each row
@@ -238,7 +273,7 @@ def trimBadEdgeElements(matrix, time_coordinates, bad_value=-1):
 
 # if a sensor doesn't have enough data then it gets taken out of calculations
 def removeBadSensors(data_matrix, space_coordinates, ratio):
-    toKeep = [(numpy.count_nonzero(row != -1.0) / len(row)) > ratio for row in data_matrix]
+    toKeep = (numpy.count_nonzero(data_matrix != -1.0, axis=1) / data_matrix.shape[1]) > ratio
     fraction_removed = (1.0 - float(numpy.sum(toKeep))/float(data_matrix.shape[0]))
     if (fraction_removed > FRACTION_SIGNIFICANT_FAILS):
         logging.warn("Removed %f percent of sensors due to insufficient measurements", 100.0*fraction_removed)
@@ -318,6 +353,18 @@ def setupDataMatrix2(sensor_data, space_coordinates, time_coordinates, device_lo
 #            data_matrix[space_index,i] = time_data_array[i,0]
         data_matrix[space_index,:] = time_data_array
 
+    data_matrix, space_coordinates = cleanDataMatrix(data_matrix, space_coordinates)
+
+# for debugging report id of last sensor in matrix - to get raw data
+    # print("ID of last sensor is")
+    # print(space_coordinates[space_coordinates.shape[0]-1, :])
+    # print(getSensorIDByMatrixPosition(sensor_data, space_coordinates, (space_coordinates.shape[0]-1)))
+
+    return data_matrix, space_coordinates, time_coordinates
+
+
+# interpolates short gaps, removes sensors with too little data and fills in the rest with time slice averages.  -1 marks missing data in the raw matrix
+def cleanDataMatrix(data_matrix, space_coordinates):
 # check to make sure we have data        
     if (data_matrix.size > 0):
         # saveMatrixToFile(data_matrix, '1matrix.txt')
@@ -341,13 +388,47 @@ def setupDataMatrix2(sensor_data, space_coordinates, time_coordinates, device_lo
         # saveMatrixToFile(data_matrix, '4matrix_filled_bad.txt')
         # numpy.savetxt('4filled_bad.csv', data_matrix, delimiter=',')
 
+    return data_matrix, space_coordinates
 
-# for debugging report id of last sensor in matrix - to get raw data
-    # print("ID of last sensor is")
-    # print(space_coordinates[space_coordinates.shape[0]-1, :])
-    # print(getSensorIDByMatrixPosition(sensor_data, space_coordinates, (space_coordinates.shape[0]-1)))
 
-    return data_matrix, space_coordinates, time_coordinates
+# Columnar version of createTimeVector, createSpaceVector2, assignTimeData and computeTimeArrays -- gives the same raw [sensors x bins] matrix (-1 where there is no data)
+# sensor_data is a DataFrame with columns ID, time, PM2_5, utm_x, utm_y and Altitude.
+#   - sensors are in order of their first reading (in the whole frame, not just the time range), and their locations come from that reading
+#   - times are binned with integer arithmetic on datetime64 (same bins as getTimeCoordinateBin)
+#   - each cell is the median of the distinct values in that sensor/bin (the old version collected them in a set)
+# returns the raw data matrix, space coordinates, time coordinates (hours from the first bin) and the time offset (hours from JANUARY1ST to the first bin)
+def binSensorData(sensor_data, time_lo_bound = -1.0, time_hi_bound = -1.0):
+    if sensor_data.empty:
+        return numpy.full((0, 0), -1.0), numpy.ndarray(shape=(0, 3), dtype=float), numpy.ndarray(shape=(0, 1), dtype=float), None
+
+    first_readings = sensor_data.drop_duplicates('ID')
+    sensor_ids = pd.Index(first_readings['ID'])
+    space_coordinates = first_readings[['utm_x', 'utm_y', 'Altitude']].to_numpy(dtype=float)
+
+    times = pd.to_datetime(sensor_data['time'], utc=True).to_numpy(dtype='datetime64[ns]').astype(numpy.int64)
+    in_range = numpy.full(times.shape, True)
+    if not ((time_lo_bound == -1.0) or (time_hi_bound == -1.0)):
+        in_range = (times >= pd.Timestamp(time_lo_bound).value) & (times <= pd.Timestamp(time_hi_bound).value)
+    if not in_range.any():
+        return numpy.full((len(sensor_ids), 0), -1.0), space_coordinates, numpy.ndarray(shape=(0, 1), dtype=float), None
+
+    bin_nanoseconds = NUM_MINUTES_PER_BIN*60*1000000000
+    bin_numbers = (times[in_range] - pd.Timestamp(JANUARY1ST).value)//bin_nanoseconds
+    unique_bins = numpy.unique(bin_numbers)
+    # same floating point steps as getTimeCoordinateBin, so that the coordinates match exactly
+    bin_hours = (unique_bins*NUM_MINUTES_PER_BIN).astype(float)/60
+    time_offset = float(bin_hours[0])
+    time_coordinates = numpy.expand_dims(bin_hours - time_offset, axis=1)
+
+    cells = pd.DataFrame({
+        'row': sensor_ids.get_indexer(sensor_data['ID'][in_range]),
+        'column': numpy.searchsorted(unique_bins, bin_numbers),
+        'value': sensor_data['PM2_5'][in_range].to_numpy(dtype=float)})
+    cell_medians = cells.drop_duplicates().groupby(['row', 'column'])['value'].median()
+    data_matrix = numpy.full((len(sensor_ids), unique_bins.shape[0]), -1.0)
+    data_matrix[cell_medians.index.get_level_values('row'), cell_medians.index.get_level_values('column')] = cell_medians.to_numpy()
+
+    return data_matrix, space_coordinates, time_coordinates, time_offset
 
 
 
@@ -360,9 +441,8 @@ def fillInMissingReadings(data_matrix, bad_value = 0.):
         logging.warn("WARNING: got time slice with too few data sensor values with value " + str(float(numpy.min(data_counts))/float(data_matrix.shape[0])) + " and index "  + str(numpy.nonzero((data_counts/data_matrix.shape[0]) < 0.75)))
     sum_tmp = numpy.sum(numpy.multiply(data_matrix,data_mask), 0)
     time_averages = numpy.divide(sum_tmp, data_counts, out=numpy.zeros_like(sum_tmp), where=(data_counts!=0))
-    for idx in numpy.ndindex(data_matrix.shape):
-        if data_matrix[idx] == bad_value:
-            data_matrix[idx] = time_averages[idx[1]]
+    missing = ~data_mask
+    data_matrix[missing] = numpy.broadcast_to(time_averages, data_matrix.shape)[missing]
     # it = numpy.nditer(data_matrix, flags=['multi_index'], op_flags=['readwrite'])
     # for data_value in it:
     #     if data_value == bad_value:
@@ -385,25 +465,49 @@ def computeTimeArrays(sensor_data, device_location_map, time_coordinates):
                 device[TIME_ARRAY_INDEX][i] = statistics.median(list(measurement_set))
                 # else there is no data and we leave the value at the initialized value above for later processing
 
+# decides whether the time part of the model can use the fft/circulant decomposition (time_structured) or needs the dense one
+# The circulant version treats the first and last bins as neighbors, so it needs
+#   - a regular grid of time bins (no bins missing in the middle)
+#   - data that covers the requested (padded) time range, so that the queries are far from the wrapped-around ends
+#   - enough bins that the padding on each side is at least TIME_KERNEL_FACTOR_PADDING time length scales
+# returns the decision and a short reason (for logging)
+def useTimeStructuredModel(time_coordinates, time_offset, time_length_scale, time_lo_bound = -1.0, time_hi_bound = -1.0):
+    bin_hours = NUM_MINUTES_PER_BIN/60.
+    num_bins = time_coordinates.shape[0]
+    if num_bins < 2:
+        return False, "too few time bins"
+    if not numpy.allclose(numpy.diff(time_coordinates[:, 0]), bin_hours):
+        return False, "irregular time bins"
+    if (num_bins*bin_hours) < 2.0*utils.TIME_KERNEL_FACTOR_PADDING*time_length_scale:
+        return False, "time range too short for circular boundary conditions"
+    if (time_lo_bound == -1.0) or (time_hi_bound == -1.0):
+        return False, "no time bounds to check the padding against"
+    first_bin = time_offset
+    last_bin = time_offset + time_coordinates[-1, 0]
+    if (first_bin > getTimeCoordinateBin(time_lo_bound) + bin_hours) or (last_bin < getTimeCoordinateBin(time_hi_bound) - bin_hours):
+        return False, "data does not cover the padded time range"
+    return True, "regular, padded time bins"
+
 # look a the time arrays and flat sensors with too much missing data for removal
 # not needed because taken care of in the dataMatrix routine
 # def flagUnderperformingSensors(device_location_map):
 
 # creates the gaussian_model object and loads it with the sensor data
 # Nov 2020 : This has been modified so that it takes bounds on the times considered.  This is for use in breaking up long time sequences into smaller chunks for efficiency
-def createModel(sensor_data, latlon_length_scale, elevation_length_scale, time_length_scale, time_lo_bound = -1.0, time_hi_bound = -1.0, save_matrices=False):
+# The fft/circulant time model is used when the time bins allow it (see useTimeStructuredModel), otherwise it falls back to the dense one.  Pass time_structured=True/False to force one.
+# sensor_data can be a DataFrame (see binSensorData) or the list of sensor dictionaries
+def createModel(sensor_data, latlon_length_scale, elevation_length_scale, time_length_scale, time_lo_bound = -1.0, time_hi_bound = -1.0, save_matrices=False, time_structured=None):
 
-    time_coordinates, time_offset = createTimeVector(sensor_data, time_lo_bound, time_hi_bound)
-##    space_coordinates, device_location_map = createSpaceVector(sensor_data)
-# this builds up the first instance of the device_location_map
-# sucessive calls will process and fill in the time data
-    space_coordinates, device_location_map = createSpaceVector2(sensor_data, time_coordinates.shape[0])
-    assignTimeData(sensor_data, device_location_map, time_offset, time_lo_bound, time_hi_bound)
-    computeTimeArrays(sensor_data, device_location_map, time_coordinates)
-#    data_matrix, space_coordinates, time_coordinates = setupDataMatrix(sensor_data, space_coordinates, time_coordinates, device_location_map)
-    data_matrix, space_coordinates, time_coordinates = setupDataMatrix2(sensor_data, space_coordinates, time_coordinates, device_location_map)
+    if not isinstance(sensor_data, pd.DataFrame):
+        sensor_data = pd.DataFrame(sensor_data)
+# this replaces createTimeVector, createSpaceVector2, assignTimeData, computeTimeArrays and setupDataMatrix2, which do the same thing one datum at a time
+    data_matrix, space_coordinates, time_coordinates, time_offset = binSensorData(sensor_data, time_lo_bound, time_hi_bound)
+    data_matrix, space_coordinates = cleanDataMatrix(data_matrix, space_coordinates)
 
     if (data_matrix.size > 0):
+        if time_structured is None:
+            time_structured, reason = useTimeStructuredModel(time_coordinates, time_offset, time_length_scale, time_lo_bound, time_hi_bound)
+            logging.info("time structured model: %s (%s)", time_structured, reason)
         space_coordinates = torch.tensor(space_coordinates)     # convert data to pytorch tensor
         time_coordinates = torch.tensor(time_coordinates)   # convert data to pytorch tensor
         data_matrix = torch.tensor(data_matrix)   # convert data to pytorch tensor
@@ -412,7 +516,7 @@ def createModel(sensor_data, latlon_length_scale, elevation_length_scale, time_l
                                                   latlon_length_scale=float(latlon_length_scale),
                                                   elevation_length_scale=float(elevation_length_scale),
                                                   time_length_scale=float(time_length_scale),
-                                                  noise_variance=36.0, signal_variance=400.0, time_structured=False)
+                                                  noise_variance=36.0, signal_variance=400.0, time_structured=time_structured, kronecker_factored=True)
         status = ""
     else:
         model = None
@@ -433,7 +537,9 @@ def createModel(sensor_data, latlon_length_scale, elevation_length_scale, time_l
 
 
 # Ross changed this to do the formatting in the api_routes call instead of here
-def estimateUsingModel(model, lats, lons, elevations, query_dates, time_offset, save_matrices=False):
+# with compute_variance=False the variances are skipped and yVar is None
+# the query locations are evaluated in tiles sized so that forward() stays within tile_bytes, and written into the output arrays, so peak memory doesn't grow with the size of the map
+def estimateUsingModel(model, lats, lons, elevations, query_dates, time_offset, save_matrices=False, compute_variance=True, tile_bytes=QUERY_TILE_BYTES):
 
     # converts from absolute dates to the local time coordinate system (in hours).  time_offset is the date of the first bin in the sensor data
     time_coordinates = convertToTimeCoordinatesVector(query_dates, time_offset)
@@ -464,19 +570,29 @@ def estimateUsingModel(model, lats, lons, elevations, query_dates, time_offset,
 
     space_coordinates = numpy.column_stack((x, y, elevations))
 
-    query_space = torch.tensor(space_coordinates)
     query_dates2 = numpy.transpose(numpy.asarray([time_coordinates]))
     query_time = torch.tensor(query_dates2)
 
     # if save_matrices:
         # numpy.savetxt('query_space_coords.csv', space_coordinates, delimiter=',')
         # numpy.savetxt('query_time_coords.csv', query_time, delimiter=',')
-    
-    yPred, yVar, status = model(query_space, query_time)
-    yPred = numpy.maximum(yPred.numpy(), 0.0)
-    yVar = yVar.numpy()
-    if numpy.amin(yVar) < 0.0:
-        logging.warn("Got negative values in variance, suggesting a numerical problem")
+
+    num_locations = space_coordinates.shape[0]
+    num_times = query_time.size(0)
+    tile_size = max(1, int(tile_bytes // model.get_forward_bytes_per_location(num_times)))
+    yPred = numpy.empty((num_locations, num_times))
+    yVar = numpy.empty((num_locations, num_times)) if compute_variance else None
+    for tile_start in range(0, num_locations, tile_size):
+        tile = slice(tile_start, tile_start + tile_size)
+        yPred_tile, yVar_tile, status = model(torch.tensor(space_coordinates[tile]), query_time, compute_variance=compute_variance)
+        yPred[tile] = yPred_tile.numpy()
+        if compute_variance:
+            yVar[tile] = yVar_tile.numpy()
+
+    numpy.maximum(yPred, 0.0, out=yPred)
+    if yVar is not None:
+        if numpy.amin(yVar) < 0.0:
+            logging.warn("Got negative values in variance, suggesting a numerical problem")
 
     return yPred, yVar, status
 
@@ -7,6 +7,7 @@ from dateutil.parser import parse
 from dateutil.utils import default_tzinfo
 from dateutil import tz
 import numpy as np
+import pandas as pd
 import logging
 from google.cloud import firestore
 from scipy import interpolate
@@ -23,6 +24,9 @@ DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 JAN_FIRST = datetime(2000, 1, 1, 0, 0, 0, 0, pytz.timezone('UTC'))
 JAN_LAST = datetime(2100, 1, 1, 0, 0, 0, 0, pytz.timezone('UTC'))
 
+# sensor type to use for the correction factors when the sensor model is not reported
+SOURCE_SENSOR_TYPES = {'AQ&U': 'PMS3003', 'Tetrad': 'PMS3003', 'PurpleAir': 'PMS5003'}
+
 
 def get_all_region_info():
     if not hasattr(get_all_region_info, "updateTime"):
@@ -36,6 +40,9 @@ def get_all_region_info():
         
         get_all_region_info.updateTime = time.time()
         get_all_region_info.params = params
+        # compile the correction factors along with the region info, so they are compiled once an hour rather than once a request
+        get_all_region_info.correction_engines = {id(area['pm2.5 correction factors']): CorrectionEngine(area['pm2.5 correction factors'])
+                                                  for area in params.values() if 'pm2.5 correction factors' in area}
 
     return get_all_region_info.params
 
@@ -228,13 +235,107 @@ def applyCorrectionFactor(factors, data_timestamp, pm2_5, humidity, sensor_type,
                 return np.maximum(pm2_5 * factors[this_type][i]['slope'] + humidity*factors[this_type][i]['humidslope']+ factors[this_type][i]['intercept'], 0.0), factors[this_type][i]['note']
 
     if default_idx >= 0:
-        return np.maximum(pm2_5 * factors[this_type][default_idx]['slope'] + humidity*factors[this_type][default_idx]['humidslope']+ factors[this_type][default_idx]['intercept'], 0.0), factors[this_type][default_idx]['note']
+        if not status:
+            return np.maximum(pm2_5 * factors[this_type][default_idx]['slope'] + humidity*factors[this_type][default_idx]['humidslope']+ factors[this_type][default_idx]['intercept'], 0.0)
+        else:
+            return np.maximum(pm2_5 * factors[this_type][default_idx]['slope'] + humidity*factors[this_type][default_idx]['humidslope']+ factors[this_type][default_idx]['intercept'], 0.0), factors[this_type][default_idx]['note']
     if not status:
         return pm2_5
     else:
         return pm2_5, "no correction"
 
 
+# times (datetimes, Timestamps, strings...) as int64 nanoseconds since the epoch, naive times are taken as UTC
+def datetimesToNanoseconds(times):
+    if not isinstance(times, (pd.Series, pd.Index, np.ndarray)):
+        times = np.atleast_1d(np.asarray(times, dtype=object))
+    times = pd.DatetimeIndex(pd.to_datetime(times, utc=True))
+    return np.asarray(times.tz_convert('UTC').tz_localize(None), dtype='datetime64[ns]').view(np.int64)
+
+
+# The correction factors of an area ('pm2.5 correction factors'), compiled so they can be applied to whole columns of readings.
+# For each sensor type the periods are turned into sorted boundaries, and each interval between boundaries gets the first period (in list order)
+# that covers it -- the one applyCorrectionFactor would stop at.  A reading's factor is then found with np.searchsorted on its time.
+class CorrectionEngine:
+    def __init__(self, factors):
+        self.factors = factors
+        self.tables = {sensor_type: self.compileFactors(rows) for sensor_type, rows in factors.items()}
+
+    @staticmethod
+    def compileFactors(rows):
+        periods = [i for i in range(len(rows)) if not (isinstance(rows[i]['starttime'], str) and (rows[i]['starttime'] == "default"))]
+        defaults = [i for i in range(len(rows)) if i not in periods]
+        # like applyCorrectionFactor, the last "default" row is the one that gets used
+        default_idx = defaults[-1] if len(defaults) > 0 else -1
+
+        starts = datetimesToNanoseconds([rows[i]['starttime'] for i in periods]) if len(periods) > 0 else np.empty(0, dtype=np.int64)
+        ends = datetimesToNanoseconds([rows[i]['endtime'] for i in periods]) if len(periods) > 0 else np.empty(0, dtype=np.int64)
+        boundaries = np.unique(np.concatenate((starts, ends)))
+        # readings after the last boundary (or before the first) are not in any period
+        interval_rows = np.full(boundaries.shape[0], default_idx)
+        for k in range(boundaries.shape[0] - 1):
+            covering = np.nonzero((starts <= boundaries[k]) & (ends > boundaries[k]))[0]
+            if covering.shape[0] > 0:
+                interval_rows[k] = periods[covering[0]]
+
+        return {
+            'boundaries': boundaries,
+            'interval rows': interval_rows,
+            'default': default_idx,
+            'slope': np.array([float(row['slope']) for row in rows]),
+            'humidslope': np.array([float(row.get('humidslope', 0.0)) for row in rows]),
+            'intercept': np.array([float(row['intercept']) for row in rows]),
+            'note': np.array([row['note'] for row in rows], dtype=object)
+        }
+
+    # row of the factor list used for each of the times (nanoseconds), -1 for none
+    @staticmethod
+    def findRows(table, times):
+        interval = np.searchsorted(table['boundaries'], times, side='right') - 1
+        rows = table['interval rows'][np.clip(interval, 0, None)] if table['boundaries'].shape[0] > 0 else np.full(times.shape[0], table['default'])
+        return np.where(interval >= 0, rows, table['default'])
+
+    # same result as applyCorrectionFactor(..., status=True) for each reading, returned as an array of corrected values and an array of notes
+    # sensor_sources is used for the readings with no sensor type
+    def apply(self, data_timestamps, pm2_5, humidity, sensor_types, sensor_sources=None):
+        pm2_5 = np.asarray(pm2_5, dtype=float)
+        humidity = np.broadcast_to(np.asarray(humidity, dtype=float), pm2_5.shape)
+        sensor_types = pd.Series(np.broadcast_to(np.asarray(sensor_types, dtype=object), pm2_5.shape), dtype=object)
+        if sensor_sources is not None:
+            sensor_sources = pd.Series(np.broadcast_to(np.asarray(sensor_sources, dtype=object), pm2_5.shape), dtype=object)
+            sensor_types = sensor_types.where(pd.notnull(sensor_types), sensor_sources.map(SOURCE_SENSOR_TYPES))
+
+        values = pm2_5.copy()
+        notes = np.full(pm2_5.shape[0], "no correction", dtype=object)
+        type_codes, types = pd.factorize(sensor_types)
+        if types.shape[0] == 0:
+            return values, notes
+        times = datetimesToNanoseconds(data_timestamps)
+        for code in range(types.shape[0]):
+            if types[code] in self.tables:
+                table = self.tables[types[code]]
+            elif "default" in self.tables:
+                table = self.tables["default"]
+            elif "0000" in self.tables:
+                table = self.tables["0000"]
+            else:
+                continue
+            readings = np.nonzero(type_codes == code)[0]
+            rows = self.findRows(table, times[readings])
+            readings, rows = readings[rows >= 0], rows[rows >= 0]
+            values[readings] = np.maximum(pm2_5[readings]*table['slope'][rows] + humidity[readings]*table['humidslope'][rows] + table['intercept'][rows], 0.0)
+            notes[readings] = table['note'][rows]
+        return values, notes
+
+
+# compiled version of an area's 'pm2.5 correction factors' -- the one made when the region info was loaded, or a new one for factors from elsewhere
+def getCorrectionEngine(factors):
+    engines = getattr(get_all_region_info, 'correction_engines', {})
+    if id(factors) in engines:
+        return engines[id(factors)]
+    return CorrectionEngine(factors)
+
+
 def getLengthScalesForTime(length_scales_array, datetime):
     default_idx = -1
     for i in range(len(length_scales_array)):
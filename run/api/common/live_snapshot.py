@@ -0,0 +1,252 @@
+# In-process snapshot of the latest reading of every sensor, for getLiveSensors.
+# Rather than a query per request (the latest time per device over the last hour, joined back to the readings), the last hour of readings
+# is kept in memory and a background thread adds the readings newer than the watermark (the newest reading it has, less an overlap for
+# readings that arrive late) every LIVE_REFRESH_SECONDS.  After each refresh the latest reading of each sensor is picked out, and its
+# outlier flag (median/MAD of the area's readings in the last hour, as filterUpperLowerBoundsForArea does) and corrected value are computed,
+# so a request only selects the rows of its areas and sources.
+# Each refresh that changes the response gets a new version, the refresh time in milliseconds (so the versions of different instances
+# can be compared too), and each sensor keeps the version in which its record last changed: a client that has the version of an earlier
+# response asks for the sensors changed since (sensors that stop reporting aren't in the changes; they are dropped when their reading is
+# older than the window), and the version is in the ETag, so an unchanged response is a 304.
+# The snapshot needs the label column of the telemetry table to tell the areas apart.
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+import common.jsonutils
+import common.telemetry_cache
+import common.utils
+
+# turned off with LIVE_SNAPSHOT: False in the config file (getLiveSensors then queries the telemetry on every request)
+LIVE_SNAPSHOT = True
+# seconds between refreshes (LIVE_REFRESH_SECONDS)
+LIVE_REFRESH_SECONDS = 60
+# sensors whose latest reading is older than this are not live (LIVE_WINDOW_MINUTES)
+LIVE_WINDOW_MINUTES = 60
+# readings this much older than the watermark are asked for again, in case they arrived late (LIVE_OVERLAP_SECONDS)
+LIVE_OVERLAP_SECONDS = 300
+
+# (apply correction, flag outliers) combinations of getLiveSensors
+RECORD_VARIANTS = [(False, False), (False, True), (True, False), (True, True)]
+
+# held while the worker's snapshot is made, so requests that come in together make (and start) only one
+snapshot_lock = threading.Lock()
+
+
+# the readings with since < time (and window_start <= time) of all areas, with the columns of submit_sensor_query and the label
+def fetchLiveReadings(since, window_start):
+    with open('common/db_table_headings.json') as json_file:
+        db_table_headings = json.load(json_file)
+    time_string = db_table_headings['time']
+    backend = common.utils.getTelemetryBackend()
+    query = f"""SELECT {common.utils.sensorQueryColumns(db_table_headings)}, {db_table_headings['label']} AS areamodel FROM {backend.table("telemetry.telemetry")}
+                WHERE ({time_string} > @since) AND ({time_string} >= @window_start)"""
+    return backend.query(query, [("since", "TIMESTAMP", since), ("window_start", "TIMESTAMP", window_start)])
+
+
+class LiveSnapshot:
+    # fetch(since, window_start) returns the readings with since < time (see fetchLiveReadings), and get_area_models() the area models
+    # (common.jsonutils.get_all_region_info if not given)
+    def __init__(self, fetch, refresh_seconds=LIVE_REFRESH_SECONDS, window_minutes=LIVE_WINDOW_MINUTES, overlap_seconds=LIVE_OVERLAP_SECONDS, get_area_models=None):
+        self.fetch = fetch
+        self.get_area_models = get_area_models
+        self.refresh_seconds = refresh_seconds
+        self.window = timedelta(minutes=window_minutes)
+        self.overlap = timedelta(seconds=overlap_seconds)
+        # the readings of the window, the watermark, and the latest reading of each sensor with its records.  Replaced as a whole by
+        # each refresh, so requests never see half of one
+        self.state = None
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self.refresh_seconds_total = 0.
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.thread = None
+        # called with (version, previous version) by the refresh thread when the version changes (see common.live_stream)
+        self.listeners = []
+
+    def addListener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='live-snapshot', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception:
+                with self.lock:
+                    self.failed_refreshes += 1
+                logging.exception('live snapshot refresh failed')
+
+    def refresh(self, now=None):
+        with self.refresh_lock:
+            begin = time.perf_counter()
+            now = common.telemetry_cache.toUTCTimestamp(datetime.now(timezone.utc) if now is None else now)
+            window_start = now - self.window
+            state = self.state
+            if state is None:
+                readings, since = None, window_start
+            else:
+                readings, since = state["readings"], max(window_start, state["watermark"] - self.overlap)
+
+            new_readings = self.fetch(since, window_start)
+            if not new_readings.empty:
+                new_readings = new_readings.assign(time=pd.to_datetime(new_readings['time'], utc=True))
+            # the fetch brings back all of the readings after since, so they replace the ones already here
+            if readings is not None:
+                readings = readings[(readings['time'] >= window_start) & (readings['time'] <= since)]
+            frames = [frame for frame in [readings, new_readings] if (frame is not None) and not frame.empty]
+            if len(frames) > 0:
+                readings = pd.concat(frames, ignore_index=True).sort_values('time', kind='mergesort').reset_index(drop=True)
+            else:
+                readings = pd.DataFrame(columns=new_readings.columns)
+            watermark = readings['time'].max() if not readings.empty else (window_start if state is None else state["watermark"])
+
+            area_models = common.jsonutils.get_all_region_info() if self.get_area_models is None else self.get_area_models()
+            self.state = self.buildState(readings, watermark, now, area_models)
+            with self.lock:
+                self.refreshes += 1
+                self.refresh_seconds_total += time.perf_counter() - begin
+                listeners = list(self.listeners)
+            if (state is not None) and (self.state["version"] != state["version"]):
+                for listener in listeners:
+                    try:
+                        listener(self.state["version"], state["version"])
+                    except Exception:
+                        logging.exception('live snapshot listener failed')
+
+    # latest reading of each sensor in the areas we know, with its outlier flag, corrected value and the response records
+    def buildState(self, readings, watermark, now, area_models):
+        readings = readings[readings['areamodel'].isin(list(area_models.keys()))] if not readings.empty else readings
+        latest = readings.drop_duplicates('id', keep='last').reset_index(drop=True)
+        pm2_5 = latest['pm2_5'].to_numpy(dtype=float)
+        flags = np.full(latest.shape[0], None, dtype=object)
+        corrected_pm2_5 = pm2_5.copy()
+        correction_notes = np.full(latest.shape[0], "no correction", dtype=object)
+        window_start = now - self.window
+
+        for area_name, rows in latest.groupby('areamodel').indices.items():
+            area_model = area_models[area_name]
+            # outlier bounds from all of the area's readings in the window, as filterUpperLowerBoundsForArea gets them from the telemetry table
+            bbox_array = np.array(area_model['boundingbox'])[:, 1:3]
+            lo, hi = bbox_array.min(axis=0), bbox_array.max(axis=0)
+            area_readings = readings[readings['areamodel'] == area_name]
+            median, MAD, count = common.utils.medianDeviationOfFrame(common.utils.filterTelemetry(
+                area_readings, lo[0], hi[0], lo[1], hi[1], window_start, now, -np.inf, common.utils.MAX_ALLOWED_PM2_5))
+            lo_filter = max(median - common.utils.DEFAULT_OUTLIER_LEVEL*MAD, 0.0)
+            hi_filter = min(max(median + common.utils.DEFAULT_OUTLIER_LEVEL*MAD, common.utils.MIN_OUTLIER_LEVEL), common.utils.MAX_ALLOWED_PM2_5)
+            area_pm2_5 = pm2_5[rows]
+            flags[rows] = np.where(area_pm2_5 < 0.0, "No data",
+                                   np.where((area_pm2_5 < lo_filter) | (area_pm2_5 > hi_filter) | np.isnan(area_pm2_5), "Outlier", None))
+
+            # humidity filled in with the mean of the area's sensors
+            humidity = latest['humidity'].iloc[rows]
+            mean_humidity = humidity.mean() if pd.notnull(humidity).any() else area_model["defaulthumidity"]
+            correction_engine = common.jsonutils.getCorrectionEngine(area_model['pm2.5 correction factors'])
+            corrected_pm2_5[rows], correction_notes[rows] = correction_engine.apply(
+                latest['time'].iloc[rows], latest['pm2_5'].iloc[rows], humidity.fillna(mean_humidity), latest['sensormodel'].iloc[rows], latest['sensorsource'].iloc[rows])
+
+        records = {}
+        for apply_correction, flag_outliers in RECORD_VARIANTS:
+            values = corrected_pm2_5 if apply_correction else pm2_5
+            variant_records = []
+            for i, row in enumerate(latest.itertuples(index=False)):
+                status = [flags[i]] if (flag_outliers and flags[i] is not None) else []
+                status.append(correction_notes[i] if apply_correction else "No correction")
+                variant_records.append(common.utils.dict_nantonull({
+                    "Sensor ID": str(row.id),
+                    "Latitude": row.lat,
+                    "Longitude": row.lon,
+                    "Time": row.time,
+                    "Humidity": row.humidity,
+                    "PM2_5": values[i],
+                    "Sensor model": row.sensormodel,
+                    "Sensor source": row.sensorsource,
+                    "Status": status
+                }))
+            records[(apply_correction, flag_outliers)] = variant_records
+
+        # the version of each sensor's record (any of the variants) and of the snapshot
+        previous = self.state
+        version = 0 if previous is None else previous["version"]
+        previous_changes = {} if previous is None else {
+            sensor_id: (changed, [previous["records"][variant][i] for variant in RECORD_VARIANTS])
+            for i, (sensor_id, changed) in enumerate(zip(previous["latest"]['id'], previous["changed"]))}
+        new_version = max(version + 1, int(now.timestamp()*1000))
+        changed = np.full(latest.shape[0], new_version, dtype=np.int64)
+        for i, sensor_id in enumerate(latest['id']):
+            if sensor_id in previous_changes:
+                previous_changed, previous_records = previous_changes[sensor_id]
+                if previous_records == [records[variant][i] for variant in RECORD_VARIANTS]:
+                    changed[i] = previous_changed
+        if (previous is None) or (changed == new_version).any() or (len(previous_changes) != latest.shape[0]):
+            version = new_version
+
+        return {"readings": readings, "watermark": watermark, "refreshed": now, "latest": latest, "records": records, "changed": changed, "version": version,
+                "area_models": area_models}
+
+    # snapshot version and records of the live sensors of the areas (and source), as getLiveSensors returns them.  since is a version
+    # (only the sensors changed after it) or a time (only the sensors with a later reading)
+    def sensors(self, areas, sensor_source, apply_correction, flag_outliers, area_models=None, since=None, now=None):
+        if self.state is None:
+            self.refresh()
+        state = self.state
+        area_models = state["area_models"] if area_models is None else area_models
+        latest = state["latest"]
+        if latest.empty:
+            return state["version"], []
+        now = common.telemetry_cache.toUTCTimestamp(datetime.now(timezone.utc) if now is None else now)
+        keep = latest['areamodel'].isin(areas).to_numpy() & (latest['time'] >= now - self.window).to_numpy()
+        if isinstance(since, int):
+            keep &= state["changed"] > since
+        elif since is not None:
+            keep &= (latest['time'] > common.telemetry_cache.toUTCTimestamp(since)).to_numpy()
+        if sensor_source != "all":
+            # areas whose sources are organized by table don't filter on the source column
+            source_areas = [area for area in areas if "sourcetablemap" not in area_models.get(area, {})]
+            keep &= ~latest['areamodel'].isin(source_areas).to_numpy() | (latest['sensorsource'] == sensor_source).to_numpy()
+        variant_records = state["records"][(bool(apply_correction), bool(flag_outliers))]
+        return state["version"], [variant_records[i] for i in np.flatnonzero(keep)]
+
+    def stats(self):
+        state = self.state
+        with self.lock:
+            return {
+                "readings": None if state is None else len(state["readings"]),
+                "sensors": None if state is None else len(state["latest"]),
+                "version": None if state is None else state["version"],
+                "watermark": None if state is None else str(state["watermark"]),
+                "refreshed": None if state is None else str(state["refreshed"]),
+                "refreshes": self.refreshes,
+                "failed refreshes": self.failed_refreshes,
+                "mean refresh seconds": (self.refresh_seconds_total/self.refreshes) if self.refreshes > 0 else None
+            }
+
+
+# the snapshot shared by the requests in this worker (its refresh thread starts with the first request), or None if it is turned off
+# or the telemetry table has no label column
+def getLiveSnapshot():
+    if not hasattr(getLiveSnapshot, 'snapshot'):
+        with snapshot_lock:
+            if not hasattr(getLiveSnapshot, 'snapshot'):
+                config = common.utils.getConfigData()
+                with open('common/db_table_headings.json') as json_file:
+                    db_table_headings = json.load(json_file)
+                if config.get('LIVE_SNAPSHOT', LIVE_SNAPSHOT) and ("label" in db_table_headings):
+                    snapshot = LiveSnapshot(fetchLiveReadings, config.get('LIVE_REFRESH_SECONDS', LIVE_REFRESH_SECONDS),
+                                            config.get('LIVE_WINDOW_MINUTES', LIVE_WINDOW_MINUTES), config.get('LIVE_OVERLAP_SECONDS', LIVE_OVERLAP_SECONDS))
+                    snapshot.start()
+                    getLiveSnapshot.snapshot = snapshot
+                else:
+                    getLiveSnapshot.snapshot = None
+    return getLiveSnapshot.snapshot
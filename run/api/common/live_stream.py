@@ -0,0 +1,202 @@
+# Push stream of live sensor updates (streamLiveSensors), fanned out from the live snapshot.
+# The snapshot's refresh thread publishes each new version here: for every distinct subscription (areas, source, correction, flags, format)
+# the sensors that changed are picked out and serialized once, however many clients share the subscription, and the message is handed to
+# the subscribers' queues.  A stream only waits on its queue, so subscribers cost no queries and no serialization of their own.
+# A subscriber that falls LIVE_STREAM_QUEUE_SIZE messages behind is closed, and streams end after LIVE_STREAM_SECONDS; clients reconnect
+# with the last version they got (the SSE Last-Event-ID, or since) and get the changes since then.
+import queue
+import threading
+import time
+from flask import json as flask_json
+import common.live_snapshot
+import common.utils
+
+# a stream ends after this long (LIVE_STREAM_SECONDS in the config file), so the connections are spread over new instances as they scale
+LIVE_STREAM_SECONDS = 600
+# a comment (SSE) or empty line (NDJSON) is sent when nothing has changed for this long, to keep proxies from closing the connection
+LIVE_STREAM_KEEPALIVE_SECONDS = 15
+# messages a subscriber can fall behind before it is closed (LIVE_STREAM_QUEUE_SIZE)
+LIVE_STREAM_QUEUE_SIZE = 8
+# streams at once in a worker (LIVE_STREAM_MAX_SUBSCRIBERS), which is the limit of an instance (gunicorn --workers 1).  Each stream holds one
+# of the worker's threads while it is open, waiting on its queue.  The Dockerfile's gunicorn threads are these plus the API_REQUEST_SLOTS
+# (common.utils) that the rest of the API is kept to, so raise it along with the threads.  benchmarks/bench_live_stream.py checks the limit
+# through the endpoint, and benchmarks/bench_live_stream_fanout.py the fan-out to thousands of subscribers (many instances' worth)
+LIVE_STREAM_MAX_SUBSCRIBERS = 32
+
+STREAM_MIMETYPES = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+KEEPALIVE_MESSAGES = {"sse": ": keep-alive\n\n", "ndjson": "\n"}
+
+
+# JSON list of the records (the same records as getLiveSensors, with the keys sorted as jsonify does, also when published outside of a
+# request).  encoded keeps the JSON of each record by its id, so the subscriptions that share records (and the snapshot keeps one record
+# object per sensor and variant) serialize them once
+def encodeRecords(records, encoded=None):
+    if encoded is None:
+        return flask_json.dumps(records, sort_keys=True)
+    parts = []
+    for record in records:
+        if id(record) not in encoded:
+            encoded[id(record)] = (record, flask_json.dumps(record, sort_keys=True))
+        parts.append(encoded[id(record)][1])
+    return "[" + ", ".join(parts) + "]"
+
+
+# one message: the version and the records of the sensors that changed
+def encodeMessage(stream_format, version, records, encoded=None):
+    if stream_format == "sse":
+        return f"id: {version}\nevent: sensors\ndata: {encodeRecords(records, encoded)}\n\n"
+    return f'{{"sensors": {encodeRecords(records, encoded)}, "version": {version}}}\n'
+
+
+class Subscriber:
+    # key is (areas, sensor source, apply correction, flag outliers, format)
+    def __init__(self, key, queue_size):
+        self.key = key
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+
+
+class LiveStream:
+    def __init__(self, snapshot, stream_seconds=LIVE_STREAM_SECONDS, keepalive_seconds=LIVE_STREAM_KEEPALIVE_SECONDS,
+                 queue_size=LIVE_STREAM_QUEUE_SIZE, max_subscribers=LIVE_STREAM_MAX_SUBSCRIBERS):
+        self.snapshot = snapshot
+        self.stream_seconds = stream_seconds
+        self.keepalive_seconds = keepalive_seconds
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        # subscribers by key
+        self.subscribers = {}
+        # (version, message) of the whole list of each key, for the streams that start without since
+        self.full_messages = {}
+        self.num_subscribers = 0
+        self.published = 0
+        self.encoded = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.publish_seconds_total = 0.
+        self.lock = threading.Lock()
+        # one stream at a time serializes a whole list, so the streams that start together wait for it rather than all doing it
+        self.full_message_lock = threading.Lock()
+        snapshot.addListener(self.publish)
+
+    # a new subscriber, or None if the worker has as many streams as it takes
+    def subscribe(self, areas, sensor_source, apply_correction, flag_outliers, stream_format):
+        key = (tuple(areas), sensor_source, bool(apply_correction), bool(flag_outliers), stream_format)
+        with self.lock:
+            if self.num_subscribers >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(key, self.queue_size)
+            self.subscribers.setdefault(key, set()).add(subscriber)
+            self.num_subscribers += 1
+            return subscriber
+
+    # (any number of times: when the stream ends and when its response is closed)
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.key, set())
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+                self.num_subscribers -= 1
+                if len(subscribers) == 0:
+                    del self.subscribers[subscriber.key]
+                    self.full_messages.pop(subscriber.key, None)
+
+    # (snapshot listener) the changes from previous_version to version, to every subscriber
+    def publish(self, version, previous_version):
+        begin = time.perf_counter()
+        with self.lock:
+            subscribers = {key: list(key_subscribers) for key, key_subscribers in self.subscribers.items()}
+        encoded, delivered, dropped = 0, 0, 0
+        encoded_records = {}
+        for (areas, sensor_source, apply_correction, flag_outliers, stream_format), key_subscribers in subscribers.items():
+            records_version, records = self.snapshot.sensors(list(areas), sensor_source, apply_correction, flag_outliers, since=previous_version)
+            if len(records) == 0:
+                continue
+            message = encodeMessage(stream_format, records_version, records, encoded_records)
+            encoded += 1
+            for subscriber in key_subscribers:
+                try:
+                    subscriber.queue.put_nowait((records_version, message))
+                    delivered += 1
+                except queue.Full:
+                    subscriber.closed = True
+                    dropped += 1
+        with self.lock:
+            self.published += 1
+            self.encoded += encoded
+            self.delivered += delivered
+            self.dropped += dropped
+            self.publish_seconds_total += time.perf_counter() - begin
+
+    # the whole list of a subscription, serialized once for each version however many streams start with it
+    def fullMessage(self, key):
+        areas, sensor_source, apply_correction, flag_outliers, stream_format = key
+        with self.full_message_lock:
+            state = self.snapshot.state
+            with self.lock:
+                cached = self.full_messages.get(key)
+            if (cached is not None) and (state is not None) and (cached[0] == state["version"]):
+                return cached
+            version, records = self.snapshot.sensors(list(areas), sensor_source, apply_correction, flag_outliers)
+            message = (version, encodeMessage(stream_format, version, records))
+            with self.lock:
+                if key in self.subscribers:
+                    self.full_messages[key] = message
+            return message
+
+    # the messages of a stream: the sensors changed since (all of them if since is None) and then the changes of each new version, until the
+    # stream ends or the client goes away.  Unsubscribes at the end
+    def messages(self, subscriber, since=None):
+        areas, sensor_source, apply_correction, flag_outliers, stream_format = subscriber.key
+        try:
+            # the subscriber was added before this, so versions published in between are either in it or in the queue
+            if since is None:
+                version, message = self.fullMessage(subscriber.key)
+            else:
+                version, records = self.snapshot.sensors(list(areas), sensor_source, apply_correction, flag_outliers, since=since)
+                message = encodeMessage(stream_format, version, records)
+            yield message
+            deadline = time.monotonic() + self.stream_seconds
+            while (not subscriber.closed) and (time.monotonic() < deadline):
+                try:
+                    message_version, message = subscriber.queue.get(timeout=max(min(self.keepalive_seconds, deadline - time.monotonic()), 0.))
+                except queue.Empty:
+                    yield KEEPALIVE_MESSAGES[stream_format]
+                    continue
+                if message_version > version:
+                    version = message_version
+                    yield message
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "subscribers": self.num_subscribers,
+                "subscriptions": len(self.subscribers),
+                "published versions": self.published,
+                "messages encoded": self.encoded,
+                "messages delivered": self.delivered,
+                "dropped subscribers": self.dropped,
+                "mean publish seconds": (self.publish_seconds_total/self.published) if self.published > 0 else None
+            }
+
+
+# held while the worker's stream is made, so requests that come in together make only one (with one listener on the snapshot)
+stream_lock = threading.Lock()
+
+# the stream of this worker's live snapshot, or None if there is no snapshot
+def getLiveStream():
+    if not hasattr(getLiveStream, 'stream'):
+        with stream_lock:
+            if not hasattr(getLiveStream, 'stream'):
+                snapshot = common.live_snapshot.getLiveSnapshot()
+                if snapshot is not None:
+                    config = common.utils.getConfigData()
+                    getLiveStream.stream = LiveStream(snapshot, config.get('LIVE_STREAM_SECONDS', LIVE_STREAM_SECONDS),
+                                                      config.get('LIVE_STREAM_KEEPALIVE_SECONDS', LIVE_STREAM_KEEPALIVE_SECONDS),
+                                                      config.get('LIVE_STREAM_QUEUE_SIZE', LIVE_STREAM_QUEUE_SIZE),
+                                                      config.get('LIVE_STREAM_MAX_SUBSCRIBERS', LIVE_STREAM_MAX_SUBSCRIBERS))
+                else:
+                    getLiveStream.stream = None
+    return getLiveStream.stream
@@ -0,0 +1,106 @@
+# In-process cache of fitted gaussian models.
+# Building a model (createModel) means fetching the sensor data and doing the eigen decompositions, which is most of the cost of an estimate query.
+# Many queries ask for the same area and hours, so the fitted models are kept here (LRU, bounded by a memory budget) and repeat queries only run forward().
+#
+# The key is (area name, sensor window rounded to bins, length scales, hash of what determines the sensor set).  Windows that reach
+# into the recent past can still receive data, so those entries expire after a short while.
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# total size of the models kept in the cache
+MODEL_CACHE_BUDGET_BYTES = 512*1024*1024
+# sensor windows that end less than this long ago (hours) may still get new measurements...
+RECENT_WINDOW_HOURS = 1.0
+# ... so their models are only kept this long (seconds)
+RECENT_WINDOW_TTL = 300.
+
+
+class ModelCache:
+    def __init__(self, budget_bytes=MODEL_CACHE_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        # key -> (value, size in bytes, expiry time or None)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None) and (entry[2] is not None) and (entry[2] < time.time()):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # ttl in seconds, None for entries that only leave through LRU eviction
+    def put(self, key, value, size_bytes, ttl=None):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            # something this big would flush the whole cache
+            if size_bytes > self.budget_bytes:
+                return
+            while self.total_bytes + size_bytes > self.budget_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+            expiry = None if ttl is None else time.time() + ttl
+            self.entries[key] = (value, size_bytes, expiry)
+            self.total_bytes += size_bytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "budget bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit rate": (self.hits/lookups) if lookups > 0 else None,
+                "evictions": self.evictions
+            }
+
+    def _remove(self, key):
+        value, size_bytes, expiry = self.entries.pop(key)
+        self.total_bytes -= size_bytes
+
+
+def getModelCache():
+    if not hasattr(getModelCache, 'cache'):
+        getModelCache.cache = ModelCache()
+    return getModelCache.cache
+
+
+# everything that goes into the sensor query/screening besides the chunk's time window: the bounding box, the time window of the whole fetch
+# (the outlier bounds and the mean humidity of the corrections are computed over all of it, so the same chunk fetched as part of another
+# request can be screened differently), the filtering flags and the correction factors
+def sensorSetHash(bounding_box, data_window_lo, data_window_hi, outlier_filtering, apply_correction, correction_factors):
+    description = json.dumps([[round(float(v), 6) for v in bounding_box], data_window_lo.isoformat(), data_window_hi.isoformat(), bool(outlier_filtering),
+                              bool(apply_correction), correction_factors], sort_keys=True, default=str)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def modelKey(area_name, window_lo, window_hi, latlon_length_scale, elevation_length_scale, time_length_scale, sensor_set_hash):
+    return (area_name, window_lo.isoformat(), window_hi.isoformat(), float(latlon_length_scale), float(elevation_length_scale), float(time_length_scale), sensor_set_hash)
+
+
+# time to live for a model fit on data up to window_hi
+def modelTTL(window_hi, now):
+    if (now - window_hi).total_seconds() < RECENT_WINDOW_HOURS*3600.:
+        return RECENT_WINDOW_TTL
+    return None
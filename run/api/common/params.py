@@ -1,6 +1,7 @@
 import re
 from enum import Enum
 from datetime import datetime, time
+from flask_restful.inputs import datetime_from_iso8601
 import common.utils
 import common.jsonutils
 import numpy as np
@@ -43,6 +44,9 @@ class URL_PARAMS(str, Enum):
     IDENTIFIER = 'identifier'
     NICKNAME = "nickname"
     DEVICE = "device"
+    VARIANCE = "variance"
+    SINCE = "since"
+    FORMAT = "format"
 
     def __str__(self):
         return "'" + self.value + "'"
@@ -75,6 +79,11 @@ class PARAMS_HELP_MESSAGES(str, Enum):
     LATS = "Single value or list of lats. lats must be between -90, 90"
     LONS = "Single value or list of lons. lons must be between -180, 180"
     DEVICE = "The 12-digit device name, in all caps"
+    VARIANCE = f"Whether to compute the variance of the estimates (default true).  {URL_PARAMS.VARIANCE}=false skips it, which is much faster for large maps, and leaves Variance out of the response."
+    SINCE = f"Only the sensors whose latest reading changed since then: the X-Snapshot-Version header of an earlier response, or a time in ISO 8601 format (2020-01-01T00:00:00+00)."
+    SENSOR_DATA_FORMAT = "json (the default), ndjson (one JSON object per line), csv, arrow (Arrow IPC stream) or parquet.  ndjson and csv are streamed as the rows are read."
+    AGGREGATED_DATA_FORMAT = "json (the default), arrow (Arrow IPC stream) or parquet."
+    STREAM_FORMAT = "sse (server-sent events, the default) or ndjson (one JSON object per line)"
     NICKNAME = "The nickname. The name must be URL-encoded before being inserted into the query. Use a site like urlencoder.org to encode it. It can up to 128 digits alphanumeric or include spaces, ~, or - "
 
 
@@ -146,6 +155,33 @@ def bool_flag(value):
     if value == "0":
         return False
 
+# a snapshot version (an integer) or a time
+def since_param(value):
+    if value.isdigit():
+        return int(value)
+    try:
+        return datetime_from_iso8601(value)
+    except ValueError:
+        raise ValueError(PARAMS_HELP_MESSAGES.SINCE)
+
+def sensor_data_format_parse(value):
+    if value in ['json', 'ndjson', 'csv', 'arrow', 'parquet']:
+        return value
+    else:
+        raise ValueError(PARAMS_HELP_MESSAGES.SENSOR_DATA_FORMAT)
+
+def aggregated_data_format_parse(value):
+    if value in ['json', 'arrow', 'parquet']:
+        return value
+    else:
+        raise ValueError(PARAMS_HELP_MESSAGES.AGGREGATED_DATA_FORMAT)
+
+def stream_format_parse(value):
+    if value in ['sse', 'ndjson']:
+        return value
+    else:
+        raise ValueError(PARAMS_HELP_MESSAGES.STREAM_FORMAT)
+
 def str_lower(value):
     return value.lower()
 
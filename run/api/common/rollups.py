@@ -0,0 +1,232 @@
+# The aggregation queries of getTimeAggregatedData, and the hourly and daily rollups of the telemetry they use.
+# Each reading goes to its interval by integer arithmetic on its offset from @start (DIV(TIMESTAMP_DIFF(time, @start, SECOND), @interval*60)),
+# rather than by joining the readings with a table of intervals, which is a range join that gets slower with every interval.
+#
+# The rollup tables have a row per device and hour (telemetry.telemetry_hourly) or day (telemetry.telemetry_daily) with the count, sum, min and
+# max of the PM2.5 readings and the sum and count of the humidities (readings at or over MAX_ALLOWED_PM2_5 are left out, as the aggregation
+# query does), which is enough to get the mean, min and max of any interval made of whole hours or days exactly.
+# The rollups are built incrementally from the end of what is already there (the watermark) up to the hours that can't get any more readings,
+# the daily rollup from the hourly one.  Run it every hour or so (from run/api):
+#    python -m common.rollups
+#    python -m common.rollups --days 30
+# An aggregation whose intervals line up with the hours (or days) is answered from the coarsest rollup it lines up with, then the finer rollup
+# past that rollup's watermark, and the raw telemetry past the last watermark (the tail that hasn't been rolled up yet).
+import argparse
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+import cachetools
+import pandas as pd
+import common.telemetry_cache
+import common.utils
+
+# rollup tables, coarsest first: (table, minutes per row)
+ROLLUPS = [("telemetry.telemetry_daily", 24*60), ("telemetry.telemetry_hourly", 60)]
+# hours that ended less than this long ago can still get readings, so they aren't rolled up yet
+ROLLUP_LAG_HOURS = common.telemetry_cache.MUTABLE_PARTITION_HOURS
+# days of telemetry rolled up per query by the builder
+BUILD_DAYS_PER_QUERY = 1
+# the watermarks are looked up this often (seconds).  A watermark that is behind only means more of the raw telemetry is read
+ROLLUP_WATERMARK_TTL = 300
+
+GROUP_COLUMNS = "ID, sensormodel, sensorsource, areamodel"
+PARTIAL_COLUMNS = "pm2_5_count, pm2_5_sum, pm2_5_min, pm2_5_max, humidity_sum, humidity_count"
+# the aggregation functions of getTimeAggregatedData in terms of the rollup columns
+PARTIAL_FUNCTIONS = {
+    "mean": "SUM(pm2_5_sum)/NULLIF(SUM(pm2_5_count), 0)",
+    "min": "MIN(pm2_5_min)",
+    "max": "MAX(pm2_5_max)",
+}
+
+
+# the interval of the reading at time (0 for the one that starts at @start) and the last second of that interval (the "upper" column)
+def intervalNumber(backend, time):
+    return f"DIV({backend.timestampDiff(time, '@start', 'SECOND')}, @interval * 60)"
+
+def intervalUpper(backend, number):
+    return backend.timestampAdd("@start", f"@interval * 60 * (1 + {number}) - 1", "SECOND")
+
+
+# aggregation of the raw telemetry: tables_list are the queries of the areas (with the time bounds), sql_function AVG, MIN or MAX.
+# The intervals are the ones the interval table had: up to the one @end is in, each from its start to its last second (both included)
+def bucketAggregationQuery(backend, tables_list, sql_function, group_string):
+    return f"""
+        SELECT
+            CASE WHEN {sql_function}(pm2_5) IS NOT NULL
+                THEN {sql_function}(pm2_5)
+                ELSE 0
+                END AS PM2_5,
+            AVG(humidity) AS HUMIDITY,
+            upper {group_string}
+        FROM (
+            SELECT numbered.*, {intervalUpper(backend, "interval_number")} AS upper
+            FROM (
+                SELECT sensors.*, {intervalNumber(backend, "time")} AS interval_number
+                FROM ({' UNION ALL '.join(tables_list)}) sensors
+            ) numbered
+            WHERE interval_number >= 0 AND interval_number <= DIV({backend.timestampDiff("@end", "@start", "MINUTE")}, @interval)
+        ) intervals
+        WHERE time <= upper
+        GROUP BY upper {group_string}
+        ORDER BY upper"""
+
+
+# the telemetry columns of the rollups, with the names the aggregation query uses.  The rollups need the source and label columns
+def rawColumns(db_table_headings):
+    if ("sensorsource" not in db_table_headings) or ("label" not in db_table_headings):
+        return None
+    return ", ".join([db_table_headings['id'] + " AS ID", db_table_headings['time'] + " AS time", db_table_headings['pm2_5'] + " AS pm2_5",
+                      db_table_headings['sensormodel'] + " AS sensormodel", db_table_headings['humidity'] + " AS humidity",
+                      db_table_headings['sensorsource'] + " AS sensorsource", db_table_headings['label'] + " AS areamodel"])
+
+
+# one row of rollup columns per reading, for the raw telemetry (already filtered, with the aggregation query's column names)
+def readingPartials(query):
+    return f"""SELECT time, {GROUP_COLUMNS}, 1 AS pm2_5_count, pm2_5 AS pm2_5_sum, pm2_5 AS pm2_5_min, pm2_5 AS pm2_5_max,
+               humidity AS humidity_sum, CASE WHEN humidity IS NULL THEN 0 ELSE 1 END AS humidity_count FROM {query}"""
+
+
+# end of the last row of the rollup (None if it is empty or not there)
+def rollupWatermark(backend, table, minutes):
+    if not backend.hasTable(table):
+        return None
+    last = backend.query(f"SELECT MAX(time) AS last FROM {backend.table(table)}")["last"]
+    if last.empty or pd.isnull(last.iloc[0]):
+        return None
+    return common.telemetry_cache.toUTCTimestamp(last.iloc[0]) + timedelta(minutes=minutes)
+
+
+# watermarks of the rollups {table: watermark or None}, shared by the requests for ROLLUP_WATERMARK_TTL
+def getRollupWatermarks(backend):
+    if not hasattr(getRollupWatermarks, 'cache'):
+        getRollupWatermarks.cache = cachetools.TTLCache(maxsize=1, ttl=ROLLUP_WATERMARK_TTL)
+        getRollupWatermarks.lock = threading.Lock()
+    with getRollupWatermarks.lock:
+        if 'watermarks' not in getRollupWatermarks.cache:
+            getRollupWatermarks.cache['watermarks'] = {table: rollupWatermark(backend, table, minutes) for table, minutes in ROLLUPS}
+        return getRollupWatermarks.cache['watermarks']
+
+
+# the parts of an aggregation over [start, stop) in intervals of interval minutes: [(table, lo, hi)] from the rollups, and where the raw
+# telemetry starts (stop if it isn't needed).  No rollup parts if the intervals don't line up with any of the rollups, or the function
+# can't be computed from them
+def rollupParts(backend, start, stop, interval, function):
+    start, stop = common.telemetry_cache.toUTCTimestamp(start), common.telemetry_cache.toUTCTimestamp(stop)
+    if function not in PARTIAL_FUNCTIONS:
+        return [], start
+    watermarks = None
+    parts = []
+    lo = start
+    for table, minutes in ROLLUPS:
+        # the rollup rows have to fall inside the intervals, so the intervals start on a row and are whole rows long
+        if (interval % minutes != 0) or (start != start.floor(f'{minutes}min')):
+            continue
+        if watermarks is None:
+            watermarks = getRollupWatermarks(backend)
+        if watermarks.get(table) is None:
+            continue
+        hi = min(watermarks[table], stop)
+        if hi > lo:
+            parts.append((table, lo, hi))
+            lo = hi
+    return parts, lo
+
+
+# the aggregation query from the rollup parts and the raw telemetry tail.  area_queries are the raw telemetry queries of the areas (with the
+# aggregation query's column names and filters, but no time bounds) and area_filters the same filters for the rollup rows.
+# Returns the query (with the same columns as the raw aggregation query) and its parameters, besides @start and @interval
+def aggregationQuery(backend, parts, raw_lo, stop, area_queries, area_filters, function, group_string):
+    partials = []
+    parameters = []
+    for i, (table, lo, hi) in enumerate(parts):
+        for area_filter in area_filters:
+            partials.append(f"SELECT time, {GROUP_COLUMNS}, {PARTIAL_COLUMNS} FROM {backend.table(table)} WHERE time >= @lo{i} AND time < @hi{i}{area_filter}")
+        parameters += [(f"lo{i}", "TIMESTAMP", lo), (f"hi{i}", "TIMESTAMP", hi)]
+    if raw_lo < stop:
+        for area_query in area_queries:
+            partials.append(readingPartials(f"({area_query}) WHERE time >= @raw_lo AND time < @stop"))
+        parameters += [("raw_lo", "TIMESTAMP", raw_lo), ("stop", "TIMESTAMP", stop)]
+
+    pm2_5_string = PARTIAL_FUNCTIONS[function]
+    query = f"""
+        SELECT
+            CASE WHEN {pm2_5_string} IS NOT NULL
+                THEN {pm2_5_string}
+                ELSE 0
+                END AS PM2_5,
+            SUM(humidity_sum)/NULLIF(SUM(humidity_count), 0) AS HUMIDITY,
+            upper {group_string}
+        FROM (
+            SELECT partials.*, {intervalUpper(backend, intervalNumber(backend, "time"))} AS upper
+            FROM ({' UNION ALL '.join(partials)}) partials
+        ) buckets
+        GROUP BY upper {group_string}
+        ORDER BY upper"""
+    return query, parameters
+
+
+# roll up the rows of the source query with lo <= time < hi into the table
+def rollUp(backend, table, minutes, source_query, lo, hi):
+    unit = "DAY" if minutes == 24*60 else "HOUR"
+    query = f"""SELECT {backend.timestampTrunc('time', unit)} AS time, {GROUP_COLUMNS}, {source_query['columns']}
+                FROM ({source_query['rows']}) readings WHERE time >= @lo AND time < @hi
+                GROUP BY 1, {GROUP_COLUMNS}"""
+    df = backend.query(query, [("lo", "TIMESTAMP", lo), ("hi", "TIMESTAMP", hi)])
+    print(f"{table} {lo} - {hi}: {len(df)} rows")
+    if not df.empty:
+        backend.appendTable(table, df, lo.strftime('%Y%m%d%H'))
+
+
+# bring the rollups up to date (at most max_days days of telemetry in this run)
+def buildRollups(backend, max_days=None, now=None):
+    with open('common/db_table_headings.json') as json_file:
+        db_table_headings = json.load(json_file)
+    columns = rawColumns(db_table_headings)
+    if columns is None:
+        print("the rollups need the sensorsource and label columns")
+        return
+    (daily_table, daily_minutes), (hourly_table, hourly_minutes) = ROLLUPS
+    now = common.telemetry_cache.toUTCTimestamp(datetime.now(timezone.utc) if now is None else now)
+    raw_table = backend.table("telemetry.telemetry")
+
+    # hourly, from the raw telemetry (from the first day of telemetry if the rollup is empty)
+    lo = rollupWatermark(backend, hourly_table, hourly_minutes)
+    if lo is None:
+        first = backend.query(f"SELECT MIN({db_table_headings['time']}) AS first FROM {raw_table}")["first"]
+        if first.empty or pd.isnull(first.iloc[0]):
+            return
+        lo = common.telemetry_cache.toUTCTimestamp(first.iloc[0]).floor('D')
+    hi = (now - timedelta(hours=ROLLUP_LAG_HOURS)).floor('60min')
+    if max_days is not None:
+        hi = min(hi, lo + timedelta(days=max_days))
+    raw_query = {"rows": f"SELECT {columns} FROM {raw_table} WHERE {db_table_headings['pm2_5']} < {common.utils.MAX_ALLOWED_PM2_5}",
+                 "columns": "COUNT(pm2_5) AS pm2_5_count, SUM(pm2_5) AS pm2_5_sum, MIN(pm2_5) AS pm2_5_min, MAX(pm2_5) AS pm2_5_max, "
+                            "SUM(humidity) AS humidity_sum, COUNT(humidity) AS humidity_count"}
+    while lo < hi:
+        chunk_hi = min(lo + timedelta(days=BUILD_DAYS_PER_QUERY), hi)
+        rollUp(backend, hourly_table, hourly_minutes, raw_query, lo, chunk_hi)
+        lo = chunk_hi
+
+    # daily, from the hourly rollup, for the days it has all of
+    hourly_watermark = rollupWatermark(backend, hourly_table, hourly_minutes)
+    if hourly_watermark is None:
+        return
+    lo = rollupWatermark(backend, daily_table, daily_minutes)
+    if lo is None:
+        lo = common.telemetry_cache.toUTCTimestamp(backend.query(f"SELECT MIN(time) AS first FROM {backend.table(hourly_table)}")["first"].iloc[0]).floor('D')
+    hourly_query = {"rows": f"SELECT * FROM {backend.table(hourly_table)}",
+                    "columns": "SUM(pm2_5_count) AS pm2_5_count, SUM(pm2_5_sum) AS pm2_5_sum, MIN(pm2_5_min) AS pm2_5_min, MAX(pm2_5_max) AS pm2_5_max, "
+                               "SUM(humidity_sum) AS humidity_sum, SUM(humidity_count) AS humidity_count"}
+    hi = hourly_watermark.floor('D')
+    while lo < hi:
+        # (a day is 24 rows of the hourly rollup per device, so more days go in each query)
+        chunk_hi = min(lo + timedelta(days=BUILD_DAYS_PER_QUERY*24), hi)
+        rollUp(backend, daily_table, daily_minutes, hourly_query, lo, chunk_hi)
+        lo = chunk_hi
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bring the hourly and daily telemetry rollups up to date")
+    parser.add_argument('--days', type=int, default=None, help='at most this many days of telemetry in this run')
+    args = parser.parse_args()
+    buildRollups(common.utils.getTelemetryBackend(), args.days)
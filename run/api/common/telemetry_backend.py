@@ -0,0 +1,253 @@
+# Where the telemetry queries run.
+# The sensor, live sensor, aggregation, outlier statistics and query size queries are built by the resources and common.utils, with the columns
+# from db_table_headings.json, and run by a backend: BigQuery (the production tables), or DuckDB over a local copy of the tables in Parquet files,
+# so the API can run against a local data set (load tests, profiling, no network) or serve hot regions from a local columnar store.
+# The SQL is written so it runs on both; the few things the dialects spell differently (timestamp arithmetic, integer series, percentiles)
+# come from the backend.  Query parameters are (name, type, value), referred to as @name in the SQL, with the BigQuery types.
+#
+# The local data set is one directory per table, {directory}/{dataset}/{table}/*.parquet (e.g. telemetry/telemetry and telemetry/statistics),
+# with the columns of the BigQuery table, except that the GEOGRAPHY column is stored as Latitude/Longitude columns.  To copy part of the
+# BigQuery tables (from run/api):
+#    python -m common.telemetry_backend directory start_day end_day [labels]
+import glob
+import json
+import os
+import re
+import sys
+import threading
+from google.cloud import bigquery
+import google.api_core.exceptions
+import pandas as pd
+
+# can be changed with TELEMETRY_BACKEND in the config file: "bigquery" or "duckdb"
+TELEMETRY_BACKEND = "bigquery"
+# the local data set of the duckdb backend (TELEMETRY_LOCAL_DIR)
+TELEMETRY_LOCAL_DIR = 'local_telemetry'
+# the telemetry table's location column, which is a GEOGRAPHY in BigQuery and Latitude/Longitude in the Parquet files
+GEOGRAPHY_COLUMN = 'GPS'
+
+PARAMETER_PATTERN = re.compile(r'@(\w+)')
+SECONDS = {"SECOND": 1, "MINUTE": 60, "HOUR": 3600, "DAY": 86400}
+# rows in each page of queryPages (DuckDB rounds it to its 2048 row vectors, and the BigQuery Storage API uses its own stream blocks)
+PAGE_ROWS = 50000
+
+
+class BigQueryBackend:
+    # get_client() returns the BigQuery client, read_result(query_job) the results as a DataFrame, read_pages(query_job, page_rows) the
+    # results as DataFrames of about page_rows rows and read_arrow(query_job) the results as an Arrow table (common.utils passes its own)
+    def __init__(self, get_client, read_result, read_pages, read_arrow):
+        self.get_client = get_client
+        self.read_result = read_result
+        self.read_pages = read_pages
+        self.read_arrow = read_arrow
+
+    def query(self, query, parameters=()):
+        return self.read_result(self.submit(query, parameters))
+
+    # the results one page at a time, for responses that are streamed as they are read
+    def queryPages(self, query, parameters=(), page_rows=PAGE_ROWS):
+        return self.read_pages(self.submit(query, parameters), page_rows)
+
+    # the results as an Arrow table, for responses in a columnar format
+    def queryArrow(self, query, parameters=()):
+        return self.read_arrow(self.submit(query, parameters))
+
+    def submit(self, query, parameters):
+        job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter(name, type, value) for name, type, value in parameters])
+        return self.get_client().query(query, job_config=job_config)
+
+    def table(self, name):
+        return f"`{name}`"
+
+    def hasTable(self, name):
+        try:
+            self.get_client().get_table(name)
+            return True
+        except google.api_core.exceptions.NotFound:
+            return False
+
+    # append the rows of the DataFrame to the table (created, partitioned by day of the time column, if it isn't there yet).
+    # partition names the rows for the local backend, which keeps them in a file of their own
+    def appendTable(self, name, df, partition):
+        job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+                                            time_partitioning=bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="time"))
+        self.get_client().load_table_from_dataframe(df, name, job_config=job_config).result()
+
+    def timestampAdd(self, timestamp, amount, unit):
+        return f"TIMESTAMP_ADD({timestamp}, INTERVAL {amount} {unit})"
+
+    # whole units from earlier to later (truncated, like TIMESTAMP_DIFF)
+    def timestampDiff(self, later, earlier, unit):
+        return f"TIMESTAMP_DIFF({later}, {earlier}, {unit})"
+
+    def timestampTrunc(self, timestamp, unit):
+        return f"TIMESTAMP_TRUNC({timestamp}, {unit})"
+
+    # FROM item with one row per integer lo..hi (both included), in the column alias
+    def integerSeries(self, lo, hi, alias):
+        return f"UNNEST(GENERATE_ARRAY({lo}, {hi})) AS {alias}"
+
+    # PERCENTILE_DISC over all the rows
+    def percentileDisc(self, value, percentile):
+        return f"PERCENTILE_DISC({value}, {percentile}) OVER()"
+
+    def stats(self):
+        return {"backend": "bigquery"}
+
+
+class DuckDBBackend:
+    def __init__(self, directory):
+        import duckdb
+        self.directory = directory
+        self.connection = duckdb.connect()
+        self.connection.execute("SET TimeZone = 'UTC'")
+        # the BigQuery functions used by the db_table_headings.json columns and the queries, on the Latitude/Longitude struct
+        self.connection.execute("CREATE MACRO ST_X(point) AS point.x")
+        self.connection.execute("CREATE MACRO ST_Y(point) AS point.y")
+        self.connection.execute("CREATE MACRO DIV(a, b) AS CAST(trunc(a / b) AS BIGINT)")
+        self.tables = []
+        self.lock = threading.Lock()
+        self.queries = 0
+        for table_directory in sorted(glob.glob(os.path.join(directory, '*', '*'))):
+            if os.path.isdir(table_directory) and len(glob.glob(os.path.join(table_directory, '**', '*.parquet'), recursive=True)) > 0:
+                self.createView(table_directory)
+
+    def createView(self, table_directory):
+        dataset, table = os.path.basename(os.path.dirname(table_directory)), os.path.basename(table_directory)
+        files = os.path.join(table_directory, '**', '*.parquet').replace("'", "''")
+        source = f"read_parquet('{files}', union_by_name=true)"
+        columns = [row[0] for row in self.connection.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+        location = ""
+        if ('Latitude' in columns) and ('Longitude' in columns) and (GEOGRAPHY_COLUMN not in columns):
+            location = f", struct_pack(x := Longitude, y := Latitude) AS {GEOGRAPHY_COLUMN}"
+        self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset}"')
+        self.connection.execute(f'CREATE VIEW "{dataset}"."{table}" AS SELECT *{location} FROM {source}')
+        self.tables.append(f"{dataset}.{table}")
+
+    def query(self, query, parameters=()):
+        # a cursor is a connection of its own to the same database, so requests on different threads can query at once
+        cursor = self.connection.cursor()
+        try:
+            df = self.execute(cursor, query, parameters).df()
+        finally:
+            cursor.close()
+        return df
+
+    def queryPages(self, query, parameters=(), page_rows=PAGE_ROWS):
+        cursor = self.connection.cursor()
+        try:
+            self.execute(cursor, query, parameters)
+            while True:
+                df = cursor.fetch_df_chunk(max(page_rows // 2048, 1))
+                if df.empty:
+                    break
+                yield df
+        finally:
+            cursor.close()
+
+    def queryArrow(self, query, parameters=()):
+        cursor = self.connection.cursor()
+        try:
+            table = self.execute(cursor, query, parameters).fetch_arrow_table()
+        finally:
+            cursor.close()
+        return table
+
+    def execute(self, cursor, query, parameters):
+        values = {}
+        for name, type, value in parameters:
+            if value is None:
+                values[name] = None
+            elif type in ("TIMESTAMP", "DATETIME"):
+                value = pd.Timestamp(value)
+                values[name] = (value.tz_localize('UTC') if value.tzinfo is None else value.tz_convert('UTC')).to_pydatetime()
+            elif type in ("NUMERIC", "FLOAT64", "BIGNUMERIC"):
+                values[name] = float(value)
+            elif type == "INT64":
+                values[name] = int(value)
+            else:
+                values[name] = value
+        # only the parameters the query uses (BigQuery ignores the others, DuckDB doesn't)
+        used = set(PARAMETER_PATTERN.findall(query))
+        values = {name: value for name, value in values.items() if name in used}
+        cursor.execute(PARAMETER_PATTERN.sub(r'$\1', query), values)
+        with self.lock:
+            self.queries += 1
+        return cursor
+
+    def table(self, name):
+        return ".".join(f'"{part}"' for part in name.split("."))
+
+    # (tables written by another process since this one started get their view here)
+    def hasTable(self, name):
+        with self.lock:
+            if name not in self.tables:
+                table_directory = os.path.join(self.directory, *name.split("."))
+                if len(glob.glob(os.path.join(table_directory, '**', '*.parquet'), recursive=True)) > 0:
+                    self.createView(table_directory)
+            return name in self.tables
+
+    def appendTable(self, name, df, partition):
+        table_directory = os.path.join(self.directory, *name.split("."))
+        os.makedirs(table_directory, exist_ok=True)
+        filename = os.path.join(table_directory, f"{partition}.parquet")
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        df.to_parquet(tmp_filename, index=False)
+        os.replace(tmp_filename, filename)
+        self.hasTable(name)
+
+    def timestampAdd(self, timestamp, amount, unit):
+        return f"({timestamp} + to_seconds(CAST(({amount}) * {SECONDS[unit]} AS BIGINT)))"
+
+    def timestampDiff(self, later, earlier, unit):
+        return f"CAST(trunc((epoch_us({later}) - epoch_us({earlier})) / {SECONDS[unit]*1000000}) AS BIGINT)"
+
+    def timestampTrunc(self, timestamp, unit):
+        return f"date_trunc('{unit.lower()}', {timestamp})"
+
+    def integerSeries(self, lo, hi, alias):
+        return f"generate_series({lo}, {hi}) AS series({alias})"
+
+    # QUANTILE_DISC picks the same row as PERCENTILE_DISC for the median
+    def percentileDisc(self, value, percentile):
+        return f"quantile_disc({value}, {percentile}) OVER()"
+
+    def stats(self):
+        with self.lock:
+            return {"backend": "duckdb", "directory": self.directory, "tables": self.tables, "queries": self.queries}
+
+
+# copy the telemetry rows of [start_day, end_day) (of the labels, if any are given) and the statistics table from BigQuery to the local data set,
+# one Parquet file per day
+def exportTelemetry(directory, start_day, end_day, labels=None):
+    client = bigquery.Client()
+    telemetry_directory = os.path.join(directory, 'telemetry', 'telemetry')
+    os.makedirs(telemetry_directory, exist_ok=True)
+    with open('common/db_table_headings.json') as json_file:
+        db_table_headings = json.load(json_file)
+    time_string = db_table_headings['time']
+    label_string = "" if not labels else f" AND {db_table_headings['label']} IN UNNEST(@labels)"
+    day = pd.Timestamp(start_day, tz='UTC')
+    while day < pd.Timestamp(end_day, tz='UTC'):
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("lo", "TIMESTAMP", day.to_pydatetime()),
+            bigquery.ScalarQueryParameter("hi", "TIMESTAMP", (day + pd.Timedelta(days=1)).to_pydatetime()),
+            bigquery.ArrayQueryParameter("labels", "STRING", list(labels or []))])
+        query = f"""SELECT * EXCEPT ({GEOGRAPHY_COLUMN}), ST_Y({GEOGRAPHY_COLUMN}) AS Latitude, ST_X({GEOGRAPHY_COLUMN}) AS Longitude
+                    FROM `telemetry.telemetry` WHERE {time_string} >= @lo AND {time_string} < @hi{label_string}"""
+        df = client.query(query, job_config=job_config).to_dataframe()
+        print(f"{day.date()}: {len(df)} rows")
+        if not df.empty:
+            df.to_parquet(os.path.join(telemetry_directory, f"{day.strftime('%Y-%m-%d')}.parquet"), index=False)
+        day = day + pd.Timedelta(days=1)
+
+    statistics_directory = os.path.join(directory, 'telemetry', 'statistics')
+    os.makedirs(statistics_directory, exist_ok=True)
+    client.query("SELECT * FROM `telemetry.statistics`").to_dataframe().to_parquet(os.path.join(statistics_directory, 'statistics.parquet'), index=False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print("usage: python -m common.telemetry_backend directory start_day end_day [labels]")
+        sys.exit(1)
+    exportTelemetry(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4:])
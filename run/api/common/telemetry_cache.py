@@ -0,0 +1,189 @@
+# Read-through cache of telemetry on local disk.
+# Telemetry more than a few hours old doesn't change, and estimate/sensor data queries keep asking for the same areas and days.  So the rows
+# of each area label are kept as one Parquet file per day ({directory}/{label}/{YYYY-MM-DD}.parquet) and queries are answered from those files,
+# with BigQuery only asked for the days that aren't on disk yet and for the recent (still mutable) part of the query, which is never stored.
+# The files are whole days of the label (no bounding box or value filters), so one file serves every query that touches that day; the caller
+# applies its own filters.  Files are written to a temporary name and renamed, so several worker processes can share the directory.
+# When the files take more than the budget, the least recently used ones are deleted.  Concurrent queries that miss the same days wait for the
+# first one's fetch rather than each fetching the days from BigQuery.
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+
+# directory of the cache, set with TELEMETRY_CACHE_DIR in the config file.  Off (empty) by default: on Cloud Run /tmp is in memory, so the
+# files take the instance's RAM on top of the model cache and the live snapshot.  Point it at a mounted disk, or at /tmp with a budget the
+# instance's memory has room for
+TELEMETRY_CACHE_DIR = ''
+# total size of the Parquet files (TELEMETRY_CACHE_BUDGET_BYTES), which is also the memory they take when the directory is in memory
+TELEMETRY_CACHE_BUDGET_BYTES = 256*1024*1024
+# days that ended less than this long ago (hours) can still get readings, so they are always read from BigQuery
+MUTABLE_PARTITION_HOURS = 3.0
+
+DAY = timedelta(days=1)
+
+
+def toUTCTimestamp(value):
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tzinfo is None else value.tz_convert('UTC')
+
+
+class TelemetryCache:
+    # fetch(label, lo, hi) returns all of the label's telemetry with lo <= time < hi (a DataFrame with a 'time' column)
+    def __init__(self, directory, fetch, budget_bytes=TELEMETRY_CACHE_BUDGET_BYTES, mutable_hours=MUTABLE_PARTITION_HOURS):
+        self.directory = directory
+        self.fetch = fetch
+        self.budget_bytes = budget_bytes
+        self.mutable_hours = mutable_hours
+        self.partition_hits = 0
+        self.partition_misses = 0
+        self.mutable_fetches = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # locks of the (label, day) partitions being fetched
+        self.partition_locks = {}
+
+    def partitionFile(self, label, day):
+        return os.path.join(self.directory, label, day.strftime('%Y-%m-%d') + '.parquet')
+
+    # telemetry of the label that could have start < time < end -- whole days from the cache plus the mutable tail from BigQuery
+    def read(self, label, start, end, now=None):
+        start, end = toUTCTimestamp(start), toUTCTimestamp(end)
+        now = toUTCTimestamp(datetime.now(timezone.utc) if now is None else now)
+        # days that are over (plus the lag) are the ones that can be stored
+        mutable_start = (now - timedelta(hours=self.mutable_hours)).floor('D')
+
+        frames = []
+        missing = []
+        day = start.floor('D')
+        while (day < mutable_start) and (day <= end):
+            df = self.readPartition(label, day)
+            if df is not None:
+                frames.append(df)
+            else:
+                missing.append(day)
+            day = day + DAY
+
+        if len(missing) > 0:
+            frames += self.fetchPartitions(label, missing)
+
+
+        if end >= mutable_start:
+            frames.append(self.fetch(label, max(start, mutable_start), end + timedelta(seconds=1)))
+            with self.lock:
+                self.mutable_fetches += 1
+
+        frames = [frame for frame in frames if not frame.empty]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    # the partition's rows, or None if it isn't on disk
+    def readPartition(self, label, day):
+        filename = self.partitionFile(label, day)
+        try:
+            df = pd.read_parquet(filename)
+            # the modification time is the "last used" time for the eviction
+            os.utime(filename)
+        except (FileNotFoundError, OSError):
+            return None
+        with self.lock:
+            self.partition_hits += 1
+        return df
+
+    # the rows of the missing days, fetched from BigQuery (one fetch per run of consecutive days) and written to the cache.  The days are
+    # locked while they are fetched, so concurrent queries that miss them wait and then read the files.  The locks are taken in day order,
+    # so queries with overlapping days can't deadlock
+    def fetchPartitions(self, label, missing):
+        with self.lock:
+            day_locks = [self.partition_locks.setdefault((label, day), threading.Lock()) for day in missing]
+        for day_lock in day_locks:
+            day_lock.acquire()
+        try:
+            frames = []
+            runs = []
+            for day in missing:
+                df = self.readPartition(label, day)
+                if df is not None:
+                    frames.append(df)
+                elif (len(runs) > 0) and (runs[-1][1] == day):
+                    runs[-1][1] = day + DAY
+                else:
+                    runs.append([day, day + DAY])
+            for run_lo, run_hi in runs:
+                df = self.fetch(label, run_lo, run_hi)
+                day = run_lo
+                while day < run_hi:
+                    day_df = df[(df['time'] >= day) & (df['time'] < day + DAY)] if not df.empty else df
+                    self.write(label, day, day_df)
+                    frames.append(day_df)
+                    day = day + DAY
+                with self.lock:
+                    self.partition_misses += (run_hi - run_lo).days
+        finally:
+            for day_lock in day_locks:
+                day_lock.release()
+            # (the files are written by now, so queries that come after this find them)
+            with self.lock:
+                for day in missing:
+                    self.partition_locks.pop((label, day), None)
+        if len(runs) > 0:
+            self.evict()
+        return frames
+
+    def write(self, label, day, df):
+        filename = self.partitionFile(label, day)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        df.to_parquet(tmp_filename, index=False)
+        os.replace(tmp_filename, filename)
+
+    # Parquet files in the cache, least recently used first: (last used, size, filename)
+    def partitionFiles(self):
+        files = []
+        for root, dirs, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.parquet'):
+                    try:
+                        status = os.stat(os.path.join(root, filename))
+                    except FileNotFoundError:
+                        continue
+                    files.append((status.st_mtime, status.st_size, os.path.join(root, filename)))
+        return sorted(files)
+
+    def evict(self):
+        files = self.partitionFiles()
+        total_bytes = sum(size for last_used, size, filename in files)
+        for last_used, size, filename in files:
+            if total_bytes <= self.budget_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            with self.lock:
+                self.evictions += 1
+
+    def clear(self):
+        for last_used, size, filename in self.partitionFiles():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        files = self.partitionFiles()
+        with self.lock:
+            lookups = self.partition_hits + self.partition_misses
+            return {
+                "directory": self.directory,
+                "partitions": len(files),
+                "bytes": sum(size for last_used, size, filename in files),
+                "budget bytes": self.budget_bytes,
+                "partition hits": self.partition_hits,
+                "partition misses": self.partition_misses,
+                "hit rate": (self.partition_hits/lookups) if lookups > 0 else None,
+                "mutable fetches": self.mutable_fetches,
+                "evictions": self.evictions
+            }
@@ -1,7 +1,13 @@
 from datetime import datetime, timedelta, timezone
+import common.elevation
 import common.gaussian_model_utils
 import common.jsonutils
+import common.model_cache
+import common.telemetry_backend
+import common.telemetry_cache
 from google.cloud import bigquery, storage
+import google.api_core.exceptions
+import cachetools
 import pytz
 import utm
 from flask import jsonify, make_response
@@ -11,8 +17,13 @@ import numpy as np
 from scipy import interpolate
 from scipy.io import loadmat
 import csv
+import itertools
 import logging
 import collections.abc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import threading
+import torch
 import pandas as pd
 import yaml
 
@@ -28,12 +39,34 @@ MIN_ACCEPTABLE_ESTIMATE = -5.0
 # If the bin size is 10 mins, and the and the time scale is 20 mins, then a value of 30 would give 30*20/10, which is a matrix size of 60.  Which is not that big.  
 TIME_SEQUENCE_SIZE = 20.
 
+# how the time chunks of an estimate are fit/evaluated: "thread", "process" or "serial".  Can be set with ESTIMATE_CHUNK_EXECUTOR in the config file.
+# torch releases the GIL in the matrix routines, so threads are usually enough (and models don't need to be copied between processes)
+CHUNK_EXECUTOR = "thread"
+# number of chunks run at once, shared by all requests in the worker (ESTIMATE_CHUNK_WORKERS)
+CHUNK_WORKERS = 4
+# torch threads for each chunk (ESTIMATE_TORCH_THREADS).  The worker serves API_REQUEST_SLOTS requests at once, so CHUNK_WORKERS*TORCH_THREADS_PER_CHUNK
+# should stay at or below that
+TORCH_THREADS_PER_CHUNK = 2
+
+# requests served at once in a worker, not counting live streams (API_REQUEST_SLOTS); the others wait for a slot.  The gunicorn threads in the
+# Dockerfile are these plus LIVE_STREAM_MAX_SUBSCRIBERS, since a live stream holds a thread while it is open but only waits on its queue, and
+# the slots keep the rest of the API to the 8 threads the instance is sized for
+API_REQUEST_SLOTS = 8
+
 # constants for outier, bad sensor removal
 MAX_ALLOWED_PM2_5 = 1000.0
 # constant to be used with MAD estimates
 DEFAULT_OUTLIER_LEVEL = 5.0
 # level below which outliers won't be removed 
 MIN_OUTLIER_LEVEL = 10.0
+# the median/MAD for the outlier bounds are kept this long (seconds)...
+OUTLIER_STATS_TTL = 600
+# ... for queries whose time window starts and ends in the same buckets (minutes)
+OUTLIER_STATS_BUCKET_MINUTES = 10
+OUTLIER_STATS_CACHE_SIZE = 1024
+# how request_model_data_local gets the outlier bounds (OUTLIER_BOUNDS_MODE in the config file): "local" computes the median/MAD from the
+# sensor rows it fetches anyway, "query" asks BigQuery for them first (estimateMedianDeviation) and only fetches the rows inside the bounds
+OUTLIER_BOUNDS_MODE = "local"
 
 def dict_nantonull(d):
     updated_item = {}
@@ -189,25 +222,19 @@ def isQueryInBoundingBox(bounding_box_vertices, query_lat, query_lon):
     return boundingBox.contains_point((query_lon, query_lat))
 
 
+# sensor_data is a DataFrame of readings (ID, time, PM2_5, utm_x, utm_y, SensorModel).  The checks are done on the per sensor/day averages, so
+# only the aggregates are looped over, not the readings
 def removeInvalidSensors(sensor_data):
     # sensor is invalid if its average reading for any day exceeds 350 ug/m3
     epoch = datetime(1970, 1, 1)
     epoch = pytz.timezone('UTC').localize(epoch)
-    dayCounts = {}
-    dayReadings = {}
-    for datum in sensor_data:
-        pm25 = datum['PM2_5']
-        datum['daysSinceEpoch'] = (datum['time'] - epoch).days
-        key = (datum['daysSinceEpoch'], datum['ID'])
-        if key in dayCounts:
-            dayCounts[key] += 1
-            dayReadings[key] += pm25
-        else:
-            dayCounts[key] = 1
-            dayReadings[key] = pm25
+    days = ((pd.to_datetime(sensor_data['time'], utc=True) - epoch)//timedelta(days=1)).to_numpy()
+    ids = sensor_data['ID'].to_numpy()
+    day_groups = sensor_data['PM2_5'].groupby([days, ids])
+    dayReadings = (day_groups.sum()/day_groups.count()).to_dict()
 
     # get days that had higher than 350 avg reading
-    keysToRemove = [key for key in dayCounts if (dayReadings[key] / dayCounts[key]) > 350]
+    keysToRemove = [key for key in dayReadings if dayReadings[key] > 350]
     keysToRemoveSet = set()
     for key in keysToRemove:
         keysToRemoveSet.add(key)
@@ -215,14 +242,14 @@ def removeInvalidSensors(sensor_data):
         keysToRemoveSet.add((key[0] - 1, key[1]))
 
     logging.info(f'Removing these days from data due to exceeding 350 ug/m3 avg: {keysToRemoveSet}')
-    sensor_data = [datum for datum in sensor_data if (datum['daysSinceEpoch'], datum['ID']) not in keysToRemoveSet]
+    keep = ~pd.MultiIndex.from_arrays([days, ids]).isin(list(keysToRemoveSet))
+    sensor_data, days, ids = sensor_data[keep], days[keep], ids[keep]
 
     # TODO NEEDS TESTING!
     # 5003 sensors are invalid if Raw 24-hour average PM2.5 levels are > 5 ug/m3
     # AND the two sensors differ by more than 16%
-    sensor5003Locations = {
-        datum['ID']: (datum['utm_x'], datum['utm_y']) for datum in sensor_data if datum['SensorModel'] == '5003'
-    }
+    sensors5003 = sensor_data[sensor_data['SensorModel'] == '5003'].drop_duplicates('ID', keep='last')
+    sensor5003Locations = dict(zip(sensors5003['ID'], zip(sensors5003['utm_x'], sensors5003['utm_y'])))
     sensorMatches = {}
     for sensor in sensor5003Locations:
         for match in sensor5003Locations:
@@ -236,10 +263,10 @@ def removeInvalidSensors(sensor_data):
         day = key[0]
         if sensor in sensorMatches:
             match = sensorMatches[sensor]
-            reading1 = dayReadings[key] / dayCounts[key]
+            reading1 = dayReadings[key]
             key2 = (day, match)
             if key2 in dayReadings:
-                reading2 = dayReadings[key2] / dayCounts[key2]
+                reading2 = dayReadings[key2]
                 difference = abs(reading1 - reading2)
                 maximum = max(reading1, reading2)
                 if min(reading1, reading2) > 5 and difference / maximum > 0.16:
@@ -254,7 +281,7 @@ def removeInvalidSensors(sensor_data):
         "Removing these days from data due to pair of 5003 sensors with both > 5 "
         f"daily reading and smaller is 16% different reading from larger : {keysToRemoveSet}"
     ))
-    sensor_data = [datum for datum in sensor_data if (datum['daysSinceEpoch'], datum['ID']) not in keysToRemoveSet]
+    sensor_data = sensor_data[~pd.MultiIndex.from_arrays([days, ids]).isin(list(keysToRemoveSet))]
 
     # * Otherwise just average the two readings and correct as normal.
     return sensor_data
@@ -328,6 +355,14 @@ def boundingBoxUnion(bbox1, bbox2):
     return min(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1]), min(bbox1[2], bbox2[2]), max(bbox1[3], bbox2[3])
 
 
+# bounding box that covers all of the given points (arrays of lats/lons) plus the radius around each of them
+def latlonBoundingBoxForPoints(lats, lons, distance_meters):
+    lat_lo, lat_hi, lon_lo, lon_hi = latlonBoundingBox(lats[0], lons[0], distance_meters)
+    for i in range(1, lats.shape[0]):
+        lat_lo, lat_hi, lon_lo, lon_hi = boundingBoxUnion(latlonBoundingBox(lats[i], lons[i], distance_meters), (lat_lo, lat_hi, lon_lo, lon_hi))
+    return lat_lo, lat_hi, lon_lo, lon_hi
+
+
 # convenience/wrappers for the utm toolbox
 def latlonToUTM(lat, lon):
     return utm.from_latlon(lat, lon)
@@ -344,12 +379,203 @@ def getBigQueryClient():
         getBigQueryClient.client = bigquery.Client()
     return getBigQueryClient.client
 
+# client for the BigQuery Storage read API (results come back as Arrow record batches over gRPC), or None if google-cloud-bigquery-storage isn't installed
+def getBigQueryStorageClient():
+    if not hasattr(getBigQueryStorageClient, 'client'):
+        try:
+            from google.cloud import bigquery_storage
+            getBigQueryStorageClient.client = bigquery_storage.BigQueryReadClient()
+        except Exception as err:
+            logging.warning(f'BigQuery Storage API not available, query results will be read through the REST API: {err}')
+            getBigQueryStorageClient.client = None
+    return getBigQueryStorageClient.client
+
+# results of a query job as a DataFrame, built column by column from Arrow (to_dataframe) rather than a Row and a dict per row.
+# Large results are read through the Storage API; if that isn't available or the read fails (e.g. no permission on the read session), the
+# results are read through the REST API instead, and if Arrow/pyarrow isn't there either, row by row as before
+def queryResultToDataFrame(query_job):
+    bqstorage_client = getBigQueryStorageClient()
+    if bqstorage_client is not None:
+        try:
+            return query_job.to_dataframe(bqstorage_client=bqstorage_client)
+        except (google.api_core.exceptions.GoogleAPICallError, ValueError) as err:
+            logging.warning(f'BigQuery Storage API read failed, reading the results through the REST API: {err}')
+    try:
+        return query_job.to_dataframe(create_bqstorage_client=False)
+    except (ImportError, ValueError) as err:
+        logging.warning(f'Could not read the query results with Arrow, reading them row by row: {err}')
+        return pd.DataFrame([dict(r) for r in query_job.result()])
+
+# results of a query job as DataFrames of about page_rows rows, read (through the Storage API if it's there) as they are consumed.
+# The first page is read here, so that if the Storage API read fails the results are read through the REST API instead, as
+# queryResultToDataFrame does, before a streamed response has started
+def queryResultPages(query_job, page_rows):
+    bqstorage_client = getBigQueryStorageClient()
+    if bqstorage_client is not None:
+        try:
+            pages = iter(query_job.result(page_size=page_rows).to_dataframe_iterable(bqstorage_client=bqstorage_client))
+            first_page = next(pages, None)
+            return pages if first_page is None else itertools.chain([first_page], pages)
+        except (google.api_core.exceptions.GoogleAPICallError, ValueError) as err:
+            logging.warning(f'BigQuery Storage API read failed, reading the results through the REST API: {err}')
+    return query_job.result(page_size=page_rows).to_dataframe_iterable(bqstorage_client=None)
+
+# results of a query job as an Arrow table (the record batches of the Storage API as they are, if it's there)
+def queryResultToArrow(query_job):
+    bqstorage_client = getBigQueryStorageClient()
+    if bqstorage_client is not None:
+        try:
+            return query_job.to_arrow(bqstorage_client=bqstorage_client)
+        except (google.api_core.exceptions.GoogleAPICallError, ValueError) as err:
+            logging.warning(f'BigQuery Storage API read failed, reading the results through the REST API: {err}')
+    return query_job.to_arrow(create_bqstorage_client=False)
+
+# held while the request slots are made
+request_slots_lock = threading.Lock()
+
+# semaphore of the API_REQUEST_SLOTS shared by the requests in this worker (main.py takes one for each request other than a live stream)
+def getRequestSlots():
+    if not hasattr(getRequestSlots, 'slots'):
+        with request_slots_lock:
+            if not hasattr(getRequestSlots, 'slots'):
+                getRequestSlots.slots = threading.BoundedSemaphore(getConfigData().get('API_REQUEST_SLOTS', API_REQUEST_SLOTS))
+    return getRequestSlots.slots
+
+# executor shared by all requests, so that concurrent requests don't oversubscribe the cores.  None means run the chunks serially
+def getChunkExecutor():
+    if not hasattr(getChunkExecutor, 'executor'):
+        config = getConfigData()
+        executor_type = config.get('ESTIMATE_CHUNK_EXECUTOR', CHUNK_EXECUTOR)
+        num_workers = config.get('ESTIMATE_CHUNK_WORKERS', CHUNK_WORKERS)
+        num_torch_threads = config.get('ESTIMATE_TORCH_THREADS', TORCH_THREADS_PER_CHUNK)
+        if executor_type == "process":
+            # spawn rather than fork, since torch may already have started its own threads
+            getChunkExecutor.executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"), initializer=torch.set_num_threads, initargs=(num_torch_threads,))
+        elif executor_type == "thread":
+            torch.set_num_threads(num_torch_threads)
+            getChunkExecutor.executor = ThreadPoolExecutor(max_workers=num_workers)
+        else:
+            getChunkExecutor.executor = None
+    return getChunkExecutor.executor
+
+# backend that runs the telemetry queries (see telemetry_backend.py), set with TELEMETRY_BACKEND in the config file
+def getTelemetryBackend():
+    if not hasattr(getTelemetryBackend, 'backend'):
+        config = getConfigData()
+        if config.get('TELEMETRY_BACKEND', common.telemetry_backend.TELEMETRY_BACKEND) == "duckdb":
+            getTelemetryBackend.backend = common.telemetry_backend.DuckDBBackend(config.get('TELEMETRY_LOCAL_DIR', common.telemetry_backend.TELEMETRY_LOCAL_DIR))
+        else:
+            getTelemetryBackend.backend = common.telemetry_backend.BigQueryBackend(getBigQueryClient, queryResultToDataFrame, queryResultPages, queryResultToArrow)
+    return getTelemetryBackend.backend
+
 def getStorageClient():
     if not hasattr(getStorageClient, 'client'):
         getStorageClient.client = storage.Client()
     return getStorageClient.client
 
+# telemetry cache shared by the requests in this worker (see telemetry_cache.py), or None if it is off.  It is turned on by setting
+# TELEMETRY_CACHE_DIR in the config file (and TELEMETRY_CACHE_BUDGET_BYTES, which counts against the instance's memory if the directory is in /tmp).  The cache is partitioned by area label, so it needs a label column in the telemetry table.
+# It is in front of BigQuery; the duckdb backend reads local Parquet files already, so it doesn't use the cache
+def getTelemetryCache():
+    if not hasattr(getTelemetryCache, 'cache'):
+        config = getConfigData()
+        directory = config.get('TELEMETRY_CACHE_DIR', common.telemetry_cache.TELEMETRY_CACHE_DIR)
+        with open('common/db_table_headings.json') as json_file:
+            db_table_headings = json.load(json_file)
+        if directory and ("label" in db_table_headings) and isinstance(getTelemetryBackend(), common.telemetry_backend.BigQueryBackend):
+            getTelemetryCache.cache = common.telemetry_cache.TelemetryCache(
+                directory, fetchTelemetry, config.get('TELEMETRY_CACHE_BUDGET_BYTES', common.telemetry_cache.TELEMETRY_CACHE_BUDGET_BYTES))
+        else:
+            getTelemetryCache.cache = None
+    return getTelemetryCache.cache
+
+# columns of the sensor queries (id, time, pm2_5, lat, lon, humidity, and sensormodel/sensorsource if the table has them)
+def sensorQueryColumns(db_table_headings):
+    column_string = " ".join([db_table_headings['id'], "AS id,", db_table_headings['time'], "AS time,", db_table_headings['pm2_5'], "AS pm2_5,",
+                              db_table_headings['latitude'], "AS lat,", db_table_headings['longitude'], "AS lon,", db_table_headings['humidity'], "AS humidity"])
+    if 'sensormodel' in db_table_headings:
+        column_string += ", " + db_table_headings['sensormodel'] + " AS sensormodel"
+    if 'sensorsource' in db_table_headings:
+        column_string += ", " + db_table_headings['sensorsource'] + " AS sensorsource"
+    return column_string
+
+# all of the telemetry of an area label with lo <= time < hi, with the columns of submit_sensor_query.  This is what fills the telemetry cache
+def fetchTelemetry(label, lo, hi):
+    with open('common/db_table_headings.json') as json_file:
+        db_table_headings = json.load(json_file)
+    time_string = db_table_headings['time']
+    label_string = db_table_headings['label']
+    table_string = "telemetry.telemetry"
+
+    backend = getTelemetryBackend()
+
+    query = f"""SELECT {sensorQueryColumns(db_table_headings)}, {label_string} AS areamodel FROM {backend.table(table_string)} WHERE ({time_string} >= @lo) AND ({time_string} < @hi) AND ({label_string} = @label)"""
+    return backend.query(query, [("lo", "TIMESTAMP", lo), ("hi", "TIMESTAMP", hi), ("label", "STRING", label)])
+
+# the rows of a telemetry cache read that the BigQuery sensor query would have returned, in time order
+def filterTelemetry(df, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, min_value, max_value):
+    if df.empty:
+        return df
+    keep = ((df['time'] > common.telemetry_cache.toUTCTimestamp(start_date)) & (df['time'] < common.telemetry_cache.toUTCTimestamp(end_date)) &
+            (df['lat'] <= lat_hi) & (df['lat'] >= lat_lo) & (df['lon'] <= lon_hi) & (df['lon'] >= lon_lo) & (df['pm2_5'] < max_value) & (df['pm2_5'] > min_value))
+    return df[keep].sort_values('time', kind='mergesort').reset_index(drop=True)
+
+# parameters of the sensor and outlier statistics queries
+def sensorQueryParameters(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi):
+    return [("start_date", "TIMESTAMP", start_date), ("end_date", "TIMESTAMP", end_date),
+            ("lat_lo", "NUMERIC", lat_lo), ("lat_hi", "NUMERIC", lat_hi), ("lon_lo", "NUMERIC", lon_lo), ("lon_hi", "NUMERIC", lon_hi)]
+
+# same as BigQuery's PERCENTILE_DISC: the first of the sorted values at or past the percentile (nulls ignored)
+def percentileDisc(values, percentile):
+    values = np.sort(values[~np.isnan(values)])
+    return values[max(int(np.ceil(percentile*values.shape[0])) - 1, 0)]
+
+# median, MAD and number of sensors for the outlier bounds, shared by the requests that ask for the same area, bounding box and time window
+# (to the bucket) within the TTL
 def estimateMedianDeviation(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi, area_model):
+    cache, lock, key_locks = getOutlierStatsCache()
+    bucket = f'{OUTLIER_STATS_BUCKET_MINUTES}min'
+    key = (area_model["name"], tuple(round(float(v), 6) for v in (lat_lo, lat_hi, lon_lo, lon_hi)),
+           common.telemetry_cache.toUTCTimestamp(start_date).floor(bucket), common.telemetry_cache.toUTCTimestamp(end_date).floor(bucket))
+    with lock:
+        if key in cache:
+            return cache[key]
+        key_lock = key_locks.setdefault(key, threading.Lock())
+    # concurrent requests for the same key wait for the first one rather than all running the query
+    with key_lock:
+        with lock:
+            if key in cache:
+                return cache[key]
+        # (a failed query raises, and nothing is kept)
+        try:
+            stats = computeMedianDeviation(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi, area_model)
+            with lock:
+                cache[key] = stats
+        finally:
+            with lock:
+                key_locks.pop(key, None)
+    return stats
+
+def getOutlierStatsCache():
+    if not hasattr(getOutlierStatsCache, 'cache'):
+        getOutlierStatsCache.cache = cachetools.TTLCache(maxsize=OUTLIER_STATS_CACHE_SIZE, ttl=OUTLIER_STATS_TTL)
+        getOutlierStatsCache.lock = threading.Lock()
+        getOutlierStatsCache.key_locks = {}
+    return getOutlierStatsCache.cache, getOutlierStatsCache.lock, getOutlierStatsCache.key_locks
+
+# the median, MAD and number of sensors of a frame of sensor rows, with the same PERCENTILE_DISC semantics as the BigQuery version (0s if there are no rows)
+def medianDeviationOfFrame(df):
+    if df.empty:
+        return 0, 0, 0
+    pm2_5 = df['pm2_5'].to_numpy(dtype=float)
+    median = percentileDisc(pm2_5, 0.5)
+    return median, percentileDisc(np.abs(pm2_5 - median), 0.5), df['id'].nunique()
+
+def computeMedianDeviation(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi, area_model):
+    telemetry_cache = getTelemetryCache()
+    if telemetry_cache is not None:
+        return medianDeviationOfFrame(filterTelemetry(telemetry_cache.read(area_model["name"], start_date, end_date), lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, -np.inf, MAX_ALLOWED_PM2_5))
+
     with open('common/db_table_headings.json') as json_file:
         db_table_headings = json.load(json_file)
     
@@ -360,6 +586,7 @@ def estimateMedianDeviation(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi
     lat_string = db_table_headings['latitude']
     id_string = db_table_headings['id']
     table_string = "telemetry.telemetry"
+    backend = getTelemetryBackend()
 
     column_string = " ".join([id_string, "AS id,", time_string, "AS time,", pm2_5_string, "AS pm2_5,", lat_string, "AS lat,", lon_string, "AS lon"])
 
@@ -377,57 +604,33 @@ def estimateMedianDeviation(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi
         column_string += ", " + label_string + " AS areamodel"
         where_string += " AND " + label_string + " = " + "'" + area_model["name"] + "'"
 
-    query_list.append(f"""(SELECT pm2_5, id FROM (SELECT {column_string} FROM `{table_string}` WHERE (({time_string} > @start_date) AND ({time_string} < @end_date))) WHERE ((lat <= @lat_hi) AND (lat >= @lat_lo) AND (lon <= @lon_hi) AND (lon >= @lon_lo)) AND (pm2_5 < {MAX_ALLOWED_PM2_5}))""")
+    query_list.append(f"""(SELECT pm2_5, id FROM (SELECT {column_string} FROM {backend.table(table_string)} WHERE (({time_string} > @start_date) AND ({time_string} < @end_date))) WHERE ((lat <= @lat_hi) AND (lat >= @lat_lo) AND (lon <= @lon_hi) AND (lon >= @lon_lo)) AND (pm2_5 < {MAX_ALLOWED_PM2_5}))""")
 
     query = "(" + " UNION ALL ".join(query_list) + ")"
 
 #    query = f"SELECT PERCENTILE_DISC(pm2_5, 0.5) OVER ()  AS median FROM {query} LIMIT 1"
 #    query = f"WITH all_data as {query} SELECT COUNT (DISTINCT id) as num_sensors, PERCENTILE_DISC(pm2_5, 0.0) OVER ()  AS min,  PERCENTILE_DISC(pm2_5, 0.5) OVER ()  AS median, PERCENTILE_DISC(pm2_5, 1.0) OVER ()  AS max FROM all_data LIMIT 1"
-    full_query = f"WITH all_data as {query} SELECT * FROM (SELECT PERCENTILE_DISC(pm2_5, 0.5) OVER() AS median FROM all_data LIMIT 1) JOIN (SELECT COUNT(DISTINCT id) as num_sensors FROM all_data) ON TRUE"
+    # median, number of sensors and MAD in one query (the MAD used to be a second query, with the median pasted in).  PERCENTILE_DISC rather than
+    # APPROX_QUANTILES, so the bounds don't change
+    full_query = f"""WITH all_data AS {query},
+        median_data AS (SELECT {backend.percentileDisc("pm2_5", 0.5)} AS median FROM all_data LIMIT 1),
+        count_data AS (SELECT COUNT(DISTINCT id) AS num_sensors FROM all_data),
+        mad_data AS (SELECT {backend.percentileDisc("ABS(all_data.pm2_5 - median_data.median)", 0.5)} AS mad FROM all_data CROSS JOIN median_data LIMIT 1)
+        SELECT median_data.median, count_data.num_sensors, mad_data.mad FROM median_data CROSS JOIN count_data CROSS JOIN mad_data"""
 
 #        query_string = f"""SELECT pm2_5 FROM (SELECT {column_string} FROM `{db_id_string}` WHERE (({time_string} > {start_date}) AND ({time_string} < {end_date}))) WHERE ((lat <= {lat_hi}) AND (lat >= {lat_lo}) AND (lon <= {lon_hi}) AND (lon >= {lon_lo})) ORDER BY time ASC"""
 
 #    print("query is: " + full_query)
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            # bigquery.ScalarQueryParameter("lat", "NUMERIC", lat),
-            # bigquery.ScalarQueryParameter("lon", "NUMERIC", lon),
-            # bigquery.ScalarQueryParameter("radius", "NUMERIC", radius),
-            bigquery.ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
-            bigquery.ScalarQueryParameter("end_date", "TIMESTAMP", end_date),
-            bigquery.ScalarQueryParameter("lat_lo", "NUMERIC", lat_lo),
-            bigquery.ScalarQueryParameter("lat_hi", "NUMERIC", lat_hi),
-            bigquery.ScalarQueryParameter("lon_lo", "NUMERIC", lon_lo),
-            bigquery.ScalarQueryParameter("lon_hi", "NUMERIC", lon_hi),
-        ]
-    )
-
-    bq_client = getBigQueryClient()
-    query_job = bq_client.query(full_query, job_config=job_config)
-    if query_job.error_result:
-        return "Invalid API call - check documentation.", 400
-
-    median_data = query_job.result()
-    median = 0
-    count = 0
-    for row in median_data:
-        median = row.median
-        count = row.num_sensors
-
-    full_query = f"WITH all_data as {query} SELECT PERCENTILE_DISC(ABS(pm2_5 - {median}), 0.5) OVER() AS median FROM all_data LIMIT 1"
-    query_job = bq_client.query(full_query, job_config=job_config)
-    if query_job.error_result:
-        return "Invalid API call - check documentation.", 400
-    MAD_data = query_job.result()
-    MAD = 0
-    for row in MAD_data:
-        MAD = row.median
-
-    return median, MAD, count
+    stats = backend.query(full_query, sensorQueryParameters(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi))
 
-def filterUpperLowerBounds(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, area_model, filter_level = DEFAULT_OUTLIER_LEVEL):
-        median, MAD, count = estimateMedianDeviation(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi, area_model)
+    # no rows if there is no data
+    if stats.empty:
+        return 0, 0, 0
+    return stats["median"].iloc[0], stats["mad"].iloc[0], stats["num_sensors"].iloc[0]
+
+# [median - filter_level*MAD, median + filter_level*MAD], clamped to 0, MIN_OUTLIER_LEVEL and MAX_ALLOWED_PM2_5
+def computeUpperLowerBounds(median, MAD, filter_level = DEFAULT_OUTLIER_LEVEL):
         if median == 0:
             lo = 0
             hi = 1000
@@ -436,6 +639,10 @@ def filterUpperLowerBounds(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date,
             hi = min(max(median + filter_level*MAD, MIN_OUTLIER_LEVEL), MAX_ALLOWED_PM2_5)
         return lo, hi
 
+def filterUpperLowerBounds(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, area_model, filter_level = DEFAULT_OUTLIER_LEVEL):
+        median, MAD, count = estimateMedianDeviation(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi, area_model)
+        return computeUpperLowerBounds(median, MAD, filter_level)
+
 def filterUpperLowerBoundsForArea(start_date, end_date, area_model, filter_level = DEFAULT_OUTLIER_LEVEL):
         bbox_array = np.array(area_model['boundingbox'])[:,1:3]
         lo = bbox_array.min(axis=0)
@@ -453,26 +660,20 @@ def submit_sensor_query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, ar
         db_table_headings = json.load(json_file)
 
     this_area_model = area_model["name"]
+
+    # days already on local disk don't need to go to BigQuery
+    telemetry_cache = getTelemetryCache()
+    if telemetry_cache is not None:
+        return filterTelemetry(telemetry_cache.read(this_area_model, start_date, end_date), lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date,
+                               -np.inf if min_value is None else min_value, max_value)
         
     query_list = []
 #loop over all of the tables associated with this area model
     time_string = db_table_headings['time']
-    pm2_5_string = db_table_headings['pm2_5']
-    humidity_string = db_table_headings['humidity']
-    lon_string = db_table_headings['longitude']
-    lat_string = db_table_headings['latitude']
-    id_string = db_table_headings['id']
     table_string = "telemetry.telemetry"
+    backend = getTelemetryBackend()
 
-    column_string = " ".join([id_string, "AS id,", time_string, "AS time,", pm2_5_string, "AS pm2_5,", lat_string, "AS lat,", lon_string, "AS lon,", humidity_string, "AS humidity"])
-
-    if 'sensormodel' in db_table_headings:
-        sensormodel_string = db_table_headings['sensormodel']
-        column_string += ", " + sensormodel_string + " AS sensormodel"
-
-    if 'sensorsource' in db_table_headings:
-        sensorsource_string = db_table_headings['sensorsource']
-        column_string += ", " + sensorsource_string + " AS sensorsource"
+    column_string = sensorQueryColumns(db_table_headings)
 
     where_string = ""
     if "label" in db_table_headings:
@@ -480,7 +681,9 @@ def submit_sensor_query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, ar
         column_string += ", " + label_string + " AS areamodel" 
         where_string += " AND " + label_string + " = " + "'" + this_area_model + "'"
 
-    query_list.append(f"""(SELECT * FROM (SELECT {column_string} FROM `{table_string}` WHERE (({time_string} > '{start_date}') AND ({time_string} < '{end_date}')) {where_string}) WHERE ((lat <= {lat_hi}) AND (lat >= {lat_lo}) AND (lon <= {lon_hi}) AND (lon >= {lon_lo})) AND (pm2_5 < {max_value}) AND (pm2_5 > {min_value}))""")
+    # min_value None for no lower bound
+    min_string = "" if min_value is None else f" AND (pm2_5 > {min_value})"
+    query_list.append(f"""(SELECT * FROM (SELECT {column_string} FROM {backend.table(table_string)} WHERE (({time_string} > '{start_date}') AND ({time_string} < '{end_date}')) {where_string}) WHERE ((lat <= {lat_hi}) AND (lat >= {lat_lo}) AND (lon <= {lon_hi}) AND (lon >= {lon_lo})) AND (pm2_5 < {max_value}){min_string})""")
 
 
     query = " UNION ALL ".join(query_list) + " ORDER BY time ASC "
@@ -495,27 +698,8 @@ def submit_sensor_query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, ar
 #    ORDER BY time ASC
 #    """
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            # bigquery.ScalarQueryParameter("lat", "NUMERIC", lat),
-            # bigquery.ScalarQueryParameter("lon", "NUMERIC", lon),
-            # bigquery.ScalarQueryParameter("radius", "NUMERIC", radius),
-            bigquery.ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
-            bigquery.ScalarQueryParameter("end_date", "TIMESTAMP", end_date),
-            bigquery.ScalarQueryParameter("lat_lo", "NUMERIC", lat_lo),
-            bigquery.ScalarQueryParameter("lat_hi", "NUMERIC", lat_hi),
-            bigquery.ScalarQueryParameter("lon_lo", "NUMERIC", lon_lo),
-            bigquery.ScalarQueryParameter("lon_hi", "NUMERIC", lon_hi),
-        ]
-    )
-
-    bq_client = getBigQueryClient()
-    query_job = bq_client.query(query, job_config=job_config)
-
-    if query_job.error_result:
-        return "Invalid API call - check documentation.", 400
     # Waits for query to finish
-    sensor_data = pd.DataFrame([dict(r) for r in query_job.result()])
+    sensor_data = backend.query(query, sensorQueryParameters(start_date, end_date, lat_lo, lat_hi, lon_lo, lon_hi))
     return(sensor_data)
 
 # could do an ellipse in lat/lon around the point using something like this
@@ -542,13 +726,21 @@ def request_model_data_local(lats, lons, radius, start_date, end_date, area_mode
         if not lats.shape == lons.shape:
             return "lats,lons data data size error", 400
         else:
-            num_points = lats.shape[0]
-            lat_lo, lat_hi, lon_lo, lon_hi = common.utils.latlonBoundingBox(lats[0], lons[0], radius)
-            for i in range(1, num_points):
-                lat_lo, lat_hi, lon_lo, lon_hi = common.utils.boundingBoxUnion((common.utils.latlonBoundingBox(lats[i], lons[i], radius)), (lat_lo, lat_hi, lon_lo, lon_hi))
+            lat_lo, lat_hi, lon_lo, lon_hi = latlonBoundingBoxForPoints(lats, lons, radius)
     else:
         return "lats,lons data structure misalignment in request sensor data", 400
 
+    if outlier_filtering and (getConfigData().get('OUTLIER_BOUNDS_MODE', OUTLIER_BOUNDS_MODE) == "local"):
+        # the median/MAD are over the same rows as the sensor query (less the outlier bounds), so fetch those once and filter them here
+        rows = submit_sensor_query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, area_model, None, MAX_ALLOWED_PM2_5)
+        if not isinstance(rows, pd.DataFrame):
+            return rows
+        median, MAD, count = medianDeviationOfFrame(rows)
+        min_value, max_value = computeUpperLowerBounds(median, MAD)
+        if not rows.empty:
+            rows = rows[(rows['pm2_5'] < max_value) & (rows['pm2_5'] > min_value)].reset_index(drop=True)
+        return rows
+
     if outlier_filtering:
         min_value, max_value = filterUpperLowerBounds(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, area_model)
     else:
@@ -592,15 +784,99 @@ def request_model_data_local(lats, lons, radius, start_date, end_date, area_mode
 
     #    return model_data
 
-def computeEstimatesForLocations(query_dates, query_locations, area_model, outlier_filtering = True, apply_correction=True):
+# steps 3-6 of computeEstimatesForLocations: query the sensor data around the query locations, screen it, apply the correction factors and add the elevations
+# returns the sensor data (DataFrame) and None, or None and a status message if there is no usable data
+def loadModelSensorData(query_lats, query_lons, radius, start_date, end_date, area_model, elevation_interpolator, outlier_filtering = True, apply_correction = True):
+    df = request_model_data_local(
+            query_lats,
+            query_lons,
+            radius,
+            start_date,
+            end_date,
+            area_model, outlier_filtering)
+
+    if df.empty:
+        return None, "Zero sensor data"
+
+    return prepareModelSensorData(df, area_model, elevation_interpolator, apply_correction)
+
+# steps 3.5-6 on the query results.  Everything stays in one DataFrame with the columns createModel needs (ID, time, PM2_5, utm_x, utm_y, Altitude),
+# so the work is done on whole columns rather than one reading at a time
+def prepareModelSensorData(df, area_model, elevation_interpolator, apply_correction = True):
+    # go ahead and replace the humidities in the data, since they won't get reported anyway
+    humidity = df["humidity"]
+    if (apply_correction):
+    # step 5, apply correction factors to the data
+        if pd.notnull(humidity).any():
+            mean_humidity = humidity.mean()
+        else:
+            mean_humidity = area_model["defaulthumidity"]
+        humidity = humidity.fillna(mean_humidity)
+
+    sensor_data = pd.DataFrame({
+        "ID": df["id"],
+        "Latitude": df["lat"].astype(float),
+        "Longitude": df["lon"].astype(float),
+        "time": df["time"],
+        "PM2_5": df["pm2_5"].astype(float),
+        "Humidity": humidity,
+        "SensorModel": df["sensormodel"],
+        "SensorSource": df["sensorsource"]
+        })
+
+    # step 3.5, convert lat/lon to UTM coordinates
+    # (the whole array is put in the UTM zone of the first reading, as is done for the query locations)
+    try:
+        sensor_data["utm_x"], sensor_data["utm_y"], zone_num, zone_let = latlonToUTM(sensor_data["Latitude"].to_numpy(), sensor_data["Longitude"].to_numpy())
+    except ValueError as err:
+        return None, "Failure to convert lat/lon"
+
+    print(f'Fields: {list(sensor_data.columns)}')
+
+    # step 4.5, Data Screening
+#    print('Screening data')
+    sensor_data = removeInvalidSensors(sensor_data)
+    correction_engine = common.jsonutils.getCorrectionEngine(area_model['pm2.5 correction factors'])
+    sensor_data["PM2_5"], correction_notes = correction_engine.apply(sensor_data["time"], sensor_data["PM2_5"], sensor_data["Humidity"], sensor_data["SensorModel"])
+
+    # step 6, add elevation values to the data
+    # NOTICE - the elevation object takes locations in the form "lon-lat"
+    sensor_data["Altitude"] = elevation_interpolator.sensorAltitudes(sensor_data["ID"], sensor_data["Longitude"], sensor_data["Latitude"])
+
+    return sensor_data, None
+# fits the model for one time chunk (unless a cached model -- (model, time_offset, status) -- is given) and evaluates it at the query locations/dates of the chunk
+# runs in the chunk executor.  Returns the estimates and the newly fit model (or None) so that the caller can cache it
+# models hold autograd tensors that can't be sent between processes, so the process executor uses return_model=False
+def estimateChunk(sensor_data, cached_model, latlon_length_scale, elevation_length_scale, time_length_scale, sensor_window, query_lats, query_lons, query_elevations, query_dates, return_model=True, compute_variance=True, tile_bytes=None):
+    fitted_model = None
+    if cached_model is not None:
+        model, time_offset, model_status = cached_model
+    else:
+        model, time_offset, model_status = common.gaussian_model_utils.createModel(
+            sensor_data, latlon_length_scale, elevation_length_scale, time_length_scale, sensor_window[0], sensor_window[1], save_matrices=True)
+        if (model != None) and return_model:
+            fitted_model = (model, time_offset, model_status)
+    # check to see if there is a valid model
+    if (model == None):
+        yPred = np.full((query_lats.shape[0], len(query_dates)), 0.0)
+        yVar = np.full((query_lats.shape[0], len(query_dates)), np.nan)
+        status = [model_status for i in range(len(query_dates))]
+    else:
+        yPred, yVar, status = common.gaussian_model_utils.estimateUsingModel(
+            model, query_lats, query_lons, query_elevations, query_dates, time_offset, save_matrices=True, compute_variance=compute_variance,
+            tile_bytes=common.gaussian_model_utils.QUERY_TILE_BYTES if tile_bytes is None else tile_bytes)
+    return yPred, yVar, status, fitted_model
+
+# with compute_variance=False the variances are not computed (most of the cost for big maps) and yVar comes back as None
+def computeEstimatesForLocations(query_dates, query_locations, area_model, outlier_filtering = True, apply_correction=True, compute_variance=True):
     num_locations = query_locations.shape[0]
     query_lats = query_locations[:,0]
     query_lons = query_locations[:,1]
     query_start_datetime = query_dates[0]
     query_end_datetime = query_dates[-1]
 
-    elevation_interpolator = common.jsonutils.buildAreaElevationInterpolator(f'{area_model["name"]}_elevations.mat')    
-    query_elevations = np.array([elevation_interpolator(this_row[1], this_row[0])[0] for this_row in query_locations])
+    elevation_interpolator = common.elevation.getAreaElevation(area_model["name"])
+    query_elevations = elevation_interpolator(query_lons, query_lats)
     
     # step 0, load up the bounding box from file and check that request is within it
 
@@ -627,79 +903,6 @@ def computeEstimatesForLocations(query_dates, query_locations, area_model, outli
 # radius is in meters, as is the length scale and UTM.    
     radius = SPACE_KERNEL_FACTOR_PADDING*latlon_length_scale
 
-    df = request_model_data_local(
-            query_lats,
-            query_lons,
-            radius,
-            query_start_datetime - timedelta(hours=TIME_KERNEL_FACTOR_PADDING*time_length_scale),
-            query_end_datetime + timedelta(hours=TIME_KERNEL_FACTOR_PADDING*time_length_scale),
-            area_model, outlier_filtering)
-
-    if df.empty:
-        return make_response(jsonify(error='no data'), 400)
-
-    # go ahead and replace the humidities in the data, since they won't get reported anyway
-    if (apply_correction):
-    # step 5, apply correction factors to the data
-        if pd.notnull(df["humidity"]).any():
-            mean_humidity = df["humidity"].mean()
-        else:
-            mean_humidity = area_model["defaulthumidity"]
-        df["humidity"].fillna(mean_humidity, inplace=True)
-
-# Move the data from the df into a list of objects.   This is done because of the legacy code around this including removing bad sensors, creating the model, etc.
-# NEED to fix all this
-    sensor_data = []    
-    for _, row in df.iterrows():
-        new_row = {
-            "ID": row["id"],
-            "Latitude": row["lat"],
-            "Longitude": row["lon"],
-            "time": row["time"],
-            "PM2_5": row["pm2_5"],
-            "Humidity": row["humidity"],
-            "SensorModel":row["sensormodel"],
-            "SensorSource":row["sensorsource"]
-            }
-        sensor_data.append(new_row)
-
-    # unique_sensors = {datum['ID'] for datum in sensor_data}
-            
-
-    # step 3.5, convert lat/lon to UTM coordinates
-    try:
-        common.utils.convertLatLonToUTM(sensor_data)
-    except ValueError as err:
-        return np.full((query_lats.shape[0], query_dates.shape[0]), 0.0), np.full((query_lats.shape[0], query_dates.shape[0]), np.nan), ["Failure to convert lat/lon" for i in range(query_dates.shape[0])]
-
-# legacy code forcing sensors to like in UTM zone...
-#    sensor_data = [datum for datum in sensor_data if datum['zone_num'] == 12]
-    # Step 4, parse sensor type from the version
-#    sensor_source_to_type = {'AirU': '3003', 'PurpleAir': '5003', 'DAQ': '0000', 'Default':'Default'}
-# DAQ does not need a correction factor
-#    for datum in sensor_data:
-#        datum['type'] =  sensor_source_to_type[datum['SensorSource']]
-
-    if len(sensor_data) > 0:
-        print(f'Fields: {sensor_data[0].keys()}')
-    else:
-        return np.full((query_lats.shape[0], query_dates.shape[0]), 0.0), np.full((query_lats.shape[0], query_dates.shape[0]), np.nan), ["Zero sensor data" for i in range(query_dates.shape[0])]
-
-    # step 4.5, Data Screening
-#    print('Screening data')
-    sensor_data = common.utils.removeInvalidSensors(sensor_data)
-    for datum in sensor_data:
-        datum['PM2_5'] = common.jsonutils.applyCorrectionFactor(area_model['pm2.5 correction factors'], datum['time'], datum['PM2_5'], datum["Humidity"], datum['SensorModel'])
-    
-
-    # step 6, add elevation values to the data
-    # NOTICE - the elevation object takes locations in the form "lon-lat"
-    # this seems redundant since elevations are passed in...
-    # elevation_interpolator = jsonutils.buildAreaElevationInterpolator(area_model['elevationfile'])
-    for datum in sensor_data:
-        if 'Altitude' not in datum:
-            datum['Altitude'] = elevation_interpolator([datum['Longitude']],[datum['Latitude']])[0]
-
     # This does the calculation in one step --- old method --- less efficient.  Below we break it into pieces.  Remove this once the code below (step 7) is fully tested.
     # step 7, get estimates from model
     # # step 8, Create Model
@@ -713,29 +916,52 @@ def computeEstimatesForLocations(query_dates, query_locations, area_model, outli
     time_padding = timedelta(hours=TIME_KERNEL_FACTOR_PADDING*time_length_scale)
     time_sequence_length = timedelta(hours = TIME_SEQUENCE_SIZE*time_length_scale)
     sensor_sequence, query_sequence = common.utils.chunkTimeQueryData(query_dates, time_sequence_length, time_padding)
-
-    yPred = np.empty((num_locations, 0))
-    yVar = np.empty((num_locations, 0))
-    status = []
-    if len(sensor_data) == 0:
-        status = "0 sensors/measurements"
-        return 
+    # line the sensor windows up with the time bins, so that repeated queries give the same windows (and hit the model cache)
+    sensor_sequence = [[common.gaussian_model_utils.binFloorDatetime(lo), common.gaussian_model_utils.binCeilDatetime(hi)] for lo, hi in sensor_sequence]
+
+    # look for models that were already fit for these windows
+    model_cache = common.model_cache.getModelCache()
+    sensor_set_hash = common.model_cache.sensorSetHash(latlonBoundingBoxForPoints(query_lats, query_lons, radius), sensor_sequence[0][0], sensor_sequence[-1][1], outlier_filtering, apply_correction, area_model['pm2.5 correction factors'])
+    model_keys = [common.model_cache.modelKey(area_model["name"], lo, hi, latlon_length_scale, elevation_length_scale, time_length_scale, sensor_set_hash) for lo, hi in sensor_sequence]
+    cached_models = [model_cache.get(key) for key in model_keys]
+
+    # steps 4-6, the sensor data is only needed if some of the windows have to be fit
+    if any(cached is None for cached in cached_models):
+        sensor_data, data_status = loadModelSensorData(query_lats, query_lons, radius, sensor_sequence[0][0], sensor_sequence[-1][1], area_model, elevation_interpolator, outlier_filtering, apply_correction)
+        if data_status is not None:
+            return np.full((query_lats.shape[0], query_dates.shape[0]), 0.0), np.full((query_lats.shape[0], query_dates.shape[0]), np.nan), [data_status for i in range(query_dates.shape[0])]
+
+    # steps 7 and 8, the chunks are independent, so they are fit and evaluated in the chunk executor and written into their columns of the output
+    now = datetime.now(timezone.utc)
+    num_dates = sum(len(query_chunk) for query_chunk in query_sequence)
+    yPred = np.empty((num_locations, num_dates))
+    yVar = np.empty((num_locations, num_dates)) if compute_variance else None
+    status = [None]*num_dates
+    executor = getChunkExecutor()
+    # the query locations of each chunk are evaluated in tiles that fit in this memory budget
+    tile_bytes = getConfigData().get('ESTIMATE_TILE_BYTES', common.gaussian_model_utils.QUERY_TILE_BYTES)
+    futures = []
+    chunk_start = 0
     for i in range(len(query_sequence)):
-    # step 7, Create Model
-        model, time_offset, model_status = common.gaussian_model_utils.createModel(
-            sensor_data, latlon_length_scale, elevation_length_scale, time_length_scale, sensor_sequence[i][0], sensor_sequence[i][1], save_matrices=True)
-        # check to see if there is a valid model
-        if (model == None):
-            yPred_tmp = np.full((query_lats.shape[0], len(query_sequence[i])), 0.0)
-            yVar_tmp = np.full((query_lats.shape[0], len(query_sequence[i])), np.nan)
-            status_estimate_tmp = [model_status for i in range(len(query_sequence[i]))]
+        chunk_columns = slice(chunk_start, chunk_start + len(query_sequence[i]))
+        chunk_start += len(query_sequence[i])
+        # createModel only reads the data frame (and picks out the chunk's time window), so the chunks can share it
+        chunk_data = sensor_data if cached_models[i] is None else None
+        chunk_args = (chunk_data, cached_models[i], latlon_length_scale, elevation_length_scale, time_length_scale, sensor_sequence[i], query_lats, query_lons, query_elevations, query_sequence[i], not isinstance(executor, ProcessPoolExecutor), compute_variance, tile_bytes)
+        # cached models are cheap to evaluate and expensive to send to another process
+        if (executor is None) or ((cached_models[i] is not None) and isinstance(executor, ProcessPoolExecutor)):
+            futures.append((i, chunk_columns, None, estimateChunk(*chunk_args)))
         else:
-            yPred_tmp, yVar_tmp, status_estimate_tmp = common.gaussian_model_utils.estimateUsingModel(
-                model, query_lats, query_lons, query_elevations, query_sequence[i], time_offset, save_matrices=True)
-        # put the estimates together into one matrix
-        yPred = np.concatenate((yPred, yPred_tmp), axis=1)
-        yVar = np.concatenate((yVar, yVar_tmp), axis=1)
-        status = status + status_estimate_tmp
+            futures.append((i, chunk_columns, executor.submit(estimateChunk, *chunk_args), None))
+
+    for i, chunk_columns, future, result in futures:
+        yPred_tmp, yVar_tmp, status_estimate_tmp, fitted_model = result if future is None else future.result()
+        yPred[:, chunk_columns] = yPred_tmp
+        if compute_variance:
+            yVar[:, chunk_columns] = yVar_tmp
+        status[chunk_columns] = status_estimate_tmp
+        if fitted_model is not None:
+            model_cache.put(model_keys[i], fitted_model, fitted_model[0].get_memory_size(), common.model_cache.modelTTL(sensor_sequence[i][1], now))
 
     if np.min(yPred) < MIN_ACCEPTABLE_ESTIMATE:
         print("got estimate below level " + str(MIN_ACCEPTABLE_ESTIMATE))
@@ -1,4 +1,4 @@
-from flask import Flask 
+from flask import Flask, g, request
 from flask_cors import CORS
 from flask_restful import Api
 
@@ -6,6 +6,7 @@ from resources.getSensorData import getSensorData
 from resources.getTimeAggregatedData import getTimeAggregatedData
 from resources.getEstimateMap import getEstimateMap
 from resources.getLiveSensors import getLiveSensors
+from resources.streamLiveSensors import streamLiveSensors
 from resources.getCorrectionFactors import getCorrectionFactors
 from resources.getLocalSensorData import getLocalSensorData
 from resources.getEstimateAtLocation import getEstimateAtLocation
@@ -20,9 +21,12 @@ from resources.apiAdminServices import getKey
 from resources.apiAdminServices import getQuota
 from resources.apiAdminServices import getQuotaUsed
 from resources.apiAdminServices import getQuotaRemaining
+from resources.apiAdminServices import getCacheStats
 
 from resources.Documentation import Documentation
 
+import common.utils
+
 app = Flask(__name__)
 api = Api(app)
 app.config['CORS_HEADERS'] = "Content-Type"
@@ -32,6 +36,7 @@ api.add_resource(getSensorData,          '/getSensorData')
 api.add_resource(getTimeAggregatedData,  '/getTimeAggregatedData')
 api.add_resource(getEstimateMap,         '/getEstimateMap')
 api.add_resource(getLiveSensors,         '/getLiveSensors')
+api.add_resource(streamLiveSensors,      '/streamLiveSensors')
 api.add_resource(getCorrectionFactors,   '/getCorrectionFactors')
 api.add_resource(getLocalSensorData,     '/getLocalSensorData')
 api.add_resource(getEstimateAtLocation,  '/getEstimateAtLocation')
@@ -46,9 +51,30 @@ api.add_resource(getQuota,          '/limited/getQuota')
 api.add_resource(getQuotaUsed,      '/limited/getQuotaUsed')
 api.add_resource(getQuotaRemaining, '/limited/getQuotaRemaining')
 api.add_resource(nickname,          '/limited/nickname')
+api.add_resource(getCacheStats,     '/limited/getCacheStats')
 
 api.add_resource(Documentation, '/docs')
 
+# the requests other than live streams share the worker's API_REQUEST_SLOTS.  The slot is given back when the response is closed, which for
+# a streamed response (getSensorData format=ndjson/csv/arrow/parquet) is when the stream has been sent
+@app.before_request
+def acquireRequestSlot():
+    if request.endpoint != 'streamlivesensors':
+        common.utils.getRequestSlots().acquire()
+        g.request_slot = True
+
+@app.after_request
+def releaseRequestSlotOnClose(response):
+    if g.pop('request_slot', False):
+        response.call_on_close(common.utils.getRequestSlots().release)
+    return response
+
+# (if the request ended without a response to give the slot back with)
+@app.teardown_request
+def releaseRequestSlot(exception):
+    if g.pop('request_slot', False):
+        common.utils.getRequestSlots().release()
+
 if __name__ == '__main__':
     import os
     os.environ['FLASK_ENV'] = 'development'
@@ -2,6 +2,9 @@ from flask_restful import Resource, reqparse
 from common.params import URL_PARAMS
 from common.api_admin_utils import FS_API_OBJ, FS_ACCESS
 import common.utils
+import common.model_cache
+import common.live_snapshot
+import common.live_stream
 from flask import jsonify, make_response
 import common.api_request_key_infos
 
@@ -98,4 +101,23 @@ class getKey(Resource):
         
         api_obj = FS_ACCESS.get_api_obj_for_identifier(args[URL_PARAMS.IDENTIFIER])
         print(api_obj.to_dict())
-        return jsonify({"key": api_obj.key})
\ No newline at end of file
+        return jsonify({"key": api_obj.key})
+
+
+getCacheStatsArgs = reqparse.RequestParser()
+getCacheStatsArgs.add_argument(URL_PARAMS.PASSCODE, type=str, required=True)
+class getCacheStats(Resource):
+    def get(self, **kwargs):
+        args = getCacheStatsArgs.parse_args()
+
+        if passcode != args[URL_PARAMS.PASSCODE]:
+            return []
+
+        telemetry_cache = common.utils.getTelemetryCache()
+        live_snapshot = common.live_snapshot.getLiveSnapshot()
+        live_stream = common.live_stream.getLiveStream()
+        return jsonify({"model cache": common.model_cache.getModelCache().stats(),
+                        "telemetry cache": telemetry_cache.stats() if telemetry_cache is not None else None,
+                        "telemetry backend": common.utils.getTelemetryBackend().stats(),
+                        "live snapshot": live_snapshot.stats() if live_snapshot is not None else None,
+                        "live stream": live_stream.stats() if live_stream is not None else None})
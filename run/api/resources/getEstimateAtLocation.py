@@ -1,4 +1,4 @@
-from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, lat_check, lon_check
+from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, lat_check, lon_check, bool_flag
 from flask_restful import Resource
 from flask_restful.reqparse import RequestParser 
 from flask_restful.inputs import datetime_from_iso8601
@@ -19,6 +19,7 @@ arguments.add_argument(URL_PARAMS.END_TIME,      type=datetime_from_iso8601, hel
 arguments.add_argument(URL_PARAMS.LAT,           type=lat_check,             help=PARAMS_HELP_MESSAGES.LAT,           required=True)
 arguments.add_argument(URL_PARAMS.LON,           type=lon_check,             help=PARAMS_HELP_MESSAGES.LON,           required=True)
 arguments.add_argument(URL_PARAMS.TIME_INTERVAL, type=float,                 help=PARAMS_HELP_MESSAGES.TIME_INTERVAL, required=True)
+arguments.add_argument(URL_PARAMS.VARIANCE,      type=bool_flag,             help=PARAMS_HELP_MESSAGES.VARIANCE,      required=False, default=True)
 
 class getEstimateAtLocation(Resource):
 
@@ -31,6 +32,7 @@ class getEstimateAtLocation(Resource):
         query_lat = args[URL_PARAMS.LAT]
         query_lon = args[URL_PARAMS.LON]
         query_rate = args[URL_PARAMS.TIME_INTERVAL]
+        compute_variance = args[URL_PARAMS.VARIANCE]
 
         _area_models = common.jsonutils.get_all_region_info()
 
@@ -43,21 +45,21 @@ class getEstimateAtLocation(Resource):
         
         query_locations = np.column_stack((np.array((query_lat)), np.array((query_lon))))
 
-        yPred, yVar, query_elevations, status = common.utils.computeEstimatesForLocations(query_dates, query_locations, area_model)
+        yPred, yVar, query_elevations, status = common.utils.computeEstimatesForLocations(query_dates, query_locations, area_model, compute_variance=compute_variance)
         
         num_times = len(query_dates)
         estimates = []
         for i in range(num_times):
-            estimates.append(
-                {
+            estimate = {
                     'PM2_5': (yPred[0, i]), 
-                    'Variance': (yVar[0, i]), 
                     'Time': query_dates[i].strftime('%Y-%m-%d %H:%M:%S%z'), 
                     'Latitude': query_lat, 
                     'Longitude': query_lon, 
                     'Elevation': query_elevations[0], 
                     'Status': status[i]
                 }
-            )
+            if compute_variance:
+                estimate['Variance'] = (yVar[0, i])
+            estimates.append(estimate)
 
         return jsonify(estimates)
\ No newline at end of file
@@ -1,4 +1,4 @@
-from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, lats_parse, lons_parse
+from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, lats_parse, lons_parse, bool_flag
 from flask_restful import Resource
 from flask_restful.reqparse import RequestParser 
 from flask_restful.inputs import datetime_from_iso8601
@@ -19,6 +19,7 @@ arguments.add_argument(URL_PARAMS.END_TIME,      type=datetime_from_iso8601, hel
 arguments.add_argument(URL_PARAMS.LATS,          type=lats_parse,            help=PARAMS_HELP_MESSAGES.LATS,          required=True)
 arguments.add_argument(URL_PARAMS.LONS,          type=lons_parse,            help=PARAMS_HELP_MESSAGES.LONS,          required=True)
 arguments.add_argument(URL_PARAMS.TIME_INTERVAL, type=float,                 help=PARAMS_HELP_MESSAGES.TIME_INTERVAL, required=True)
+arguments.add_argument(URL_PARAMS.VARIANCE,      type=bool_flag,             help=PARAMS_HELP_MESSAGES.VARIANCE,      required=False, default=True)
 
 class getEstimateAtLocations(Resource):
 
@@ -31,6 +32,7 @@ class getEstimateAtLocations(Resource):
         query_lats = args[URL_PARAMS.LATS]
         query_lons = args[URL_PARAMS.LONS]
         query_rate = args[URL_PARAMS.TIME_INTERVAL]
+        compute_variance = args[URL_PARAMS.VARIANCE]
 
         _area_models = common.jsonutils.get_all_region_info()
 
@@ -47,20 +49,20 @@ class getEstimateAtLocations(Resource):
         query_dates = common.utils.interpolateQueryDates(query_start_datetime, query_end_datetime, query_rate)
         query_locations = np.column_stack((query_lats, query_lons))
         
-        yPred, yVar, query_elevations, status = common.utils.computeEstimatesForLocations(query_dates, query_locations, area_model)
+        yPred, yVar, query_elevations, status = common.utils.computeEstimatesForLocations(query_dates, query_locations, area_model, compute_variance=compute_variance)
 
         num_times = len(query_dates)
         data_out = {'Latitude': query_lats.tolist(), 'Longitude': query_lons.tolist(), 'Elevation': query_elevations.tolist()}
         estimates = []
 
         for i in range(num_times):
-            estimates.append(
-                {
+            estimate = {
                     'PM2_5': (yPred[:,i]).tolist(), 
-                    'Variance': (yVar[:,i]).tolist(), 
                     'Time': query_dates[i].strftime('%Y-%m-%d %H:%M:%S%z'), 
                     'Status': status[i]
                 }
-            )
+            if compute_variance:
+                estimate['Variance'] = (yVar[:,i]).tolist()
+            estimates.append(estimate)
         data_out["Estimates"] = estimates
         return jsonify(data_out)
\ No newline at end of file
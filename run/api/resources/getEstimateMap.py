@@ -1,4 +1,4 @@
-from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES
+from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, bool_flag
 from flask_restful import Resource
 from flask_restful.reqparse import RequestParser 
 from flask_restful.inputs import datetime_from_iso8601
@@ -30,6 +30,7 @@ arguments.add_argument(URL_PARAMS.TIME,          type=datetime_from_iso8601, hel
 arguments.add_argument(URL_PARAMS.START_TIME,    type=datetime_from_iso8601, help=PARAMS_HELP_MESSAGES.START_TIME,       required=False, default=None)
 arguments.add_argument(URL_PARAMS.END_TIME,      type=datetime_from_iso8601, help=PARAMS_HELP_MESSAGES.END_TIME,         required=False)
 arguments.add_argument(URL_PARAMS.TIME_INTERVAL, type=float,                 help=PARAMS_HELP_MESSAGES.TIME_INTERVAL_HR, required=False)
+arguments.add_argument(URL_PARAMS.VARIANCE,      type=bool_flag,             help=PARAMS_HELP_MESSAGES.VARIANCE,         required=False, default=True)
 
 
 class getEstimateMap(Resource):
@@ -49,6 +50,7 @@ class getEstimateMap(Resource):
         query_start_datetime = args[URL_PARAMS.START_TIME]
         query_end_datetime = args[URL_PARAMS.END_TIME]
         query_rate = args[URL_PARAMS.TIME_INTERVAL]
+        compute_variance = args[URL_PARAMS.VARIANCE]
 
         # Must include either time or (start, end, interval) but not both
         msg = f"Must include {URL_PARAMS.TIME} or all of: [{URL_PARAMS.START_TIME}, {URL_PARAMS.END_TIME}, {URL_PARAMS.TIME_INTERVAL}]. Cannot include {URL_PARAMS.TIME} and the others."
@@ -90,13 +92,14 @@ class getEstimateMap(Resource):
         else:
             query_dates = common.utils.interpolateQueryDates(query_start_datetime, query_end_datetime, query_rate)      
 
-        yPred, yVar, query_elevations, status = common.utils.computeEstimatesForLocations(query_dates, query_locations, area_model)
+        yPred, yVar, query_elevations, status = common.utils.computeEstimatesForLocations(query_dates, query_locations, area_model, compute_variance=compute_variance)
 
         num_times = len(query_dates)
 
         query_elevations = query_elevations.reshape((lat_vector.shape[0], lon_vector.shape[0]))
         yPred = yPred.reshape((lat_vector.shape[0], lon_vector.shape[0], num_times))
-        yVar = yVar.reshape((lat_vector.shape[0], lon_vector.shape[0], num_times))
+        if compute_variance:
+            yVar = yVar.reshape((lat_vector.shape[0], lon_vector.shape[0], num_times))
 
         estimates = yPred.tolist()
         elevations = query_elevations.tolist()
@@ -110,14 +113,14 @@ class getEstimateMap(Resource):
 
         estimates = []
         for i in range(num_times):
-            estimates.append(
-                {
+            estimate = {
                     'PM2_5': (yPred[:,:,i]).tolist(), 
-                    'Variance': (yVar[:,:,i]).tolist(), 
                     'Time': query_dates[i].strftime('%Y-%m-%d %H:%M:%S%z'), 
                     'Status': status[i]
                 }
-            )
+            if compute_variance:
+                estimate['Variance'] = (yVar[:,:,i]).tolist()
+            estimates.append(estimate)
 
         return_object['estimates'] = estimates
         
@@ -3,10 +3,12 @@ from datetime import datetime, timedelta
 from common.params import *
 from flask_restful import Resource
 from flask_restful.reqparse import RequestParser 
-from flask import jsonify
+from flask import jsonify, make_response, request
 import numpy as np
 import common.utils
 import common.jsonutils
+import common.live_snapshot
+import common.telemetry_cache
 import json
 import pandas as pd
 
@@ -17,6 +19,7 @@ http://localhost:5000/getLiveSensors
 http://localhost:5000/getLiveSensors?sensorSource=AQ%26U
 http://localhost:5000/getLiveSensors?noCorrection=1
 http://localhost:5000/getLiveSensors?areaModel=slc_ut
+http://localhost:5000/getLiveSensors?since=1634150400000
 """
 
 arguments = RequestParser()
@@ -24,6 +27,150 @@ arguments.add_argument(URL_PARAMS.SENSOR_SOURCE, type=str,        help=PARAMS_HE
 arguments.add_argument(URL_PARAMS.NO_CORRECTION, type=bool_flag,  help=PARAMS_HELP_MESSAGES.NO_CORRECTION,      required=False, default=False)
 arguments.add_argument(URL_PARAMS.AREA_MODEL,    type=multi_area, help=PARAMS_HELP_MESSAGES.AREA_MODEL_AS_LIST, required=False, default=multi_area("all"))
 arguments.add_argument(URL_PARAMS.FLAG_OUTLIERS, type=bool_flag,  help=PARAMS_HELP_MESSAGES.FLAG_OUTLIERS,      required=False, default=False)
+arguments.add_argument(URL_PARAMS.SINCE,         type=since_param, help=PARAMS_HELP_MESSAGES.SINCE,             required=False, default=None)
+
+# the live sensors straight from the telemetry table (the latest reading of each device in the last hour), when there is no live snapshot
+def queryLiveSensors(areas, sensor_source, apply_correction, flag_outliers, _area_models):
+    # Define the BigQuery query
+    now = datetime.utcnow()
+    one_hour_ago = now - timedelta(hours=1)  # AirU + PurpleAir sensors have reported in the last hour
+    query_list = []
+
+    with open('common/db_table_headings.json') as json_file:
+        db_table_headings = json.load(json_file)
+        
+    query_list = []
+
+    for this_area in areas:
+        need_source_query = False
+        area_model = _area_models[this_area]
+#        print(area_model)
+        # this logic adjusts for the two cases, where you have different tables for each source or one table for all sources
+        # get all of the sources if you need to
+        source_query = "TRUE"
+        if (sensor_source == "all"):
+            # easy case, query all tables with no source requirement
+            pass
+        elif "sourcetablemap" in area_model:
+            # if it's organized by table, then get the right table (or nothing)
+            if sensor_source in area_model["sourcetablemap"]:
+                sources = area_model["sourcetablemap"][sensor_source]
+            else:
+                sources = None
+        else:
+            # sources are not organized by table.  Get all the tables and add a boolean to check for the source
+            # sources = area_model["idstring"]
+#            source_query = f"{sensor_string} = @sensor_source"
+            need_source_query = True
+
+        # for area_id_string in sources:
+        where_string = " WHERE TRUE"
+        empty_query = False
+        time_string = db_table_headings['time']
+        pm2_5_string = db_table_headings['pm2_5']
+        lon_string = db_table_headings['longitude']
+        humidity_string = db_table_headings['humidity']
+        lat_string = db_table_headings['latitude']
+        id_string = db_table_headings['id']
+        model_string = db_table_headings['sensormodel']
+        table_string = common.utils.getTelemetryBackend().table("telemetry.telemetry")
+
+        column_string = ", ".join([id_string + " AS ID", time_string + " AS time", pm2_5_string + " AS pm2_5", lat_string + " AS lat", lon_string+" AS lon", model_string + " AS sensormodel", f"{humidity_string} AS humidity"])
+        # put together a separate query for all of the specified sources
+        group_string = ", ".join(["ID", "pm2_5", "humidity", "lat", "lon", "area_model", "sensormodel"])
+
+        if "sensorsource" in db_table_headings:
+            sensor_string = db_table_headings['sensorsource']
+            column_string += ", " + sensor_string + " AS sensorsource"
+            group_string += ", sensorsource"
+            if need_source_query:
+                source_query = f"{sensor_string} = '{sensor_source}'"
+        elif need_source_query:
+            # if you are looking for a particular sensor source, but that's not part of the tables info, then the query is not going to return anything
+            empty_query = True
+
+            # This is to cover the case where the different regions are in the same database/table and distinguised by different labels
+        if "label" in db_table_headings:
+            label_string = db_table_headings['label']
+            column_string += ", " + label_string + " AS area_model"
+            if area_model != "all":
+                where_string += " AND " + label_string + " = " + "'" + this_area + "'"
+        else:
+            column_string += ", " + "'" + this_area + "'" + " AS area_model"
+
+        where_string += f" AND {source_query} AND {time_string} >= '{str(one_hour_ago)}'"
+
+        this_query = f"""(WITH a AS (SELECT {column_string} FROM {table_string} {where_string}),  b AS (SELECT {id_string} AS ID, max({time_string})  AS LATEST_MEASUREMENT FROM {table_string} WHERE {time_string} >= '{str(one_hour_ago)}' GROUP BY {id_string}) SELECT * FROM a INNER JOIN b ON a.time = b.LATEST_MEASUREMENT and b.ID = a.ID)"""
+
+        if not empty_query:
+            query_list.append(this_query)
+
+    # Build the actual query from the list of options
+    query = " UNION ALL ".join(query_list)
+    # Run the query and collect the result
+
+    df = common.utils.getTelemetryBackend().query(query)
+    if df.empty:
+        return []
+    status_data = [[]]*df.shape[0]
+    df["status"] = status_data
+    
+    if flag_outliers:
+        filters = {}
+        for this_area in areas:
+            area_model = _area_models[this_area]
+            lo_filter, hi_filter = common.utils.filterUpperLowerBoundsForArea(str(one_hour_ago), str(now), area_model)
+            filters[this_area] = (lo_filter,hi_filter)
+        for idx, datum in df.iterrows():
+            this_lo, this_hi = filters[datum["area_model"]]
+            this_data = datum['pm2_5']
+            if  this_data < 0.0:
+                df.at[idx, 'status'] = df.at[idx, 'status'] + ["No data"]
+            elif (this_data < this_lo) or (this_data > this_hi) or np.isnan(this_data):
+                df.at[idx, 'status'] = df.at[idx, 'status'] + ["Outlier"]
+
+
+                
+    if apply_correction:
+        # find the mean humidity
+        if pd.notnull(df["humidity"]).any():
+            mean_humidity = df["humidity"].mean()
+        else:
+            mean_humidity = _area_models[df["area_model"].iloc[-1]]["defaulthumidity"]
+        print(f"Mean humidity is {mean_humidity}")
+        humidity = df["humidity"].fillna(mean_humidity)
+        pm2_5 = df["pm2_5"].to_numpy(dtype=float, copy=True)
+        correction_status = np.full(df.shape[0], "no correction", dtype=object)
+        # the correction factors are per area, so correct the readings of each area together
+        for this_area, rows in df.groupby("area_model").indices.items():
+            correction_engine = common.jsonutils.getCorrectionEngine(_area_models[this_area]['pm2.5 correction factors'])
+            pm2_5[rows], correction_status[rows] = correction_engine.apply(
+                df["time"].iloc[rows], df["pm2_5"].iloc[rows], humidity.iloc[rows], df["sensormodel"].iloc[rows], df["sensorsource"].iloc[rows])
+        df["pm2_5"] = pm2_5
+        df["status"] = [this_status + [this_correction] for this_status, this_correction in zip(df["status"], correction_status)]
+    else:
+        df["status"] = [this_status + ["No correction"] for this_status in df["status"]]
+
+    sensor_list = []
+
+    df = df.fillna(np.nan)
+    
+    for idx, row in df.iterrows():
+        sensor_list.append(common.utils.dict_nantonull(
+            {
+                "Sensor ID": str(row["ID"]),
+                "Latitude": row["lat"],
+                "Longitude": row["lon"],
+                "Time": row["time"],
+                "Humidity": row["humidity"],
+                "PM2_5": row["pm2_5"],
+                "Sensor model": row["sensormodel"],
+                "Sensor source": row["sensorsource"],
+                "Status":row["status"]
+            })
+        )
+    return sensor_list
+
 
 class getLiveSensors(Resource):
 
@@ -44,157 +191,35 @@ class getLiveSensors(Resource):
             # Check that the arguments we want exist
             sensor_source = "all"
 
-        # Define the BigQuery query
-        now = datetime.utcnow()
-        one_hour_ago = now - timedelta(hours=1)  # AirU + PurpleAir sensors have reported in the last hour
-        query_list = []
-
-        with open('common/db_table_headings.json') as json_file:
-            db_table_headings = json.load(json_file)
-            
-        query_list = []
-
-        for this_area in areas:
-            need_source_query = False
-            area_model = _area_models[this_area]
-    #        print(area_model)
-            # this logic adjusts for the two cases, where you have different tables for each source or one table for all sources
-            # get all of the sources if you need to
-            source_query = "TRUE"
-            if (sensor_source == "all"):
-                # easy case, query all tables with no source requirement
-                pass
-            elif "sourcetablemap" in area_model:
-                # if it's organized by table, then get the right table (or nothing)
-                if sensor_source in area_model["sourcetablemap"]:
-                    sources = area_model["sourcetablemap"][sensor_source]
-                else:
-                    sources = None
-            else:
-                # sources are not organized by table.  Get all the tables and add a boolean to check for the source
-                # sources = area_model["idstring"]
-    #            source_query = f"{sensor_string} = @sensor_source"
-                need_source_query = True
-
-            # for area_id_string in sources:
-            where_string = " WHERE TRUE"
-            empty_query = False
-            time_string = db_table_headings['time']
-            pm2_5_string = db_table_headings['pm2_5']
-            lon_string = db_table_headings['longitude']
-            humidity_string = db_table_headings['humidity']
-            lat_string = db_table_headings['latitude']
-            id_string = db_table_headings['id']
-            model_string = db_table_headings['sensormodel']
-            table_string = "telemetry.telemetry"
-
-            column_string = ", ".join([id_string + " AS ID", time_string + " AS time", pm2_5_string + " AS pm2_5", lat_string + " AS lat", lon_string+" AS lon", model_string + " AS sensormodel", f"{humidity_string} AS humidity"])
-            # put together a separate query for all of the specified sources
-            group_string = ", ".join(["ID", "pm2_5", "humidity", "lat", "lon", "area_model", "sensormodel"])
-
-            if "sensorsource" in db_table_headings:
-                sensor_string = db_table_headings['sensorsource']
-                column_string += ", " + sensor_string + " AS sensorsource"
-                group_string += ", sensorsource"
-                if need_source_query:
-                    source_query = f"{sensor_string} = '{sensor_source}'"
-            elif need_source_query:
-                # if you are looking for a particular sensor source, but that's not part of the tables info, then the query is not going to return anything
-                empty_query = True
-
-                # This is to cover the case where the different regions are in the same database/table and distinguised by different labels
-            if "label" in db_table_headings:
-                label_string = db_table_headings['label']
-                column_string += ", " + label_string + " AS area_model"
-                if area_model != "all":
-                    where_string += " AND " + label_string + " = " + "'" + this_area + "'"
-            else:
-                column_string += ", " + "'" + this_area + "'" + " AS area_model"
-
-            where_string += f" AND {source_query} AND {time_string} >= '{str(one_hour_ago)}'"
-
-            this_query = f"""(WITH a AS (SELECT {column_string} FROM `{table_string}` {where_string}),  b AS (SELECT {id_string} AS ID, max({time_string})  AS LATEST_MEASUREMENT FROM `{table_string}` WHERE {time_string} >= '{str(one_hour_ago)}' GROUP BY {id_string}) SELECT * FROM a INNER JOIN b ON a.time = b.LATEST_MEASUREMENT and b.ID = a.ID)"""
-
-            if not empty_query:
-                query_list.append(this_query)
-
-        # Build the actual query from the list of options
-        query = " UNION ALL ".join(query_list)
-        # Run the query and collect the result
-
-        bq_client = common.utils.getBigQueryClient()
-        query_job = bq_client.query(query)
-    
-        df = pd.DataFrame([dict(r) for r in query_job.result()])
-        if df.empty:
-            return jsonify({'error':'no data'})
-        status_data = [[]]*df.shape[0]
-        df["status"] = status_data
-        
-        if flag_outliers:
-            filters = {}
-            for this_area in areas:
-                area_model = _area_models[this_area]
-                lo_filter, hi_filter = common.utils.filterUpperLowerBoundsForArea(str(one_hour_ago), str(now), area_model)
-                filters[this_area] = (lo_filter,hi_filter)
-            for idx, datum in df.iterrows():
-                this_lo, this_hi = filters[datum["area_model"]]
-                this_data = datum['pm2_5']
-                if  this_data < 0.0:
-                    df.at[idx, 'status'] = df.at[idx, 'status'] + ["No data"]
-                elif (this_data < this_lo) or (this_data > this_hi) or np.isnan(this_data):
-                    df.at[idx, 'status'] = df.at[idx, 'status'] + ["Outlier"]
-
-
-                    
-        if apply_correction:
-            # find the mean humidity
-            if pd.notnull(df["humidity"]).any():
-                mean_humidity = df["humidity"].mean()
-            else:
-                mean_humidity = _area_models[datum["area_model"]]["defaulthumidity"]
-            print(f"Mean humidity is {mean_humidity}")
-            for idx, datum in df.iterrows():
-                if pd.isnull(datum['humidity']):
-                    this_humid = mean_humidity
-                else:
-                    this_humid = datum['humidity']
-                df.at[idx, 'pm2_5'], this_status= common.jsonutils.applyCorrectionFactor(
-                factors=_area_models[datum["area_model"]]['pm2.5 correction factors'], 
-                data_timestamp=datum['time'], 
-                pm2_5=datum['pm2_5'],
-                humidity =  this_humid,
-                sensor_type=datum['sensormodel'], 
-                sensor_source=datum['sensorsource'],
-                status=True
-                )
-                df.at[idx, 'status'] = df.at[idx, 'status'] + [this_status]
+        since = args[URL_PARAMS.SINCE]
+
+        snapshot = common.live_snapshot.getLiveSnapshot()
+        if snapshot is not None:
+            version, sensor_list = snapshot.sensors(areas, sensor_source, apply_correction, flag_outliers, _area_models, since)
+            # the same version and number of sensors (which drop out of the window between versions) is the same response
+            etag = f"{version}-{len(sensor_list)}"
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(etag)
+                response.headers.add('Access-Control-Allow-Origin', '*')
+                return response
         else:
-            for idx, datum in df.iterrows():
-                df.at[idx, 'status'] = df.at[idx, 'status'] + ["No correction"]
-
-        sensor_list = []
+            version, etag = None, None
+            sensor_list = queryLiveSensors(areas, sensor_source, apply_correction, flag_outliers, _area_models)
+            if since is not None:
+                # versions are the snapshot times in milliseconds
+                since = pd.Timestamp(since, unit='ms', tz='UTC') if isinstance(since, int) else common.telemetry_cache.toUTCTimestamp(since)
+                sensor_list = [sensor for sensor in sensor_list if common.telemetry_cache.toUTCTimestamp(sensor["Time"]) > since]
+        # no changes is an empty list rather than an error
+        if (len(sensor_list) == 0) and (since is None):
+            return jsonify({'error':'no data'})
 
-        df = df.fillna(np.nan)
-        
-        for idx, row in df.iterrows():
-            sensor_list.append(common.utils.dict_nantonull(
-                {
-                    "Sensor ID": str(row["ID"]),
-                    "Latitude": row["lat"],
-                    "Longitude": row["lon"],
-                    "Time": row["time"],
-                    "Humidity": row["humidity"],
-                    "PM2_5": row["pm2_5"],
-                    "Sensor model": row["sensormodel"],
-                    "Sensor source": row["sensorsource"],
-                    "Status":row["status"]
-                })
-            )
-        
         response = jsonify(sensor_list)
         response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('')
+        if version is not None:
+            response.set_etag(etag)
+            response.headers.add('X-Snapshot-Version', str(version))
+            response.headers.add('Access-Control-Expose-Headers', 'ETag, X-Snapshot-Version')
         return response
 
             
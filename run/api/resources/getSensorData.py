@@ -1,15 +1,18 @@
+import itertools
 import numpy as np
 import time
-from google.cloud import bigquery
-from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, list_param, multi_area, bool_flag
+from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, list_param, multi_area, bool_flag, sensor_data_format_parse
 from flask_restful import Resource
 from flask_restful.reqparse import RequestParser 
 from flask_restful.inputs import datetime_from_iso8601
-from flask import jsonify, make_response
+from flask import Response, jsonify, make_response, stream_with_context
 import common.utils
 import common.jsonutils
 import json
 import pandas as pd
+import pyarrow as pa
+import common.arrow_output
+import common.telemetry_backend
 
 from common.decorators import processPreRequest
 
@@ -17,6 +20,7 @@ from common.decorators import processPreRequest
 http://127.0.0.1:5000/getSensorData?startTime=2021-09-20T13:00:00Z&endTime=2021-09-20T14:00:00Z
 http://127.0.0.1:5000/getSensorData?startTime=2021-09-20T13:00:00Z&endTime=2021-09-20T14:00:00Z&sensorSource=Tetrad
 http://127.0.0.1:5000/getSensorData?startTime=2021-09-20T13:00:00Z&endTime=2021-09-20T14:00:00Z&areaModel=slc_ut
+http://127.0.0.1:5000/getSensorData?startTime=2021-09-20T13:00:00Z&endTime=2021-09-27T13:00:00Z&areaModel=slc_ut&format=csv
 '''
 
 arguments = RequestParser()
@@ -26,6 +30,67 @@ arguments.add_argument(URL_PARAMS.SENSOR_SOURCE, type=str,                   hel
 arguments.add_argument(URL_PARAMS.ID,            type=list_param,            help=PARAMS_HELP_MESSAGES.ID,                 required=False, default=None)
 arguments.add_argument(URL_PARAMS.NO_CORRECTION, type=bool_flag,             help=PARAMS_HELP_MESSAGES.NO_CORRECTION,      required=False, default=False)
 arguments.add_argument(URL_PARAMS.AREA_MODEL,    type=multi_area,            help=PARAMS_HELP_MESSAGES.AREA_MODEL_AS_LIST, required=False, default=multi_area("all"))
+arguments.add_argument(URL_PARAMS.FORMAT,        type=sensor_data_format_parse, help=PARAMS_HELP_MESSAGES.SENSOR_DATA_FORMAT, required=False, default="json")
+
+STREAM_MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# columns of the arrow and parquet responses (the fields of the JSON response, typed)
+SENSOR_DATA_SCHEMA = pa.schema([("Sensor source", pa.string()), ("Sensor ID", pa.string()), ("PM2_5", pa.float32()), ("Humidity", pa.float64()),
+                                ("Time", pa.timestamp("us", tz="UTC")), ("Latitude", pa.float64()), ("Longitude", pa.float64()), ("Status", pa.string())])
+# columns the corrections need, the only ones taken out of Arrow
+CORRECTION_COLUMNS = ["time", "pm2_5", "humidity", "sensormodel", "sensorsource", "area_model", "mean_humidity"]
+
+# corrected pm2_5 and status of the rows, with the missing humidities taken as mean_humidity
+def correctSensorData(df, _area_models, mean_humidity):
+    humidity = df["humidity"].fillna(mean_humidity)
+    pm2_5 = df["pm2_5"].to_numpy(dtype=float, copy=True)
+    correction_status = df["status"].to_numpy(dtype=object, copy=True)
+    # the correction factors are per area, so correct the readings of each area together
+    for this_area, rows in df.groupby("area_model").indices.items():
+        correction_engine = common.jsonutils.getCorrectionEngine(_area_models[this_area]['pm2.5 correction factors'])
+        pm2_5[rows], correction_status[rows] = correction_engine.apply(
+            df["time"].iloc[rows], df["pm2_5"].iloc[rows], humidity.iloc[rows], df["sensormodel"].iloc[rows], df["sensorsource"].iloc[rows])
+    df["pm2_5"] = pm2_5
+    df["status"] = correction_status
+
+# the rows as NDJSON lines or CSV (the fields of the JSON response), a page at a time as they come from the query, corrected page by page.
+# The query has the mean humidity of all of the rows in each row (mean_humidity), so the corrections are the same as the JSON response's
+def streamSensorData(pages, data_format, apply_correction, _area_models):
+    for page_number, df in enumerate(pages):
+        if df.empty:
+            continue
+        df["status"] = "No correction"
+        if apply_correction:
+            mean_humidity = df["mean_humidity"].iloc[0]
+            correctSensorData(df, _area_models, mean_humidity if pd.notnull(mean_humidity) else common.jsonutils.DEFAULT_DEFAULT_HUMIDITY)
+        records = pd.DataFrame({"Sensor source": df["sensorsource"], "Sensor ID": df["ID"], "PM2_5": df["pm2_5"].astype(float), "Humidity": df["humidity"].astype(float),
+                                "Time": df["time"].dt.strftime(common.utils.DATETIME_FORMAT), "Latitude": df["lat"].astype(float), "Longitude": df["lon"].astype(float),
+                                "Status": df["status"]})
+        if data_format == "csv":
+            yield records.to_csv(index=False, header=(page_number == 0))
+        else:
+            lines = records.to_json(orient='records', lines=True, double_precision=15)
+            yield lines if lines.endswith("\n") else lines + "\n"
+
+# the rows as record batches of SENSOR_DATA_SCHEMA, made from the query's batches column by column.  Only the columns of the corrections
+# become pandas (a batch at a time), the rest stay in Arrow
+def arrowSensorData(table, apply_correction, _area_models):
+    for batch in table.to_batches(max_chunksize=common.telemetry_backend.PAGE_ROWS):
+        if batch.num_rows == 0:
+            continue
+        if apply_correction:
+            df = pa.Table.from_batches([batch]).select(CORRECTION_COLUMNS).to_pandas()
+            df["status"] = "No correction"
+            mean_humidity = df["mean_humidity"].iloc[0]
+            correctSensorData(df, _area_models, mean_humidity if pd.notnull(mean_humidity) else common.jsonutils.DEFAULT_DEFAULT_HUMIDITY)
+            pm2_5 = pa.array(df["pm2_5"].to_numpy(dtype=float), type=pa.float32())
+            status = pa.array(df["status"].to_numpy(dtype=object), type=pa.string())
+        else:
+            pm2_5 = batch.column(batch.schema.get_field_index("pm2_5")).cast(pa.float32())
+            status = pa.array(["No correction"]*batch.num_rows, type=pa.string())
+        columns = [batch.column(batch.schema.get_field_index(name)) for name in ["sensorsource", "ID"]] + [pm2_5] + \
+            [batch.column(batch.schema.get_field_index(name)) for name in ["humidity", "time", "lat", "lon"]] + [status]
+        yield pa.RecordBatch.from_arrays([column.cast(field.type) for column, field in zip(columns, SENSOR_DATA_SCHEMA)], schema=SENSOR_DATA_SCHEMA)
 
 class getSensorData(Resource):
 
@@ -38,6 +103,7 @@ class getSensorData(Resource):
         end = args[URL_PARAMS.END_TIME]
         apply_correction = not bool(args[URL_PARAMS.NO_CORRECTION])
         areas = args[URL_PARAMS.AREA_MODEL]
+        data_format = args[URL_PARAMS.FORMAT]
 
         # Download and parse area_params.json
         _area_models = common.jsonutils.get_all_region_info()
@@ -81,7 +147,7 @@ class getSensorData(Resource):
             lat_string = db_table_headings['latitude']
             id_string = db_table_headings['id']
             model_string = db_table_headings['sensormodel']
-            table_string = "telemetry.telemetry"
+            table_string = common.utils.getTelemetryBackend().table("telemetry.telemetry")
 
             column_string = ", ".join([id_string + " AS ID", time_string + " AS time", pm2_5_string + " AS pm2_5", lat_string + " AS lat", lon_string + " AS lon", model_string +  " AS sensormodel", f"{humidity_string} AS humidity"])
             
@@ -98,7 +164,7 @@ class getSensorData(Resource):
 
             where_string = "time >= @start AND time <= @end"
             if id != None:
-                id_str = ' AND (' + ' OR '.join([f' ID = "{i}" ' for i in id]) + ')'
+                id_str = ' AND (' + ' OR '.join([f" ID = '{i}' " for i in id]) + ')'
                 where_string  += id_str
             where_string += source_query
 
@@ -110,7 +176,7 @@ class getSensorData(Resource):
             else:
                 column_string += ", " + "'" + this_area + "'" + " AS area_model"
 
-            this_query = f"""(SELECT * FROM (SELECT {column_string} FROM `{table_string}`) WHERE ({where_string}))"""
+            this_query = f"""(SELECT * FROM (SELECT {column_string} FROM {table_string}) WHERE ({where_string}))"""
 
             if not empty_query:
                 query_list.append(this_query)
@@ -118,22 +184,36 @@ class getSensorData(Resource):
             query = " UNION ALL ".join(query_list) + " ORDER BY time ASC "
             query = query + "\n-- TOMTESTLOCAL"
 
-        job_config = bigquery.QueryJobConfig(query_parameters=[
-                bigquery.ScalarQueryParameter("id", "STRING", id),
-                bigquery.ScalarQueryParameter("sensor_source", "STRING", sensor_source),
-                bigquery.ScalarQueryParameter("start", "TIMESTAMP", start),
-                bigquery.ScalarQueryParameter("end", "TIMESTAMP", end),
-            ])
+        query_parameters = [
+                ("sensor_source", "STRING", sensor_source),
+                ("start", "TIMESTAMP", start),
+                ("end", "TIMESTAMP", end),
+            ]
+
+        if data_format in common.arrow_output.ARROW_MIMETYPES:
+            query = f"SELECT *, AVG(humidity) OVER () AS mean_humidity FROM ({' UNION ALL '.join(query_list)}) ORDER BY time ASC"
+            table = common.utils.getTelemetryBackend().queryArrow(query, query_parameters)
+            if table.num_rows == 0:
+                return make_response(jsonify(error='no data'), 400)
+            return common.arrow_output.arrowResponse(arrowSensorData(table, apply_correction, _area_models), SENSOR_DATA_SCHEMA, data_format, "sensor_data")
+
+        if data_format in STREAM_MIMETYPES:
+            # the mean humidity for the corrections comes with the rows, since the rows are corrected a page at a time
+            query = f"SELECT *, AVG(humidity) OVER () AS mean_humidity FROM ({' UNION ALL '.join(query_list)}) ORDER BY time ASC"
+            pages = common.utils.getTelemetryBackend().queryPages(query, query_parameters)
+            # the first page (or none) before the response starts, so no data is still an error
+            first_page = next((page for page in pages if not page.empty), None)
+            if first_page is None:
+                return make_response(jsonify(error='no data'), 400)
+            pages = itertools.chain([first_page], pages)
+            return Response(stream_with_context(streamSensorData(pages, data_format, apply_correction, _area_models)), mimetype=STREAM_MIMETYPES[data_format])
 
         print(f"About to run query {query}")
         # Run the query and collect the result
         measurements = []
-        bq_client = common.utils.getBigQueryClient()
         a = time.time()
         print('About to query...')
-        query_job = bq_client.query(query, job_config=job_config)
-        #    rows = query_job.result()
-        df = pd.DataFrame([dict(r) for r in query_job.result()])
+        df = common.utils.getTelemetryBackend().query(query, query_parameters)
 
         if df.empty:
             return make_response(jsonify(error='no data'), 400)
@@ -154,20 +234,7 @@ class getSensorData(Resource):
 #    There is no specific area model to refer to, so just use a stupid guess
                 mean_humidity = common.jsonutils.DEFAULT_DEFAULT_HUMIDITY
 #                mean_humidity = this_model['defaulthumidity']
-            for idx, datum in df.iterrows():
-                if pd.isnull(datum['humidity']):
-                    this_humidity = mean_humidity
-                else:
-                    this_humidity = datum['humidity']
-                df.at[idx, 'pm2_5'], df.at[idx, 'status'] = common.jsonutils.applyCorrectionFactor(
-                    factors=_area_models[datum["area_model"]]['pm2.5 correction factors'], 
-                    data_timestamp=datum['time'], 
-                    pm2_5=datum['pm2_5'], 
-                    humidity = this_humidity,
-                    sensor_type=datum['sensormodel'], 
-                    sensor_source=datum['sensorsource'],
-                    status=True
-                )
+            correctSensorData(df, _area_models, mean_humidity)
             print(f'Finished applying corrections... Took {int(time.time() - a)} seconds')
                 
         #    else:
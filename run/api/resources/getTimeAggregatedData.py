@@ -1,14 +1,17 @@
-from google.cloud import bigquery
 from datetime import timedelta
-from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, list_param, multi_area, function_parse, groupby_parse
+from common.params import URL_PARAMS, PARAMS_HELP_MESSAGES, list_param, multi_area, function_parse, groupby_parse, aggregated_data_format_parse
 from flask_restful import Resource
 from flask_restful.reqparse import RequestParser 
 from flask_restful.inputs import datetime_from_iso8601
 from flask import jsonify
 import common.utils
+import common.arrow_output
 import common.jsonutils
+import common.rollups
 import json
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 from common.decorators import processPreRequest
 
@@ -25,6 +28,7 @@ arguments.add_argument(URL_PARAMS.SENSOR_SOURCE,    type=str,
 arguments.add_argument(URL_PARAMS.ID,               type=list_param,            help=PARAMS_HELP_MESSAGES.ID,                 required=False, default="all")
 arguments.add_argument(URL_PARAMS.APPLY_CORRECTION, type=bool,                  help=PARAMS_HELP_MESSAGES.APPLY_CORRECTION,   required=False)
 arguments.add_argument(URL_PARAMS.AREA_MODEL,       type=multi_area,            help=PARAMS_HELP_MESSAGES.AREA_MODEL_AS_LIST, required=False, default=multi_area("all"))
+arguments.add_argument(URL_PARAMS.FORMAT,           type=aggregated_data_format_parse, help=PARAMS_HELP_MESSAGES.AGGREGATED_DATA_FORMAT, required=False, default="json")
 
 class getTimeAggregatedData(Resource):
 
@@ -45,6 +49,7 @@ class getTimeAggregatedData(Resource):
         id = args[URL_PARAMS.ID]
         apply_correction = (args[URL_PARAMS.APPLY_CORRECTION] is not None)
         areas = args[URL_PARAMS.AREA_MODEL]
+        data_format = args[URL_PARAMS.FORMAT]
 
         _area_models = common.jsonutils.get_all_region_info()
 
@@ -82,6 +87,10 @@ class getTimeAggregatedData(Resource):
             db_table_headings = json.load(json_file)
 
         tables_list = []
+        # the same rows, without the time bounds, and their filters for the rollups
+        area_queries = []
+        area_filters = []
+        backend = common.utils.getTelemetryBackend()
         
         for this_area in areas:
             need_source_query = False
@@ -114,7 +123,7 @@ class getTimeAggregatedData(Resource):
             lat_string = db_table_headings['latitude']
             id_string = db_table_headings['id']
             model_string = db_table_headings['sensormodel']
-            table_string = "telemetry.telemetry"
+            table_string = backend.table("telemetry.telemetry")
 
             # area model gets taken care of below
             column_string = ", ".join([id_string + " AS ID", time_string + " AS time", pm2_5_string + " AS pm2_5", lat_string + " AS lat", lon_string+" AS lon", model_string + " AS sensormodel", humidity_string + " AS humidity"])
@@ -128,10 +137,10 @@ class getTimeAggregatedData(Resource):
                 # if you are looking for a particular sensor source, but that's not part of the tables info, then the query is not going to return anything
                 empty_query = True
 
-            where_string = f"pm2_5 < {common.utils.MAX_ALLOWED_PM2_5} AND time >= @start AND time <= '{end_interval}'"
+            filter_string = ""
             if id != "all":
-                where_string  += " AND ID = @id"
-            where_string += source_query
+                filter_string  += " AND ID = @id"
+            filter_string += source_query
 
                 # This is to cover the case where the different regions are in the same database/table and distinguised by different labels
             if "label" in db_table_headings:
@@ -139,54 +148,39 @@ class getTimeAggregatedData(Resource):
                 column_string += ", " + label_string + " AS areamodel"
                 if area_model != "all":
 #                    where_string += " AND " + label_string + " = " + "'" + this_area + "'"
-                    where_string += " AND areamodel = " + "'" + this_area + "'"
+                    filter_string += " AND areamodel = " + "'" + this_area + "'"
             else:
                 column_string += ", " + "'" + this_area + "'" + " AS areamodel"
 
-            this_query = f"""(SELECT * FROM (SELECT {column_string} FROM `{table_string}`) WHERE ({where_string}))"""
+            where_string = f"pm2_5 < {common.utils.MAX_ALLOWED_PM2_5} AND time >= @start AND time <= '{end_interval}'" + filter_string
+            this_query = f"""(SELECT * FROM (SELECT {column_string} FROM {table_string}) WHERE ({where_string}))"""
         
 
             if not empty_query:
                 tables_list.append(this_query)
+                area_queries.append(f"SELECT * FROM (SELECT {column_string} FROM {table_string}) WHERE (pm2_5 < {common.utils.MAX_ALLOWED_PM2_5}{filter_string})")
+                area_filters.append(filter_string)
 
 
-        query = f"""
-            WITH
-                intervals AS (
-                    SELECT
-                        TIMESTAMP_ADD(@start, INTERVAL @interval * num MINUTE) AS lower,
-                        TIMESTAMP_ADD(@start, INTERVAL @interval * 60* (1 + num) - 1 SECOND) AS upper
-                    FROM UNNEST(GENERATE_ARRAY(0,  DIV(TIMESTAMP_DIFF(@end, @start, MINUTE) , @interval))) AS num
-                )
-            SELECT
-                CASE WHEN {SQL_FUNCTIONS.get(function)}(pm2_5) IS NOT NULL
-                    THEN {SQL_FUNCTIONS.get(function)}(pm2_5)
-                    ELSE 0
-                    END AS PM2_5,
-               {SQL_FUNCTIONS.get("mean")}(humidity) AS HUMIDITY,
-                upper  {group_string}
-            FROM intervals
-                JOIN (
-                {' UNION ALL '.join(tables_list)}
-            ) sensors
-                ON sensors.time BETWEEN intervals.lower AND intervals.upper
-            GROUP BY upper {group_string}
-            ORDER BY upper"""
+        # intervals of whole hours (or days) come from the rollups as far as they go, and from the raw telemetry after that
+        stop = start + timedelta(minutes=((int((end - start).total_seconds()) // 60) // timeInterval + 1)*timeInterval) if timeInterval > 0 else start
+        rollup_parts, raw_lo = common.rollups.rollupParts(backend, start, stop, timeInterval, function)
+        rollup_parameters = []
+        if len(rollup_parts) > 0:
+            query, rollup_parameters = common.rollups.aggregationQuery(backend, rollup_parts, raw_lo, stop, area_queries, area_filters, function, group_string)
+        else:
+            query = common.rollups.bucketAggregationQuery(backend, tables_list, SQL_FUNCTIONS.get(function), group_string)
         
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("id", "STRING", id),
-                bigquery.ScalarQueryParameter("start", "TIMESTAMP", start),
-                bigquery.ScalarQueryParameter("end", "TIMESTAMP", end),
-                bigquery.ScalarQueryParameter("interval", "INT64", timeInterval),
-            ]
-        )
+        query_parameters = [
+                ("id", "STRING", id),
+                ("start", "TIMESTAMP", start),
+                ("end", "TIMESTAMP", end),
+                ("interval", "INT64", timeInterval),
+            ] + rollup_parameters
         
         # Run the query and collect the result
         measurements = []
-        bq_client = common.utils.getBigQueryClient()
-        query_job = bq_client.query(query, job_config=job_config)
-        rows = pd.DataFrame([dict(r) for r in query_job.result()])
+        rows = backend.query(query, query_parameters)
 
         # find the average humidity to fill in...
         if pd.notnull(rows["HUMIDITY"]).any():
@@ -194,14 +188,39 @@ class getTimeAggregatedData(Resource):
         else:
             mean_humidity = common.jsonutils.DEFAULT_DEFAULT_HUMIDITY
 
+        # correct the whole column, an area at a time (the correction factors are per area)
+        corrected_pm2_5 = rows["PM2_5"].to_numpy(dtype=float, copy=True)
+        correction_status = np.full(rows.shape[0], "no correction", dtype=object)
+        if apply_correction and ("areamodel" in rows) and ("sensormodel" in rows):
+            humidity = rows["HUMIDITY"].fillna(mean_humidity)
+            for this_area, area_rows in rows.groupby("areamodel").indices.items():
+                correction_engine = common.jsonutils.getCorrectionEngine(_area_models[this_area]['pm2.5 correction factors'])
+                corrected_pm2_5[area_rows], correction_status[area_rows] = correction_engine.apply(
+                    rows["upper"].iloc[area_rows], rows["PM2_5"].iloc[area_rows], humidity.iloc[area_rows], rows["sensormodel"].iloc[area_rows])
+
+        # the same fields as the JSON response, typed and made a column at a time (the time is always "Time", and grouped by id "Sensor ID" is
+        # the id of each row)
+        if data_format in common.arrow_output.ARROW_MIMETYPES:
+            if not apply_correction:
+                correction_status = np.full(rows.shape[0], "Not corrected", dtype=object)
+            columns = {
+                "PM2_5": pa.array(corrected_pm2_5, type=pa.float32(), from_pandas=True),
+                "Humidity": pa.array(rows["HUMIDITY"].to_numpy(dtype=float), type=pa.float64(), from_pandas=True),
+                "Time": pa.array(pd.to_datetime(rows["upper"], utc=True) + timedelta(seconds=1), type=pa.timestamp("us", tz="UTC")),
+                "Status": pa.array(correction_status, type=pa.string())}
+            if group_by != None:
+                columns["Sensor ID" if group_by == "id" else group_by] = pa.array(rows[group_tags[group_by]], type=pa.string())
+            if (id != "all") and (group_by != "id"):
+                columns["Sensor ID"] = pa.array([",".join(id)]*rows.shape[0], type=pa.string())
+            if sensor_source != "all":
+                columns["Sensor source"] = pa.array([sensor_source]*rows.shape[0], type=pa.string())
+            table = pa.table(columns)
+            return common.arrow_output.arrowResponse(table.to_batches(), table.schema, data_format, "time_aggregated_data")
+
         if group_string == "":
             for idx, row in rows.iterrows():
                 if apply_correction:
-                    if pd.notnull(row['HUMIDITY']):
-                        this_humidity = row['HUMIDITY']
-                    else:
-                        this_humidity = mean_humidity
-                    new_pm2_5, status = common.jsonutils.applyCorrectionFactor(_area_models[row["areamodel"]['pm2.5 correction factors']], row["upper"], row["PM2_5"], this_humidity, row["sensormodel"], status=True)
+                    new_pm2_5, status = corrected_pm2_5[idx], correction_status[idx]
                 else:
                     new_pm2_5 = row["PM2_5"]
                     status = "Not corrected"
@@ -214,11 +233,7 @@ class getTimeAggregatedData(Resource):
         else:
             for idx, row in rows.iterrows():
                 if apply_correction:
-                    if pd.notnull(row['HUMIDITY']):
-                        this_humidity = row['HUMIDITY']
-                    else:
-                        this_humidity = mean_humidity
-                    new_pm2_5, status = common.jsonutils.applyCorrectionFactor(_area_models[row["areamodel"]]['pm2.5 correction factors'], row["upper"], row["PM2_5"], this_humidity, row["sensormodel"], status=True)
+                    new_pm2_5, status = corrected_pm2_5[idx], correction_status[idx]
                 else:
                     new_pm2_5 = row["PM2_5"]
                     status = "Not corrected"
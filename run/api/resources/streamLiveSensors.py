@@ -0,0 +1,61 @@
+from common.params import *
+from flask_restful import Resource
+from flask_restful.reqparse import RequestParser
+from flask import Response, jsonify, make_response, request, stream_with_context
+import common.jsonutils
+import common.live_stream
+
+from common.decorators import processPreRequest
+
+"""
+http://localhost:5000/streamLiveSensors
+http://localhost:5000/streamLiveSensors?areaModel=slc_ut&sensorSource=AQ%26U
+http://localhost:5000/streamLiveSensors?format=ndjson&flagOutliers=1
+"""
+
+arguments = RequestParser()
+arguments.add_argument(URL_PARAMS.SENSOR_SOURCE, type=str,                 help=PARAMS_HELP_MESSAGES.SENSOR_SOURCE,      required=False, default="all")
+arguments.add_argument(URL_PARAMS.NO_CORRECTION, type=bool_flag,           help=PARAMS_HELP_MESSAGES.NO_CORRECTION,      required=False, default=False)
+arguments.add_argument(URL_PARAMS.AREA_MODEL,    type=multi_area,          help=PARAMS_HELP_MESSAGES.AREA_MODEL_AS_LIST, required=False, default=multi_area("all"))
+arguments.add_argument(URL_PARAMS.FLAG_OUTLIERS, type=bool_flag,           help=PARAMS_HELP_MESSAGES.FLAG_OUTLIERS,      required=False, default=False)
+arguments.add_argument(URL_PARAMS.SINCE,         type=since_param,         help=PARAMS_HELP_MESSAGES.SINCE,              required=False, default=None)
+arguments.add_argument(URL_PARAMS.FORMAT,        type=stream_format_parse, help=PARAMS_HELP_MESSAGES.STREAM_FORMAT,      required=False, default="sse")
+
+# the live sensors (as getLiveSensors returns them) and then the sensors that change with each refresh of the live snapshot, pushed as
+# server-sent events (id is the snapshot version) or NDJSON lines ({"version": ..., "sensors": [...]})
+class streamLiveSensors(Resource):
+
+    @processPreRequest()
+    def get(self, **kwargs):
+        args = arguments.parse_args()
+        sensor_source = args[URL_PARAMS.SENSOR_SOURCE]
+        apply_correction = not args[URL_PARAMS.NO_CORRECTION]
+        areas = args[URL_PARAMS.AREA_MODEL]
+        flag_outliers = bool(args[URL_PARAMS.FLAG_OUTLIERS])
+        stream_format = args[URL_PARAMS.FORMAT]
+        since = args[URL_PARAMS.SINCE]
+
+        if sensor_source == "" or sensor_source == "undefined" or sensor_source==None:
+            sensor_source = "all"
+        # an EventSource that reconnects picks up from the last version it got
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        if last_event_id.isdigit():
+            since = int(last_event_id)
+
+        stream = common.live_stream.getLiveStream()
+        if stream is None:
+            return make_response(jsonify({'error': 'live sensor stream is not available'}), 503)
+        subscriber = stream.subscribe(areas, sensor_source, apply_correction, flag_outliers, stream_format)
+        if subscriber is None:
+            response = make_response(jsonify({'error': 'too many live sensor streams, try again later'}), 503)
+            response.headers.add('Retry-After', str(stream.keepalive_seconds))
+            return response
+
+        response = Response(stream_with_context(stream.messages(subscriber, since)), mimetype=common.live_stream.STREAM_MIMETYPES[stream_format])
+        # the generator only unsubscribes once it has started, and the response can be closed before that (e.g. the client went away)
+        response.call_on_close(lambda: stream.unsubscribe(subscriber))
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        response.headers.add('Cache-Control', 'no-cache')
+        # no buffering by nginx-style proxies
+        response.headers.add('X-Accel-Buffering', 'no')
+        return response